@@ -0,0 +1,585 @@
+"""Importable raw TCP/IP helpers for the encapsulation notebook (vectorized checksum + batch builder)"""
+
+# NOTE: The notebook cells build one packet at a time (checksum in pure Python, every header packed twice).
+# This module keeps the same functions/transport but adds a NumPy fast path that builds many packets at once,
+# and RawTcpTransport.encapsulate() builds one packet from header sums precomputed per transport (~2x the notebook).
+import socket, struct, random, time, platform, threading
+from typing import Optional, Sequence, List, Iterable, Tuple
+
+IS_WINDOWS = (platform.system() == 'Windows')
+try:
+    import numpy as np
+    HAVE_NUMPY = True
+except Exception as e:
+    HAVE_NUMPY = False
+    NUMPY_IMPORT_ERR = e
+try:
+    from scapy.all import IP as SCAPY_IP, TCP as SCAPY_TCP, Raw as SCAPY_Raw, send as scapy_send
+    HAVE_SCAPY = True
+except Exception as e:
+    HAVE_SCAPY = False
+    SCAPY_IMPORT_ERR = e
+
+IP_HEADER_LEN = 20
+TCP_HEADER_LEN = 20
+HEADERS_LEN = IP_HEADER_LEN + TCP_HEADER_LEN
+IP_HEADER_FMT = struct.Struct('!BBHHHBBH4s4s')
+TCP_HEADER_FMT = struct.Struct('!HHLLBBHHH')
+HEADERS_FMT = struct.Struct('!BBHHHBBH4s4sHHLLBBHHH')   # IP + TCP header in one pack
+IP_CHECKSUM_OFFSET = 10                         # Offset of the checksum inside the IP header
+TCP_SEQ_OFFSET = IP_HEADER_LEN + 4              # Offset of the seq number inside a full packet
+TCP_CHECKSUM_OFFSET = IP_HEADER_LEN + 16        # Offset of the TCP checksum inside a full packet
+NUMPY_MIN_BYTES = 512                           # Below this, struct.unpack beats the NumPy call overhead
+
+
+# ==============================
+# ===== Checksum (RFC 1071) ====
+# ==============================
+# Fold a 32/64-bit running sum into 16 bits (one's complement carry) -->
+def _fold(res: int) -> int:
+    while res >> 16:
+        res = (res & 0xFFFF) + (res >> 16)
+    return res
+
+# Sum of all 16-bit big-endian words (pads odd data with one zero byte) -->
+def ones_complement_sum(data: bytes) -> int:
+    if len(data) % 2:
+        data = bytes(data) + b'\0'
+    if HAVE_NUMPY and len(data) >= NUMPY_MIN_BYTES:
+        return _fold(int(np.frombuffer(data, dtype='>u2').sum(dtype=np.uint64)))
+    return _fold(sum(struct.unpack('!%dH' % (len(data) // 2), data)))
+
+# Function to calculate checksum (same result as the notebook version) -->
+def checksum(data: bytes) -> int:
+    return ~ones_complement_sum(data) & 0xFFFF
+
+# Incremental update of a checksum when one 16-bit word changes (RFC 1624, eqn. 3) -->
+def checksum_update(old_checksum: int, old_word: int, new_word: int) -> int:
+    return ~_fold((~old_checksum & 0xFFFF) + (~old_word & 0xFFFF) + new_word) & 0xFFFF
+
+# Helper function to display the data -->
+def hexdump(data: bytes, width: int=16):
+    for i in range(0, len(data), width):
+        chunk = data[i:i+width]
+        hex_bytes = ' '.join(f'{b:02x}' for b in chunk)
+        ascii_bytes = ''.join(chr(b) if 32 <= b < 127 else '.' for b in chunk)
+        print(f"{i:04x}  {hex_bytes:<{width*3}}  {ascii_bytes}")
+
+
+# ============================
+# ===== Single packet path ===
+# ============================
+# Same signature as the notebook, but the header is packed once and the checksum is patched in place -->
+def build_ip_header(src_ip: str, dst_ip: str, payload_len: int, proto: int=socket.IPPROTO_TCP,
+                    identification: Optional[int]=None) -> bytes:
+    if identification is None:
+        identification = random.randint(0, 65535)
+    ip_header = bytearray(IP_HEADER_FMT.pack((4 << 4) + 5, 0, IP_HEADER_LEN + payload_len, identification,
+                                             0, 64, proto, 0, socket.inet_aton(src_ip), socket.inet_aton(dst_ip)))
+    struct.pack_into('!H', ip_header, IP_CHECKSUM_OFFSET, checksum(ip_header))
+    return bytes(ip_header)
+
+def build_tcp_header(src_ip: str, dst_ip: str, src_port: int, dst_port: int, payload: bytes=b'',
+                     seq: Optional[int]=None, ack_seq: int=0, flags: int=0x02, window: int=65535) -> bytes:
+    if seq is None:
+        seq = random.randint(0, 0xFFFFFFFF)
+    tcp_header = bytearray(TCP_HEADER_FMT.pack(src_port, dst_port, seq, ack_seq, (5 << 4), flags, window, 0, 0))
+    pseudo_header = struct.pack('!4s4sBBH', socket.inet_aton(src_ip), socket.inet_aton(dst_ip),
+                                0, socket.IPPROTO_TCP, TCP_HEADER_LEN + len(payload))
+    struct.pack_into('!H', tcp_header, 16, checksum(pseudo_header + tcp_header + payload))
+    return bytes(tcp_header)
+
+
+# ==========================
+# ===== Batch packet path ==
+# ==========================
+class PacketBatch:
+    """
+    Many IP+TCP packets stored back to back in ONE preallocated buffer.
+    Every packet gets an even-sized slot (odd payloads keep a zero pad byte that is never sent),
+    so the whole buffer can be viewed as 16-bit words for the vectorized checksums.
+    """
+
+    def __init__(self, buffer: bytearray, offsets: List[int], lengths: List[int]):
+        self.buffer = buffer
+        self.offsets = offsets      # Start of each packet inside the buffer
+        self.lengths = lengths      # Real (sent) length of each packet
+        self._view = memoryview(buffer)
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    # A zero-copy view of packet i (what actually goes on the wire) -->
+    def packet(self, i: int) -> memoryview:
+        o = self.offsets[i]
+        return self._view[o:o + self.lengths[i]]
+
+    def __iter__(self):
+        for i in range(len(self.offsets)):
+            yield self.packet(i)
+
+    # Replace the seq numbers of all packets, fixing the TCP checksum incrementally (no payload re-sum) -->
+    def set_seqs(self, seqs: Sequence[int]) -> None:
+        if len(seqs) != len(self.offsets):
+            raise ValueError("Need exactly one seq per packet")
+        if HAVE_NUMPY and self.offsets:
+            self._set_seqs_numpy(seqs)
+            return
+        buf = self.buffer
+        for o, new_seq in zip(self.offsets, seqs):
+            old_hi, old_lo, old_sum = struct.unpack_from('!HH8xH', buf, o + TCP_SEQ_OFFSET)
+            new_hi, new_lo = (new_seq >> 16) & 0xFFFF, new_seq & 0xFFFF
+            res = checksum_update(checksum_update(old_sum, old_hi, new_hi), old_lo, new_lo)
+            struct.pack_into('!L', buf, o + TCP_SEQ_OFFSET, new_seq & 0xFFFFFFFF)
+            struct.pack_into('!H', buf, o + TCP_CHECKSUM_OFFSET, res)
+
+    def _set_seqs_numpy(self, seqs: Sequence[int]) -> None:
+        words = np.frombuffer(self.buffer, dtype='>u2')      # Writable view (bytearray backed)
+        base = np.asarray(self.offsets, dtype=np.int64) // 2
+        seq_w = base + TCP_SEQ_OFFSET // 2
+        sum_w = base + TCP_CHECKSUM_OFFSET // 2
+        new = np.asarray(seqs, dtype=np.uint64) & 0xFFFFFFFF
+        new_hi, new_lo = (new >> 16) & 0xFFFF, new & 0xFFFF
+        old_hi, old_lo = words[seq_w].astype(np.uint64), words[seq_w + 1].astype(np.uint64)
+        # HC' = ~(~HC + ~m + m') for both 16-bit halves of the seq at once:
+        res = ((~words[sum_w]).astype(np.uint64) & 0xFFFF) + (~old_hi & 0xFFFF) + new_hi + (~old_lo & 0xFFFF) + new_lo
+        words[sum_w] = ~_fold_array(res) & 0xFFFF
+        words[seq_w], words[seq_w + 1] = new_hi, new_lo
+
+    # Swap the payload of packet i for another payload of the SAME length (checksum updated incrementally) -->
+    def set_payload(self, i: int, payload: bytes) -> None:
+        o, n = self.offsets[i], self.lengths[i] - HEADERS_LEN
+        if len(payload) != n:
+            raise ValueError(f"Payload must keep the same length ({n} bytes)")
+        start = o + HEADERS_LEN
+        old_sum = ones_complement_sum(self.buffer[start:start + n])
+        new_sum = ones_complement_sum(payload)
+        (old_chk,) = struct.unpack_from('!H', self.buffer, o + TCP_CHECKSUM_OFFSET)
+        self.buffer[start:start + n] = payload
+        struct.pack_into('!H', self.buffer, o + TCP_CHECKSUM_OFFSET, checksum_update(old_chk, old_sum, new_sum))
+
+# Vectorized version of _fold for uint64 numpy arrays -->
+def _fold_array(res):
+    while True:
+        carry = res >> 16
+        if not carry.any():
+            return res
+        res = (res & 0xFFFF) + carry
+
+# Build all packets into one buffer (pure Python fallback: still one buffer, one pack per header) -->
+def _build_batch_python(src_ip, dst_ip, src_port, dst_port, payloads, seqs, idents, flags, window) -> PacketBatch:
+    offsets, lengths, total = [], [], 0
+    for p in payloads:
+        offsets.append(total)
+        lengths.append(HEADERS_LEN + len(p))
+        total += HEADERS_LEN + len(p) + (len(p) & 1)
+    buf = bytearray(total)
+    src, dst = socket.inet_aton(src_ip), socket.inet_aton(dst_ip)
+    pseudo_sum = ones_complement_sum(src + dst) + socket.IPPROTO_TCP
+    for o, n, p, seq, ident in zip(offsets, lengths, payloads, seqs, idents):
+        IP_HEADER_FMT.pack_into(buf, o, (4 << 4) + 5, 0, n, ident, 0, 64, socket.IPPROTO_TCP, 0, src, dst)
+        struct.pack_into('!H', buf, o + IP_CHECKSUM_OFFSET, checksum(buf[o:o + IP_HEADER_LEN]))
+        TCP_HEADER_FMT.pack_into(buf, o + IP_HEADER_LEN, src_port, dst_port, seq, 0, (5 << 4), flags, window, 0, 0)
+        buf[o + HEADERS_LEN:o + n] = p
+        seg_sum = ones_complement_sum(buf[o + IP_HEADER_LEN:o + n])
+        struct.pack_into('!H', buf, o + TCP_CHECKSUM_OFFSET, ~_fold(pseudo_sum + (n - IP_HEADER_LEN) + seg_sum) & 0xFFFF)
+    return PacketBatch(buf, offsets, lengths)
+
+# Build all packets into one buffer with NumPy (headers + both checksums vectorized) -->
+def _build_batch_numpy(src_ip, dst_ip, src_port, dst_port, payloads, seqs, idents, flags, window) -> PacketBatch:
+    n_pkts = len(payloads)
+    plen = np.fromiter((len(p) for p in payloads), dtype=np.int64, count=n_pkts)
+    slot = HEADERS_LEN + plen + (plen & 1)
+    offsets = np.zeros(n_pkts, dtype=np.int64)
+    np.cumsum(slot[:-1], out=offsets[1:])
+    total = int(slot.sum())
+    buf = bytearray(total)
+
+    # 1) Header template repeated n times, then the per-packet fields are filled column-wise:
+    template = bytearray(HEADERS_LEN)
+    IP_HEADER_FMT.pack_into(template, 0, (4 << 4) + 5, 0, 0, 0, 0, 64, socket.IPPROTO_TCP, 0,
+                            socket.inet_aton(src_ip), socket.inet_aton(dst_ip))
+    TCP_HEADER_FMT.pack_into(template, IP_HEADER_LEN, src_port, dst_port, 0, 0, (5 << 4), flags, window, 0, 0)
+    hdr = np.tile(np.frombuffer(bytes(template), dtype='>u2'), (n_pkts, 1))     # (n, 20) words
+    seq_arr = np.asarray(seqs, dtype=np.uint64) & 0xFFFFFFFF
+    hdr[:, 1] = HEADERS_LEN + plen                      # IP total length
+    hdr[:, 2] = np.asarray(idents, dtype=np.uint64)     # IP identification
+    hdr[:, 12] = seq_arr >> 16                          # TCP seq (high word)
+    hdr[:, 13] = seq_arr & 0xFFFF                       # TCP seq (low word)
+
+    # 2) Scatter headers and payloads into the single buffer:
+    u8 = np.frombuffer(buf, dtype=np.uint8)
+    u8[(offsets[:, None] + np.arange(HEADERS_LEN)).ravel()] = hdr.view(np.uint8).ravel()
+    view = memoryview(buf)
+    for o, p in zip(offsets.tolist(), payloads):
+        view[o + HEADERS_LEN:o + HEADERS_LEN + len(p)] = p
+
+    # 3) IP checksum: 10 words per header row.
+    ip_sum = _fold_array(hdr[:, :IP_HEADER_LEN // 2].astype(np.uint64).sum(axis=1))
+    # 4) TCP checksum: pseudo header + (TCP header + payload) words, summed with a prefix sum over the buffer.
+    words = np.frombuffer(buf, dtype='>u2')
+    prefix = np.zeros(len(words) + 1, dtype=np.uint64)
+    np.cumsum(words, dtype=np.uint64, out=prefix[1:])
+    seg_start = (offsets + IP_HEADER_LEN) // 2
+    seg_end = (offsets + slot) // 2
+    pseudo_sum = ones_complement_sum(socket.inet_aton(src_ip) + socket.inet_aton(dst_ip)) + socket.IPPROTO_TCP
+    tcp_sum = _fold_array(prefix[seg_end] - prefix[seg_start] + (TCP_HEADER_LEN + plen).astype(np.uint64) + pseudo_sum)
+
+    base = offsets // 2
+    words[base + IP_CHECKSUM_OFFSET // 2] = ~ip_sum & 0xFFFF
+    words[base + TCP_CHECKSUM_OFFSET // 2] = ~tcp_sum & 0xFFFF
+    return PacketBatch(buf, offsets.tolist(), (HEADERS_LEN + plen).tolist())
+
+
+# ==================================
+# ===== Cross-Platform Transport ===
+# ==================================
+# - Linux/macOS: raw sockets (we include the IP header)
+# - Windows: Scapy + Npcap fallback (raw TCP sockets are blocked by the OS)
+# - sock=...: packets go out on a socket we were given (LocalPacketSink.transport(): no root, no Scapy)
+class RawTcpTransport:
+    def __init__(self, src_ip: str, dst_ip: str, src_port: int, dst_port: int, iface: Optional[str]=None,
+                 windows_fallback: Optional[bool]=None, sock: Optional[socket.socket]=None):
+        self.src_ip = src_ip
+        self.dst_ip = dst_ip
+        self.src_port = src_port
+        self.dst_port = dst_port
+        self.iface = iface
+        self.sock_addr: Tuple[str, int] = (dst_ip, 0)      # Where raw packets are sent (a LocalPacketSink changes it)
+        self.windows_fallback = IS_WINDOWS if windows_fallback is None else windows_fallback
+
+        # Header words that are the same for every packet of this transport, summed once (see encapsulate) -->
+        self._src, self._dst = socket.inet_aton(src_ip), socket.inet_aton(dst_ip)
+        addr_sum = sum(struct.unpack('!4H', self._src + self._dst))
+        self._ip_sum = ((4 << 4) + 5 << 8) + (64 << 8) + socket.IPPROTO_TCP + addr_sum
+        self._tcp_sum = addr_sum + socket.IPPROTO_TCP + src_port + dst_port + 65535     # Pseudo header + ports + window
+
+        if sock is not None:
+            self.windows_fallback = False
+            self.sock = sock
+        elif not self.windows_fallback:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_RAW)
+        else:
+            if not HAVE_SCAPY:
+                raise RuntimeError(
+                    f"Windows detected but Scapy is not available: {SCAPY_IMPORT_ERR}.\n"
+                    "Install with: pip install scapy. Ensure Npcap is installed with loopback support."
+                )
+
+    # One packet: the same bytes as build_ip_header + build_tcp_header + data, but both checksums come from the
+    # per-transport sums above + the few words that change (lengths, id, seq, flags) + one pass over the payload,
+    # and the two headers are packed once, together -->
+    def encapsulate(self, data: bytes, flags: int=0x02) -> bytes:
+        seq, ident = random.getrandbits(32), random.getrandbits(16)
+        total = HEADERS_LEN + len(data)
+        ip_check = ~_fold(self._ip_sum + total + ident) & 0xFFFF
+        tcp_check = ~_fold(self._tcp_sum + (total - IP_HEADER_LEN) + (seq >> 16) + (seq & 0xFFFF)
+                           + ((5 << 12) | flags) + ones_complement_sum(data)) & 0xFFFF
+        return HEADERS_FMT.pack((4 << 4) + 5, 0, total, ident, 0, 64, socket.IPPROTO_TCP, ip_check, self._src, self._dst,
+                                self.src_port, self.dst_port, seq, 0, 5 << 4, flags, 65535, tcp_check, 0) + data
+
+    # Build thousands of packets into one preallocated buffer -->
+    # seq=None -> random ISN, then each packet continues the stream (seq += previous payload length)
+    def encapsulate_batch(self, payloads: Sequence[bytes], flags: int=0x18, seq: Optional[int]=None,
+                          window: int=65535) -> PacketBatch:
+        payloads = [bytes(p) for p in payloads]
+        if seq is None:
+            seq = random.randint(0, 0xFFFFFFFF)
+        seqs, s = [], seq
+        for p in payloads:
+            seqs.append(s & 0xFFFFFFFF)
+            s += len(p)
+        idents = [random.randint(0, 65535) for _ in payloads]
+        build = _build_batch_numpy if (HAVE_NUMPY and payloads) else _build_batch_python
+        return build(self.src_ip, self.dst_ip, self.src_port, self.dst_port, payloads, seqs, idents, flags, window)
+
+    def send(self, data: bytes, flags: int=0x02):
+        if not self.windows_fallback:
+            pkt = self.encapsulate(data, flags=flags)
+            self.sock.sendto(pkt, self.sock_addr)
+        else:
+            scapy_pkt = SCAPY_IP(src=self.src_ip, dst=self.dst_ip)/SCAPY_TCP(sport=self.src_port, dport=self.dst_port, flags=flags)/SCAPY_Raw(data)
+            chosen_iface = self.iface
+            if chosen_iface is None and self.dst_ip in ("127.0.0.1", "::1"):
+                chosen_iface = "Npcap Loopback Adapter"
+            scapy_send(scapy_pkt, verbose=False, iface=chosen_iface)
+
+    # Bulk send: pre-build every packet once, then push them in batches over the raw socket (no Scapy) -->
+    # Python has no sendmmsg(), so a "batch" is a tight sendto() loop over zero-copy slices of one buffer;
+    # rate_pps=None sends as fast as possible, otherwise a token bucket paces whole batches (no fixed sleeps).
+    def send_bulk(self, payloads: Sequence[bytes], flags: int=0x18, batch_size: int=256,
+                  rate_pps: Optional[float]=None, burst: Optional[int]=None) -> dict:
+        if getattr(self, 'sock', None) is None:
+            raise RuntimeError("send_bulk() needs the raw socket path (windows_fallback=False or a LocalPacketSink)")
+        batch = self.encapsulate_batch(payloads, flags=flags)
+        bucket = TokenBucket(rate_pps, burst or batch_size) if rate_pps else None
+        sendto, addr, view = self.sock.sendto, self.sock_addr, batch._view
+        offsets, lengths = batch.offsets, batch.lengths
+        sent = sent_bytes = batches = 0
+        t0 = time.perf_counter()
+        for start in range(0, len(batch), batch_size):
+            end = min(start + batch_size, len(batch))
+            if bucket is not None:
+                bucket.consume(end - start)
+            for o, n in zip(offsets[start:end], lengths[start:end]):
+                sent_bytes += sendto(view[o:o + n], addr)
+            sent += end - start
+            batches += 1
+        elapsed = time.perf_counter() - t0
+        return {'packets': sent, 'bytes': sent_bytes, 'batches': batches, 'seconds': elapsed,
+                'pps': sent / elapsed if elapsed > 0 else float('inf')}
+
+
+# Turn a DataFrame column into payloads without iterrows() (empty rows -> "test message {i}", like the notebook) -->
+def payloads_from_column(column: Iterable) -> List[bytes]:
+    values = column.tolist() if hasattr(column, 'tolist') else list(column)
+    return [(m if isinstance(m, str) and m else f"test message {i}").encode() for i, m in enumerate(values)]
+
+
+# ========================
+# ===== Rate limiting ====
+# ========================
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, at most `burst` saved up."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = float(rate)
+        self.burst = max(1, int(burst))
+        self.tokens = float(self.burst)
+        self.last = time.perf_counter()
+
+    # Block until n tokens are available (n > burst is allowed: the bucket goes into debt and paces the next call) -->
+    def consume(self, n: int=1) -> None:
+        need = min(n, self.burst)
+        while True:
+            now = time.perf_counter()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= need:
+                self.tokens -= n
+                return
+            time.sleep((need - self.tokens) / self.rate)
+
+
+# ==================================
+# ===== Timestamp-faithful replay ==
+# ==================================
+# Replay the CSV at the recorded `timestamp` offsets (divided by `speed`) instead of a fixed sleep -->
+# The file is streamed row by row; each packet is built BEFORE waiting, then we sleep until a spin margin
+# before the deadline and busy-wait the rest on perf_counter_ns() (monotonic).
+# The margin adapts: every sleep measures how late the OS woke us (oversleep) and the margin grows to
+# 1.5x the worst recent oversleep (up to max_spin_sec), then decays back towards spin_sec while wake-ups are on time.
+# A sleep can still overrun the margin (sleeps_overran), and the spin itself can be preempted by the OS / hypervisor
+# (a 1 vCPU VM stalls a bare busy loop for up to ~4 ms). Nothing here hides that: the returned drift stats
+# (p99_ms / max_ms / over_1ms) are what actually happened, plus the margin used (spin_ms / max_spin_ms).
+def replay_csv(transport: 'RawTcpTransport', csv_path: str, speed: float=1.0, flags: int=0x18,
+               spin_sec: float=0.002, max_spin_sec: float=0.02, limit: Optional[int]=None) -> dict:
+    import csv
+    if speed <= 0:
+        raise ValueError("speed must be > 0")
+    raw_path = not transport.windows_fallback
+    drifts_ns: List[int] = []
+    start_ns = first_ts = None
+    spin_ns, min_spin_ns, cap_ns = int(spin_sec * 1e9), int(spin_sec * 1e9), int(max(spin_sec, max_spin_sec) * 1e9)
+    widest_ns = oversleep_max_ns = overran = 0
+    with open(csv_path, newline='', encoding='utf-8') as f:
+        for i, row in enumerate(csv.DictReader(f)):
+            if limit is not None and i >= limit:
+                break
+            ts = float(row['timestamp'])
+            message = row.get('message') or f"test message {i}"
+            pkt = transport.encapsulate(message.encode(), flags=flags) if raw_path else None
+            if start_ns is None:
+                start_ns, first_ts = time.perf_counter_ns(), ts
+            deadline = start_ns + int((ts - first_ts) / speed * 1e9)
+
+            # Coarse sleep (measuring how late we wake up), then spin for the last few ms:
+            now = time.perf_counter_ns()
+            if deadline - now > spin_ns:
+                wake = deadline - spin_ns
+                time.sleep((wake - now) / 1e9)
+                oversleep = max(0, time.perf_counter_ns() - wake)
+                oversleep_max_ns = max(oversleep_max_ns, oversleep)
+                overran += oversleep > spin_ns      # Woke up after the deadline: this send is late whatever we do
+                spin_ns = min(cap_ns, max(min_spin_ns, int(spin_ns * 0.98), oversleep * 3 // 2))
+                widest_ns = max(widest_ns, spin_ns)
+            while time.perf_counter_ns() < deadline:
+                pass
+
+            drifts_ns.append(time.perf_counter_ns() - deadline)
+            if raw_path:
+                transport.sock.sendto(pkt, transport.sock_addr)
+            else:
+                transport.send(message.encode(), flags=flags)
+    stats = drift_stats(drifts_ns)
+    stats.update(spin_ms=spin_ns / 1e6, max_spin_ms=max(widest_ns, min_spin_ns) / 1e6,
+                 max_oversleep_ms=oversleep_max_ns / 1e6, sleeps_overran=overran)
+    return stats
+
+# Schedule drift summary in milliseconds (positive = sent late) -->
+def drift_stats(drifts_ns: Sequence[int]) -> dict:
+    if not drifts_ns:
+        return {'messages': 0}
+    ms = sorted(d / 1e6 for d in drifts_ns)
+    pick = lambda q: ms[min(len(ms) - 1, int(q * len(ms)))]
+    return {'messages': len(ms), 'mean_ms': sum(ms) / len(ms), 'p50_ms': pick(0.50), 'p99_ms': pick(0.99),
+            'max_ms': ms[-1], 'over_1ms': sum(1 for d in ms if d > 1.0)}
+
+
+# ===========================
+# ===== Local packet sink ===
+# ===========================
+class LocalPacketSink:
+    """
+    A UDP socket on localhost that stands in for the wire: every raw packet the transport sends
+    arrives here as one datagram, so bulk sending can be checked without root or Wireshark.
+    """
+
+    def __init__(self, host: str='127.0.0.1', keep: bool=False):
+        self.rx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.rx.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1024 * 1024)
+        self.rx.bind((host, 0))
+        self.rx.settimeout(0.2)
+        self.address = self.rx.getsockname()
+        self.packets = 0
+        self.bytes = 0
+        self.received: List[bytes] = []    # Filled only when keep=True
+        self.keep = keep
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        buf = bytearray(65535)
+        while not self._stop.is_set():
+            try:
+                n = self.rx.recv_into(buf)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            self.packets += 1
+            self.bytes += n
+            if self.keep:
+                self.received.append(bytes(buf[:n]))
+
+    # Point a transport at this sink (raw path, no root needed) -->
+    def attach(self, transport: 'RawTcpTransport') -> 'RawTcpTransport':
+        transport.windows_fallback = False
+        transport.sock = self._sender()
+        transport.sock_addr = self.address
+        return transport
+
+    # A new transport that only ever sends here (never opens a raw socket, never needs Scapy) -->
+    def transport(self, src_ip: str, dst_ip: str, src_port: int, dst_port: int) -> 'RawTcpTransport':
+        transport = RawTcpTransport(src_ip, dst_ip, src_port, dst_port, sock=self._sender())
+        transport.sock_addr = self.address
+        return transport
+
+    def _sender(self) -> socket.socket:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 8 * 1024 * 1024)
+        return sock
+
+    # Wait until `expected` packets arrived (or timeout), then stop the receiver thread -->
+    def close(self, expected: Optional[int]=None, timeout: float=2.0) -> None:
+        deadline = time.perf_counter() + timeout
+        while expected is not None and self.packets < expected and time.perf_counter() < deadline:
+            time.sleep(0.01)
+        self._stop.set()
+        self._thread.join()
+        self.rx.close()
+
+
+# =====================
+# ===== Benchmark =====
+# =====================
+# Load checksum/build_ip_header/build_tcp_header exactly as they are written in the notebook -->
+def _load_notebook_functions(path: str) -> dict:
+    import json
+    with open(path, encoding='utf-8') as f:
+        cells = json.load(f)['cells']
+    ns = {'socket': socket, 'struct': struct, 'random': random, 'Optional': Optional}
+    for cell in cells:
+        src = ''.join(cell.get('source', []))
+        if cell.get('cell_type') == 'code' and ('def checksum' in src or 'def build_' in src):
+            exec(src, ns)
+    return ns
+
+def benchmark(num_packets: int=5000, payload_size: int=64, notebook_path: Optional[str]=None) -> dict:
+    import os
+    notebook_path = notebook_path or os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                  'raw_tcp_ip_notebook_fallback_annotated-v1.ipynb')
+    nb = _load_notebook_functions(notebook_path)
+    src_ip, dst_ip, sport, dport = '127.0.0.1', '127.0.0.1', 40000, 12345
+    payloads = [bytes(random.getrandbits(8) for _ in range(payload_size)) for _ in range(num_packets)]
+    transport = RawTcpTransport(src_ip, dst_ip, sport, dport,        # Never sends: any socket will do (no root)
+                                sock=socket.socket(socket.AF_INET, socket.SOCK_DGRAM))
+
+    def pps(fn) -> float:
+        t0 = time.perf_counter()
+        fn()
+        return num_packets / (time.perf_counter() - t0)
+
+    def notebook_loop():
+        for p in payloads:
+            tcp = nb['build_tcp_header'](src_ip, dst_ip, sport, dport, p, flags=0x18)
+            nb['build_ip_header'](src_ip, dst_ip, len(tcp) + len(p)) + tcp + p
+
+    batch = transport.encapsulate_batch(payloads)
+    results = {
+        'numpy': HAVE_NUMPY,
+        'notebook_pps': pps(notebook_loop),
+        'module_single_pps': pps(lambda: [transport.encapsulate(p, flags=0x18) for p in payloads]),
+        'batch_pps': pps(lambda: transport.encapsulate_batch(payloads)),
+        'incremental_seq_pps': pps(lambda: batch.set_seqs([random.randint(0, 0xFFFFFFFF)] * len(batch))),
+    }
+    # Sanity: the batch packets must carry valid checksums (re-summing a valid header gives 0)
+    sample = bytes(batch.packet(0))
+    pseudo = struct.pack('!4s4sBBH', socket.inet_aton(src_ip), socket.inet_aton(dst_ip), 0, socket.IPPROTO_TCP,
+                         len(sample) - IP_HEADER_LEN)
+    single = transport.encapsulate(payloads[0], flags=0x18)
+    results['checksums_ok'] = all(nb['checksum'](pkt[:IP_HEADER_LEN]) == 0
+                                  and nb['checksum'](pseudo + pkt[IP_HEADER_LEN:]) == 0 for pkt in (sample, single))
+    transport.sock.close()
+    return results
+
+# Replay the CSV messages into a LocalPacketSink: per-row send() (notebook loop, minus the 0.1 s sleep) vs send_bulk() -->
+def benchmark_send(csv_path: Optional[str]=None, repeat: int=50, rate_pps: Optional[float]=None) -> dict:
+    import csv, os
+    csv_path = csv_path or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'group02_http_input.csv')
+    with open(csv_path, newline='', encoding='utf-8') as f:
+        payloads = payloads_from_column([row['message'] for row in csv.DictReader(f)] * repeat)
+
+    sink = LocalPacketSink()
+    per_row = sink.transport('127.0.0.1', '127.0.0.1', 40000, 12345)
+    t0 = time.perf_counter()
+    for p in payloads:
+        per_row.send(p, flags=0x18)
+    per_row_pps = len(payloads) / (time.perf_counter() - t0)
+    sink.close(expected=len(payloads))
+    per_row_received = sink.packets
+
+    sink = LocalPacketSink()
+    stats = sink.transport('127.0.0.1', '127.0.0.1', 40000, 12345).send_bulk(payloads, rate_pps=rate_pps)
+    sink.close(expected=len(payloads))
+    return {'packets': len(payloads), 'notebook_sleep_pps': 10.0, 'per_row_pps': per_row_pps,
+            'per_row_received': per_row_received, 'bulk_pps': stats['pps'], 'bulk_received': sink.packets}
+
+
+if __name__ == '__main__':
+    import sys
+    if sys.argv[1:2] == ['replay']:     # python rawtcp.py replay [speed]
+        import os
+        sink = LocalPacketSink()
+        results = replay_csv(sink.transport('127.0.0.1', '127.0.0.1', 40000, 12345),
+                             os.path.join(os.path.dirname(os.path.abspath(__file__)), 'group02_http_input.csv'),
+                             speed=float(sys.argv[2]) if len(sys.argv) > 2 else 1.0)
+        sink.close(expected=results['messages'])
+    else:
+        results = benchmark_send() if sys.argv[1:2] == ['send'] else benchmark()
+    for key, value in results.items():
+        if isinstance(value, float):
+            print(f"{key:>22}: {value:,.3f}" if key.endswith('_ms') else f"{key:>22}: {value:,.0f}")
+        else:
+            print(f"{key:>22}: {value}")
@@ -0,0 +1,104 @@
+"""Tests for rawtcp.py: everything is sent into a LocalPacketSink (no root, no Scapy, no Wireshark)"""
+
+import csv, os, socket, struct, time
+import rawtcp
+from rawtcp import LocalPacketSink, checksum, payloads_from_column, IP_HEADER_LEN, HEADERS_LEN, TCP_SEQ_OFFSET
+
+CSV_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'group02_http_input.csv')
+SRC, DST, SPORT, DPORT = '10.0.0.1', '10.0.0.2', 40000, 12345
+
+
+# The notebook's messages (a few times over) + odd lengths, so the checksum padding is exercised too -->
+def _payloads(repeat: int=5) -> list:
+    with open(CSV_PATH, newline='', encoding='utf-8') as f:
+        messages = [row['message'] for row in csv.DictReader(f)]
+    return payloads_from_column(messages * repeat + ['a', 'abc', '', 'x' * 1001])
+
+# Send with the given call, return what the sink captured -->
+def _capture(send, expected: int) -> list:
+    sink = LocalPacketSink(keep=True)
+    send(sink.transport(SRC, DST, SPORT, DPORT))
+    sink.close(expected=expected, timeout=5.0)
+    return sink.received
+
+# A checksum over data that contains its own (correct) checksum comes out as 0 -->
+def _assert_checksums(pkt: bytes) -> None:
+    ip_header, segment = pkt[:IP_HEADER_LEN], pkt[IP_HEADER_LEN:]
+    assert checksum(ip_header) == 0
+    assert struct.unpack('!H', ip_header[2:4])[0] == len(pkt)     # IP total length
+    pseudo = socket.inet_aton(SRC) + socket.inet_aton(DST) + struct.pack('!BBH', 0, socket.IPPROTO_TCP, len(segment))
+    assert checksum(pseudo + segment) == 0
+    assert ip_header[12:16] == socket.inet_aton(SRC) and ip_header[16:20] == socket.inet_aton(DST)
+    assert struct.unpack('!HH', segment[:4]) == (SPORT, DPORT)
+
+
+# ======================
+# ===== Bulk sending ===
+# ======================
+def test_send_bulk_delivers_every_packet_in_order():
+    payloads = _payloads()
+    stats = {}
+    received = _capture(lambda t: stats.update(t.send_bulk(payloads, batch_size=64)), len(payloads))
+
+    assert stats['packets'] == len(payloads)
+    assert stats['bytes'] == sum(HEADERS_LEN + len(p) for p in payloads)
+    assert len(received) == len(payloads)
+    assert [pkt[HEADERS_LEN:] for pkt in received] == payloads
+
+def test_send_bulk_checksums_and_seq_numbers():
+    payloads = _payloads(repeat=1)
+    received = _capture(lambda t: t.send_bulk(payloads, flags=0x18), len(payloads))
+
+    assert len(received) == len(payloads)
+    seqs = [struct.unpack_from('!L', pkt, TCP_SEQ_OFFSET)[0] for pkt in received]
+    for pkt, payload, seq, next_seq in zip(received, payloads, seqs, seqs[1:] + [None]):
+        _assert_checksums(pkt)
+        assert pkt[IP_HEADER_LEN + 13] == 0x18        # TCP flags
+        if next_seq is not None:                       # One stream: seq moves on by each payload's length
+            assert next_seq == (seq + len(payload)) & 0xFFFFFFFF
+
+
+# ========================
+# ===== Single packets ===
+# ========================
+def test_send_matches_the_notebook_headers():
+    payloads = _payloads(repeat=1)
+
+    def send_all(transport):
+        for p in payloads:
+            transport.send(p, flags=0x02)
+    received = _capture(send_all, len(payloads))
+
+    assert [pkt[HEADERS_LEN:] for pkt in received] == payloads
+    for pkt, payload in zip(received, payloads):
+        _assert_checksums(pkt)
+        ident = struct.unpack_from('!H', pkt, 4)[0]
+        seq = struct.unpack_from('!L', pkt, TCP_SEQ_OFFSET)[0]
+        tcp = rawtcp.build_tcp_header(SRC, DST, SPORT, DPORT, payload, seq=seq, flags=0x02)
+        ip = rawtcp.build_ip_header(SRC, DST, len(tcp) + len(payload), identification=ident)
+        assert pkt == ip + tcp + payload
+
+
+# =====================
+# ===== Rate limiting ==
+# =====================
+def test_token_bucket_paces_send_bulk():
+    payloads = _payloads(repeat=1) * 10
+    rate, batch = 2000.0, 50
+    stats = {}
+    received = _capture(lambda t: stats.update(t.send_bulk(payloads, batch_size=batch, rate_pps=rate)), len(payloads))
+
+    assert len(received) == len(payloads)
+    # The first batch is the bucket's burst, every later one waits for its tokens -->
+    ideal = (len(payloads) - batch) / rate
+    assert ideal * 0.95 <= stats['seconds'] <= ideal * 1.3
+    assert rate * 0.75 <= stats['pps'] <= rate * 1.15
+
+def test_token_bucket_allows_the_burst_then_the_rate():
+    bucket = rawtcp.TokenBucket(rate=1000.0, burst=100)
+    t0 = time.perf_counter()
+    bucket.consume(100)                 # Saved up: no wait
+    assert time.perf_counter() - t0 < 0.01
+    for _ in range(10):
+        bucket.consume(20)              # 200 tokens at 1000/s -> ~0.2 s
+    assert 0.18 <= time.perf_counter() - t0 <= 0.3
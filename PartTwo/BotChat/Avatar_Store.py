@@ -0,0 +1,72 @@
+"""Content-addressed avatars: every avatar URL (or data URL) is stored once and referred to by its hash"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Callable, Iterable, Optional
+
+from Common_Setups import AVATAR_STORE_MAX, AVATAR_MAX_BYTES
+
+HASH_CHARS = 16     # 64 bits of sha256: plenty for the avatars of one chat server
+
+
+# The id of an avatar: same URL -> same hash, on every server and client -->
+def avatar_hash(url: str) -> str:
+    return hashlib.sha256(url.encode("utf-8")).hexdigest()[:HASH_CHARS]
+
+
+def looks_like_hash(text: str) -> bool:
+    return len(text) == HASH_CHARS and all(c in "0123456789abcdef" for c in text)
+
+
+class AvatarStore:
+    """Server side table hash -> URL, oldest first.
+
+    Once it holds more than `max_items`, the oldest avatars nobody uses anymore are dropped
+    (`in_use` returns the hashes that users still point to).
+    """
+
+    def __init__(self, in_use: Callable[[], Iterable[str]], max_items: int = AVATAR_STORE_MAX,
+                 max_bytes: int = AVATAR_MAX_BYTES):
+        self.blobs: "OrderedDict[str, str]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.in_use = in_use
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+
+    # Store a URL (no-op if it is already there). Returns its hash, or None if it is too large -->
+    def put(self, url: str) -> Optional[str]:
+        if len(url.encode("utf-8")) > self.max_bytes:
+            return None
+        h = avatar_hash(url)
+        with self.lock:
+            if h in self.blobs:
+                self.blobs.move_to_end(h)
+                return h
+            self.blobs[h] = url
+            over = len(self.blobs) - self.max_items
+        if over > 0:
+            self._evict(over, keep=h)
+        return h
+
+    def get(self, h: str) -> Optional[str]:
+        with self.lock:
+            return self.blobs.get(h)
+
+    def _evict(self, count: int, keep: str) -> None:
+        used = set(self.in_use())   # Outside our lock: in_use() takes the server's lock
+        used.add(keep)
+        with self.lock:
+            for h in [h for h in self.blobs if h not in used][:count]:
+                del self.blobs[h]
+
+    # Hot restart: the avatars that are still used go to the successor -->
+    def export(self, hashes: Iterable[str]) -> dict:
+        with self.lock:
+            return {h: self.blobs[h] for h in hashes if h in self.blobs}
+
+    def load(self, blobs: dict) -> None:
+        with self.lock:
+            for h, url in blobs.items():
+                if avatar_hash(url) == h:
+                    self.blobs[h] = url
@@ -0,0 +1,28 @@
+"""Exponential backoff with jitter (used by every client that reconnects to the server)"""
+
+import random
+
+
+class ExponentialBackoff:
+    """Delays grow base, base*factor, base*factor^2 ... up to `cap` seconds.
+
+    "Full jitter": each delay is a random value in [0, current step], so many clients
+    that lost the server at the same moment don't all come back at the same moment.
+    """
+    __slots__ = ("base", "cap", "factor", "attempts")
+
+    def __init__(self, base: float, cap: float, factor: float = 2.0):
+        self.base = float(base)
+        self.cap = float(cap)
+        self.factor = float(factor)
+        self.attempts = 0
+
+    # The delay (seconds) to wait before the next attempt -->
+    def next_delay(self) -> float:
+        step = self.cap if self.attempts >= 32 else min(self.cap, self.base * (self.factor ** self.attempts))
+        self.attempts += 1
+        return random.uniform(self.base / 2 if self.attempts == 1 else 0.0, step)
+
+    # Call after a successful connection (next failure starts from `base` again) -->
+    def reset(self) -> None:
+        self.attempts = 0
@@ -0,0 +1,984 @@
+"""Micro-benchmarks for the server side (run: python Benchmarks.py <name>)"""
+
+import json
+import os
+import selectors
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from typing import Callable, Dict, List, Tuple
+
+
+# Time `fn` over `n` calls and return nanoseconds per call -->
+def ns_per_call(fn: Callable[[], object], n: int) -> float:
+    t0 = time.perf_counter_ns()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter_ns() - t0) / n
+
+
+# ==============================
+# ===== Rate limiter cost  =====
+# ==============================
+def bench_rate_limiter(n: int = 200_000) -> Dict[str, float]:
+    import Rate_Limiter
+    from Rate_Limiter import ConnectionLimiter, ACTION_DROP
+
+    # Loop overhead only (what the handler paid before the limiter existed):
+    empty = ns_per_call(lambda: None, n)
+
+    # Allowed path: huge rates so every check passes:
+    Rate_Limiter._global_msgs.rate = Rate_Limiter._global_bytes.rate = 0    # Unlimited global buckets
+    fast = ConnectionLimiter(msgs_per_sec=1e12, bytes_per_sec=1e15, action=ACTION_DROP)
+    allowed = ns_per_call(lambda: fast.check(64), n)
+
+    # Limited path: 1 msg/sec so (almost) every check is rejected:
+    slow = ConnectionLimiter(msgs_per_sec=1, bytes_per_sec=1e15, action=ACTION_DROP)
+    rejected = ns_per_call(lambda: slow.check(64), n)
+
+    return {"loop_ns": empty, "allowed_ns": allowed - empty, "rejected_ns": rejected - empty,
+            "rejected_count": slow.counters["dropped"]}
+
+
+# ===================================
+# ===== Shared server test helpers ==
+# ===================================
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# A port nobody listens on right now -->
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+# Run Main_Server.py as a subprocess and wait until it accepts connections.
+# Heartbeats are off unless `extra` turns them on: raw bench clients never answer a PING -->
+def start_server(port: int, *extra: str, capture: bool = False) -> subprocess.Popen:
+    proc = subprocess.Popen([sys.executable, os.path.join(HERE, "Main_Server.py"), "--port", str(port),
+                             "--heartbeat-sec", "0", *extra],
+                            stdout=subprocess.PIPE if capture else subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                            text=capture)
+    for _ in range(200):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return proc
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError("Server did not start")
+
+# Open n raw client connections (pseudo-users "__bench..." keep the USERS lines short) -->
+def connect_clients(port: int, n: int, prefix: str = "__bench") -> List[socket.socket]:
+    clients = []
+    for i in range(n):
+        s = socket.create_connection(("127.0.0.1", port))
+        s.sendall(f"{prefix}{i}\n".encode())
+        s.setblocking(False)
+        clients.append(s)
+    return clients
+
+# Read from all clients until `done(sock, line)` returned True for each of them (or timeout) -->
+def read_until(clients: List[socket.socket], done: Callable[[socket.socket, str], bool], timeout: float) -> Dict:
+    sel = selectors.DefaultSelector()
+    buffers = {}
+    for s in clients:
+        sel.register(s, selectors.EVENT_READ)
+        buffers[s] = b""
+    finished = {}
+    deadline = time.monotonic() + timeout
+    while len(finished) < len(clients) and time.monotonic() < deadline:
+        for key, _ in sel.select(timeout=0.1):
+            s = key.fileobj
+            try:
+                data = s.recv(65536)
+            except (BlockingIOError, ConnectionError):
+                continue
+            if not data:
+                finished.setdefault(s, time.monotonic())
+                sel.unregister(s)
+                continue
+            buffers[s] += data
+            *lines, buffers[s] = buffers[s].split(b"\n")
+            for line in lines:
+                if s not in finished and done(s, line.decode("utf-8", "replace")):
+                    finished[s] = time.monotonic()
+    sel.close()
+    return finished
+
+
+# ==============================
+# ===== Drain / hot restart ====
+# ==============================
+# Connect n clients, send SIGTERM (drain) or SIGHUP (hot restart) and time each phase -->
+def bench_drain(clients: int = 5000, handoff: bool = False) -> Dict[str, float]:
+    port = free_port()
+    proc = start_server(port)
+    try:
+        socks = connect_clients(port, clients)
+        # Wait until the server registered everyone (each client sees its own join message):
+        last_join = f"__bench{clients - 1} -> has joined the chat"
+        joined = read_until(socks, lambda s, line: line.endswith(last_join), timeout=300.0)
+
+        t0 = time.monotonic()
+        proc.send_signal(signal.SIGHUP if handoff else signal.SIGTERM)
+        hinted = read_until(socks, lambda s, line: line.startswith("RECONNECT|"), timeout=60.0)
+        t_hint = max(hinted.values(), default=t0)
+        for s in socks:  # A well-behaved client closes right after the hint
+            s.close()
+        proc.wait(timeout=60.0)
+        t_done = time.monotonic()
+
+        result = {"clients": float(clients), "joined": float(len(joined)), "hinted": float(len(hinted)),
+                  "all_hinted_ms": (t_hint - t0) * 1000, "drain_total_ms": (t_done - t0) * 1000}
+        if handoff:  # The successor must already be accepting on the same port
+            t1 = time.monotonic()
+            socket.create_connection(("127.0.0.1", port), timeout=2.0).close()
+            result["successor_accept_ms"] = (time.monotonic() - t1) * 1000
+        return result
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+        if handoff:  # The successor runs in its own session with the same command line
+            subprocess.run(["pkill", "-f", f"Main_Server.py --port {port}"], check=False)
+
+
+# ==================================
+# ===== Outbound micro-batching ====
+# ==================================
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+# A busy room: `senders` users each send `per_sender` messages in quick rounds to ALL; `receivers` listen -->
+# Measures send syscalls per delivered line (server counters) and send -> receive latency.
+def bench_batching_window(batch_ms: float, receivers: int = 50, senders: int = 20, per_sender: int = 30,
+                          round_gap_ms: float = 1.0, extra: tuple = ()) -> Dict[str, float]:
+    port = free_port()
+    proc = start_server(port, "--batch-ms", str(batch_ms), *extra, capture=True)
+    try:
+        listeners = connect_clients(port, receivers, prefix="__rx")
+        talkers = connect_clients(port, senders, prefix="__tx")
+        time.sleep(0.5)  # Let the join traffic settle
+        for s in listeners + talkers:  # Drop join/USERS lines
+            try:
+                while s.recv(1 << 20):
+                    pass
+            except BlockingIOError:
+                pass
+
+        expected = senders * per_sender
+        latencies = []
+        counts = {s: 0 for s in listeners}
+        start_ns = {}
+
+        def on_line(s, line):
+            if line.startswith("MSG|__tx"):
+                latencies.append((time.perf_counter_ns() - start_ns[line.split("|")[3]]) / 1e6)
+                counts[s] += 1
+            return counts[s] >= expected
+
+        def talk():
+            for r in range(per_sender):
+                for i, s in enumerate(talkers):
+                    msg_id = f"b{r}-{i}"
+                    start_ns[msg_id] = time.perf_counter_ns()
+                    s.send(f"ALL:{msg_id}:{'x' * 40}\n".encode())  # A few bytes: fits the (non-blocking) socket
+                time.sleep(round_gap_ms / 1000)
+        talker = threading.Thread(target=talk)
+        t0 = time.perf_counter()
+        talker.start()
+        done = read_until(listeners, on_line, timeout=60.0)
+        took = time.perf_counter() - t0
+        talker.join()
+
+        proc.send_signal(signal.SIGTERM)
+        for s in listeners + talkers:
+            s.close()
+        out, _ = proc.communicate(timeout=30.0)
+        stats = json.loads(next(l for l in out.splitlines() if l.startswith("OUTBOX_STATS "))[13:])
+        delivered = sum(counts.values())
+        return {"delivered": float(delivered), "complete_receivers": float(len(done)), "lines_per_s": delivered / took,
+                "syscalls_per_msg": stats["syscalls"] / max(1, stats["frames"]),
+                "p50_ms": percentile(latencies, 50), "p99_ms": percentile(latencies, 99)}
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+
+# Same load with batching off and with a few windows -->
+def bench_batching(windows=(0.0, 0.5, 2.0, 5.0)) -> Dict[str, float]:
+    result = {}
+    for ms in windows:
+        r = bench_batching_window(ms)
+        tag = "off" if ms == 0 else f"{ms:g}ms"
+        result[f"{tag} delivered"] = r["delivered"]
+        result[f"{tag} syscalls/msg"] = r["syscalls_per_msg"]
+        result[f"{tag} p50_ms"] = r["p50_ms"]
+        result[f"{tag} p99_ms"] = r["p99_ms"]
+    return result
+
+
+# =========================
+# ===== Compression  ======
+# =========================
+# Protocol lines of different shapes (what a busy server really sends) -->
+def sample_lines(n: int, seed: int = 7) -> Dict[str, List[str]]:
+    import base64
+    import random
+    rng = random.Random(seed)
+    words = ("hi hello ok yes no thanks lol see you later where are we meeting today tomorrow the build is "
+             "green red failing again check the logs please server client message chat window avatar").split()
+    source = open(os.path.join(HERE, "Chat_UI.py"), encoding="utf-8").read().replace("\r", "").replace("\n", " ")
+
+    def msg(i: int, text: str) -> str:
+        return f"MSG|user{i % 50}|ALL|{1792365739000 + i}-{i:06x}|{i}|{text}"
+
+    def paste(i: int) -> str:
+        size = rng.randint(2_000, 20_000)
+        start = rng.randint(0, len(source) - size)
+        return msg(i, source[start:start + size])
+
+    return {
+        "chat_small": [msg(i, " ".join(rng.choices(words, k=rng.randint(2, 40)))) for i in range(n)],
+        "chat_paste": [paste(i) for i in range(n // 20)],
+        "avatar_dicebear": [f"AVATAR|user{i}|https://api.dicebear.com/7.x/adventurer/svg?seed=user{i}"
+                            f"&backgroundColor=b6e3f4" for i in range(n)],
+        "avatar_data_url": ["AVATAR|user%d|data:image/png;base64,%s" % (i, base64.b64encode(rng.randbytes(4096)).decode())
+                            for i in range(n // 20)],
+        "history_replay": ["\n".join(msg(i * 50 + j, " ".join(rng.choices(words, k=rng.randint(2, 40))))
+                                     for j in range(50)) for i in range(n // 50)],
+        "roster_1000": ["USERS|System|ALL|" + ",".join(f"User{rng.randint(1000, 9999)}" for _ in range(1000))
+                        for _ in range(n // 50)],
+    }
+
+# Bytes on the wire and CPU per line, with and without compression -->
+def bench_compression(n: int = 2000) -> Dict[str, float]:
+    import Compression
+    encode = Compression.encode_line.__wrapped__    # Skip the broadcast cache: measure the real work
+    result = {}
+    for name, lines in sample_lines(n).items():
+        raw = sum(len(line.encode("utf-8")) + 1 for line in lines)
+        t0 = time.perf_counter_ns()
+        wire_lines = [encode(line) for line in lines]
+        t1 = time.perf_counter_ns()
+        packed = [w for w in wire_lines if w.startswith(Compression.PREFIX)]
+        for w in packed:
+            Compression.decode_line(w)
+        t2 = time.perf_counter_ns()
+        wire = sum(len(w.encode("utf-8")) + 1 for w in wire_lines)
+        result[f"{name} raw_kb"] = raw / 1024
+        result[f"{name} wire/raw"] = wire / raw
+        result[f"{name} compressed%"] = 100.0 * len(packed) / len(lines)
+        result[f"{name} encode_us"] = (t1 - t0) / len(lines) / 1000
+        result[f"{name} decode_us"] = (t2 - t1) / len(packed) / 1000 if packed else 0.0
+    return result
+
+
+# ================================
+# ===== Client state warm start ==
+# ================================
+# Fill a state DB with n messages, then time a fresh process until the first window's messages are ready -->
+def bench_client_state(n: int = 1_000_000, appends: int = 50_000) -> Dict[str, float]:
+    import tempfile
+    from State_Store import StateStore, PersistentList, UPSERT_MESSAGE
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "state.db")
+        store = StateStore(path)
+        t0 = time.perf_counter()
+        chunk = 50_000
+        for start in range(0, n, chunk):
+            rows = [(f"{i}-{i:06x}", f"user{i % 100}", f"message number {i}", "12:00", "ALL" if i % 10 else "user1")
+                    for i in range(start, min(n, start + chunk))]
+            store.db.executemany(UPSERT_MESSAGE, rows)
+            store.db.commit()
+        fill_s = time.perf_counter() - t0
+
+        # What a new Run_App.py does before it can render: import the state + pick this user's messages
+        probe = ("import time; t0 = time.perf_counter(); import State_Globals as S; "
+                 "own = 'user1'; mine = [m for m in S.messages if m[4] in ('ALL', own) or m[1] == own]; "
+                 "print((time.perf_counter() - t0) * 1000, len(S.messages))")
+        env = dict(os.environ, BOTCHAT_CLIENT_DB=path)
+        starts = []
+        for _ in range(3):
+            out = subprocess.run([sys.executable, "-c", probe], cwd=HERE, env=env, capture_output=True,
+                                 text=True, check=True).stdout.split()
+            starts.append(float(out[0]))
+
+        # UI side cost of a persisted append (the commit happens on the writer thread) -->
+        messages = PersistentList(store)
+        t1 = time.perf_counter_ns()
+        for i in range(appends):
+            messages.append((f"new-{i}", "user2", "hello", "12:01", "ALL"))
+        t2 = time.perf_counter_ns()
+        store.flush(timeout=120.0)
+        t3 = time.perf_counter_ns()
+
+        return {"stored_messages": float(n), "fill_s": fill_s, "db_mb": os.path.getsize(path) / 2**20,
+                "loaded_at_start": float(out[1]), "first_window_ms": min(starts),
+                "append_us": (t2 - t1) / appends / 1000,
+                "commit_msgs_per_s": appends / ((t3 - t1) / 1e9),
+                "batches": float(store.stats["batches"])}
+
+
+# ===================================
+# ===== UI startup (Run_App)    =====
+# ===================================
+# `python -X importtime` of a module: (total ms, {module it imports directly: cumulative ms}) -->
+def import_profile(module: str, *preload: str) -> tuple:
+    code = "; ".join([f"import {m}" for m in preload] + ["import sys", "sys.stderr.write('@@\\n')", f"import {module}"])
+    err = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=HERE, capture_output=True,
+                         text=True, check=True).stderr
+    err = err[err.index("@@\n") + 3:]     # Only what `module` itself added
+    total, children = 0.0, {}
+    for line in err.splitlines():
+        if not line.startswith("import time:") or line.count("|") != 2:
+            continue
+        _self, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        depth = (len(name) - len(name.lstrip()) - 1) // 2     # importtime indents 2 spaces per nesting level
+        if depth == 0:
+            total += int(cumulative) / 1000
+        elif depth == 1:
+            children[name.strip()] = int(cumulative) / 1000
+    return total, children
+
+
+def bench_startup(runs: int = 3, top_n: int = 6) -> Dict[str, float]:
+    result: Dict[str, float] = {}
+
+    # Import-time profile of the routes module (what Run_App pays before the server can start) -->
+    total, top = import_profile("UI_Router")
+    result["import_ui_router_ms"] = total
+    for name, ms in sorted(top.items(), key=lambda kv: -kv[1])[:top_n]:
+        result[f"import_{name}_ms"] = ms
+    # Paid later, on the first mode=chat request (or by the background prewarm):
+    result["import_chat_ui_lazy_ms"] = import_profile("Chat_UI", "UI_Router")[0]
+
+    # Time to first window: process start -> launcher page served (the window opens on the same signal) -->
+    firsts = []
+    for _ in range(runs):
+        port = free_port()
+        code = f"import Run_App; Run_App.run_chat_app(port={port}, open_window=False)"
+        t0 = time.perf_counter()
+        proc = subprocess.Popen([sys.executable, "-c", code], cwd=HERE, stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL)
+        try:
+            while time.perf_counter() - t0 < 30:
+                try:
+                    with socket.create_connection(("127.0.0.1", port), timeout=1.0) as s:
+                        s.sendall(b"GET / HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n")
+                        if s.recv(64).startswith(b"HTTP/1.1 200"):
+                            firsts.append(time.perf_counter() - t0)
+                            break
+                except OSError:
+                    time.sleep(0.02)
+        finally:
+            proc.terminate()
+            proc.wait(timeout=10)
+    result["first_window_s"] = min(firsts) if firsts else float("nan")
+    return result
+
+
+# ==========================================
+# ===== Rooms: subscribers vs everyone =====
+# ==========================================
+# Stands in for a client socket: counts what the server writes to it -->
+class CountingSink:
+    __slots__ = ("lines", "nbytes")
+
+    def __init__(self):
+        self.lines = 0
+        self.nbytes = 0
+
+    def sendall(self, data: bytes) -> None:
+        self.lines += 1
+        self.nbytes += len(data)
+
+
+# The server's own routing code (publish + fan-out) with `users` connections spread over `n_rooms` rooms -->
+def bench_rooms(users: int = 10_000, n_rooms: int = 100, global_msgs: int = 200, room_msgs: int = 5_000) -> Dict[str, float]:
+    import Main_Server as server
+
+    sinks = [CountingSink() for _ in range(users)]
+    names = [f"__bench{i}" for i in range(users)]
+    with server.online_users_lock:
+        server.online_users.update(zip(names, sinks))
+    for i, (name, sink) in enumerate(zip(names, sinks)):
+        server.join_room(server.open_session(name, sink), sink, f"#room{i % n_rooms}")
+
+    def run(count: int, target_of: Callable[[int], str], deliver: Callable[[str, str], None]) -> tuple:
+        before = sum(s.lines for s in sinks)
+        t0 = time.perf_counter_ns()
+        for m in range(count):
+            target = target_of(m)
+            line, _ = server.publish(names[m % users], target, f"b{m}-{target}", "hello everybody in here")
+            deliver(target, line)
+        took = time.perf_counter_ns() - t0
+        return took / count / 1000, (sum(s.lines for s in sinks) - before) / count
+
+    all_us, all_fanout = run(global_msgs, lambda m: "ALL", lambda _t, line: server.broadcast(line))
+    room_us, room_fanout = run(room_msgs, lambda m: f"#room{m % n_rooms}", server.send_to_room)
+    return {"users": float(users), "rooms": float(n_rooms),
+            "global_us_per_msg": all_us, "global_deliveries_per_msg": all_fanout,
+            "room_us_per_msg": room_us, "room_deliveries_per_msg": room_fanout,
+            "global_ns_per_delivery": all_us * 1000 / all_fanout, "room_ns_per_delivery": room_us * 1000 / room_fanout,
+            "speedup_per_msg": all_us / room_us}
+
+
+# ======================
+# ===== Federation =====
+# ======================
+# Blocking line reader for one raw client (waits for one specific line) -->
+class LineClient:
+    def __init__(self, port: int, name: str):
+        self.sock = socket.create_connection(("127.0.0.1", port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.sendall(f"{name}\n".encode())
+        self.sock.settimeout(5.0)
+        self.buffer = b""
+
+    def send(self, line: str) -> None:
+        self.sock.sendall(f"{line}\n".encode())
+
+    def wait_for(self, needle: str) -> str:
+        while True:
+            while b"\n" in self.buffer:
+                line, self.buffer = self.buffer.split(b"\n", 1)
+                text = line.decode("utf-8", "replace")
+                if needle in text:
+                    return text
+            data = self.sock.recv(65536)
+            if not data:
+                raise ConnectionError("closed")
+            self.buffer += data
+
+
+# `nodes` servers on localhost linked to each other; senders on node 0, one receiver per node -->
+# Measures send -> receive latency on the same node vs. another node (ALL and private), and how many
+# peer-link lines one ALL message costs while `idle_users` more users sit on every node.
+def bench_federation(nodes: int = 3, msgs: int = 300, idle_users: int = 50) -> Dict[str, float]:
+    from Federation import PEER_SECRET_ENV
+    os.environ.setdefault(PEER_SECRET_ENV, os.urandom(16).hex())   # The nodes inherit it
+    ports = [free_port() for _ in range(nodes)]
+    ids = [f"127.0.0.1:{p}" for p in ports]
+    procs = [start_server(port, "--node-id", node, "--peers", ",".join(ids), capture=True)
+             for port, node in zip(ports, ids)]
+    try:
+        receivers = [LineClient(port, f"fed_rx{i}") for i, port in enumerate(ports)]
+        idle = [s for port in ports for s in connect_clients(port, idle_users, prefix=f"__idle{port}_")]
+        # Several senders: each stays under the per-connection rate limit (RATE_LIMIT_CONN_MSGS_PER_SEC)
+        senders = [LineClient(ports[0], f"fed_tx{i}") for i in range(2 * msgs // 30 + 1)]
+        for rx in receivers[1:]:  # Links are up and the roster went around once the far nodes know the senders
+            rx.wait_for(f"fed_tx{len(senders) - 1}")
+        time.sleep(0.2)
+
+        local, remote, private = [], [], []
+        for m in range(msgs):
+            t0 = time.perf_counter_ns()
+            senders[m % len(senders)].send(f"ALL:a{m}:{'x' * 40}")
+            receivers[0].wait_for(f"|a{m}|")
+            local.append((time.perf_counter_ns() - t0) / 1e6)
+            for rx in receivers[1:]:
+                rx.wait_for(f"|a{m}|")
+            remote.append((time.perf_counter_ns() - t0) / 1e6)     # Until the last node delivered it
+        for m in range(msgs):
+            t0 = time.perf_counter_ns()
+            senders[m % len(senders)].send(f"fed_rx{nodes - 1}:d{m}:{'x' * 40}")
+            receivers[-1].wait_for(f"|d{m}|")
+            private.append((time.perf_counter_ns() - t0) / 1e6)
+        taken = LineClient(ports[-1], "fed_tx0").wait_for("|")  # The name lives on node 0
+
+        for proc in procs:
+            proc.send_signal(signal.SIGTERM)
+        for s in idle + [c.sock for c in senders + receivers]:
+            s.close()
+        stats = [json.loads(next(l for l in proc.communicate(timeout=30.0)[0].splitlines()
+                                 if l.startswith("FEDERATION_STATS "))[17:]) for proc in procs]
+        return {"nodes": float(nodes), "users_per_node": float(idle_users + 1),
+                "same_node_p50_ms": percentile(local, 50), "same_node_p99_ms": percentile(local, 99),
+                "cross_node_p50_ms": percentile(remote, 50), "cross_node_p99_ms": percentile(remote, 99),
+                "dm_cross_node_p50_ms": percentile(private, 50), "dm_cross_node_p99_ms": percentile(private, 99),
+                # ALL: one line per other node (not per user); private: one line, to the target's node only
+                "peer_lines_per_all_msg": stats[0]["to_all"] / msgs, "peer_lines_per_dm": stats[0]["to_one"] / msgs,
+                "name_taken_cluster_wide": float(taken.endswith("NAME_TAKEN"))}
+    finally:
+        for proc in procs:
+            if proc.poll() is None:
+                proc.kill()
+
+
+# ==================
+# ===== Search =====
+# ==================
+# `n` chat messages (Zipf-like words, ALL / rooms / private), indexed once; then query latency per kind -->
+def bench_search(n: int = 1_000_000, runs: int = 200, words: int = 8) -> Dict[str, float]:
+    import itertools
+    import random
+    from Search_Index import SearchIndex
+
+    rng = random.Random(11)
+    vocab = [f"w{i}" for i in range(20_000)]
+    cumulative = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(vocab))))
+    users = [f"user{i}" for i in range(50)]
+    texts = [" ".join(rng.choices(vocab, cum_weights=cumulative, k=words)) for _ in range(n)]
+
+    index = SearchIndex()
+    t0 = time.perf_counter()
+    for start in range(0, n, 5000):
+        chunk = []
+        for i in range(start, min(n, start + 5000)):
+            roll = i % 10
+            target = "ALL" if roll < 7 else ("#room%d" % (i % 5) if roll < 8 else users[(i * 7) % len(users)])
+            chunk.append((f"m{i}", users[i % len(users)], target, texts[i]))
+        index.add_many(chunk)
+    build_s = time.perf_counter() - t0
+
+    def timed(query: str) -> List[float]:
+        took = []
+        for r in range(runs):
+            t = time.perf_counter()
+            index.search(query, users[r % len(users)], ("#room1",))
+            took.append((time.perf_counter() - t) * 1000)
+        return took
+
+    result = {"messages": float(n), "index_build_s": build_s, "distinct_words": float(len(index.postings))}
+    for name, query in (("common", "w0"), ("medium", "w300"), ("rare", "w19999"),
+                        ("two_common", "w0 w1"), ("common_rare", "w0 w19999"), ("two_medium", "w300 w301")):
+        took = timed(query)
+        result[f"{name}_p50_ms"] = percentile(took, 50)
+        result[f"{name}_p99_ms"] = percentile(took, 99)
+
+    t0 = time.perf_counter()    # What the index replaces: one pass over every message
+    [t for t in texts if "w19999" in t.split()]
+    result["linear_scan_ms"] = (time.perf_counter() - t0) * 1000
+    return result
+
+
+# =====================
+# ===== Mailboxes =====
+# =====================
+# Part 1, in process: `n` private messages queued for `recipients` offline users -> append rate, and how much the
+# server's memory grows with them (it should not: the messages are on disk). Then the time to empty one mailbox.
+# Part 2, end to end: `queued` messages for one offline name, then time from connecting until all arrived.
+def bench_mailbox(n: int = 1_000_000, recipients: int = 10_000, queued: int = 500) -> Dict[str, float]:
+    import tempfile
+    from Mailbox import MailboxStore, DIR_ENV
+
+    def rss_mb() -> float:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+    result = {}
+    with tempfile.TemporaryDirectory() as directory:
+        store = MailboxStore(directory, max_per_user=n)
+        text = "x" * 60
+        for i in range(recipients):     # Every mailbox exists once: what is left to grow is the messages
+            store.put(f"user{i}", "bench", "warm", text)
+        rss0 = rss_mb()
+        t0 = time.perf_counter()
+        for i in range(n):
+            store.put(f"user{i % recipients}", "bench", f"m{i}", text)
+        took = time.perf_counter() - t0
+        rss1 = rss_mb()
+        t0 = time.perf_counter()
+        got = store.take("user0")
+        result.update({"messages": float(n), "recipients": float(recipients), "put_per_s": n / took,
+                       "rss_growth_mb": rss1 - rss0, "bytes_ram_per_msg": (rss1 - rss0) * 2**20 / n,
+                       "take_ms": (time.perf_counter() - t0) * 1000, "take_msgs": float(len(got)),
+                       "disk_mb": sum(os.path.getsize(os.path.join(directory, f)) for f in os.listdir(directory)) / 2**20})
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ[DIR_ENV] = directory
+        port = free_port()
+        proc = start_server(port, capture=True)
+        try:
+            # Several senders: each stays under the per-connection rate limit (RATE_LIMIT_CONN_MSGS_PER_SEC)
+            senders = [LineClient(port, f"mb_tx{i}") for i in range(queued // 30 + 1)]
+            for m in range(queued):
+                senders[m % len(senders)].send(f"mb_away:q{m}:{'x' * 40}")
+            for m in range(queued - len(senders), queued):  # The echo of each sender's last message: all are queued
+                senders[m % len(senders)].wait_for(f"|q{m}|")
+            t0 = time.perf_counter()
+            rx = LineClient(port, "mb_away")
+            rx.wait_for(f"|q{queued - 1}|")
+            result["delivery_ms"] = (time.perf_counter() - t0) * 1000
+            result["delivered_msgs"] = float(queued)
+            proc.send_signal(signal.SIGTERM)
+            for c in senders + [rx]:
+                c.sock.close()
+            stats = json.loads(next(l for l in proc.communicate(timeout=30.0)[0].splitlines()
+                                    if l.startswith("MAILBOX_STATS "))[14:])
+            result.update({"server_delivered": float(stats["delivered"]), "server_latency_p50_ms": stats["latency_p50_ms"]})
+        finally:
+            os.environ.pop(DIR_ENV, None)
+            if proc.poll() is None:
+                proc.kill()
+    return result
+
+
+# ===================
+# ===== Logging =====
+# ===================
+# Part 1, in process: cost of one log call for the caller (filtered out / sampled out / queued) next to a
+# synchronous JSON line write + flush, and how fast the writer empties the queue.
+# Part 2, end to end: the batching load (20 senders -> 50 receivers) with the log off, at the default level,
+# and with a debug record for every message.
+def bench_logging(n: int = 200_000) -> Dict[str, float]:
+    import tempfile
+    from Server_Log import AsyncLogger, FILE_ENV
+
+    result = {}
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "server.log")
+        logger = AsyncLogger(path, level="info", echo=False, max_pending=n + 1, sample_every={"msg": 100})
+        result["filtered_ns"] = ns_per_call(lambda: logger.debug("msg", sender="a", target="ALL", msg_id="m1", bytes=40), n)
+        logger.configure("debug", {"msg": 100})
+        result["sampled_out_ns"] = ns_per_call(lambda: logger.debug("msg", sender="a", target="ALL", msg_id="m1", bytes=40), n)
+        logger.pending.clear()
+        result["queued_ns"] = ns_per_call(lambda: logger.info("join", "--> alice joined", user="alice", address="127.0.0.1"), n)
+        t0 = time.perf_counter()
+        logger.close()      # Writes all n queued records
+        result["writer_records_per_s"] = n / (time.perf_counter() - t0)
+
+        with open(os.path.join(directory, "sync.log"), "a", encoding="utf-8") as f:
+            def sync_write():
+                f.write(json.dumps({"ts": time.time(), "level": "info", "event": "join", "msg": "--> alice joined",
+                                    "user": "alice", "address": "127.0.0.1"}) + "\n")
+                f.flush()
+            result["sync_write_ns"] = ns_per_call(sync_write, n // 4)
+
+        os.environ[FILE_ENV] = path
+        try:
+            for tag, extra in (("off", ("--log-level", "off")), ("info", ()),
+                               ("every_msg", ("--log-level", "debug", "--log-sample", "1"))):
+                r = bench_batching_window(0.0, extra=extra)
+                result[f"{tag} lines_per_s"] = r["lines_per_s"]
+                result[f"{tag} p99_ms"] = r["p99_ms"]
+        finally:
+            os.environ.pop(FILE_ENV, None)
+    return result
+
+
+# =====================
+# ===== Profiler  =====
+# =====================
+# `workers` threads burn CPU (JSON round trips) next to `idle` threads blocked like connection handlers.
+# Work done in `seconds` with and without a profile running -> the slowdown, next to the overhead the profiler
+# measured for itself (its bound: PROFILE_MAX_OVERHEAD) and the share of busy samples found in the hot function.
+def bench_profiler(seconds: float = 3.0, workers: int = 4, idle_counts=(10, 1000)) -> Dict[str, float]:
+    import tempfile
+    from Profiler import SamplingProfiler, WAITING
+
+    def burn(stop: threading.Event, done: List[int]) -> None:
+        payload = {"type": "MSG", "sender": "user1", "target": "ALL", "text": "x" * 64}
+        while not stop.is_set():
+            for _ in range(100):
+                json.loads(json.dumps(payload))
+            done[0] += 100
+
+    def measure(profile: bool, directory: str):
+        stop, counters = threading.Event(), [[0] for _ in range(workers)]
+        threads = [threading.Thread(target=burn, args=(stop, c)) for c in counters]
+        for t in threads:
+            t.start()
+        profiler = SamplingProfiler(seconds, directory=directory) if profile else None
+        if profiler is not None:
+            profiler.start()
+            profiler.thread.join()
+        else:
+            time.sleep(seconds)
+        stop.set()
+        for t in threads:
+            t.join()
+        return sum(c[0] for c in counters) / seconds, profiler
+
+    result = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for n in idle_counts:
+            gate = threading.Event()
+            sleepers = [threading.Thread(target=gate.wait, daemon=True) for _ in range(n)]
+            for t in sleepers:
+                t.start()
+            base, _ = measure(False, directory)
+            profiled, profiler = measure(True, directory)
+            gate.set()
+            busy, _ = profiler.top()
+            in_burn = sum(count for stack, count in profiler.stacks.items() if ";burn (" in stack and not stack.endswith(WAITING))
+            result[f"idle{n} slowdown_pct"] = (1 - profiled / base) * 100
+            result[f"idle{n} overhead_pct"] = profiler.result["overhead"] * 100
+            result[f"idle{n} samples"] = float(profiler.result["samples"])
+            result[f"idle{n} interval_ms"] = profiler.result["interval_ms"]
+            result[f"idle{n} busy_in_burn_pct"] = in_burn * 100 / max(1, busy)   # The idle threads are [waiting]
+    return result
+
+
+# ==============================
+# ===== Simulated network ======
+# ==============================
+# Main_Server's routing over Sim_Net (in-memory sockets, virtual clock, one thread): `clients` users, then
+# private messages, room messages and ALL messages. Numbers are CPU time (process_time) per routed message and
+# per delivered line - no kernel, no scheduler noise. The virtual clock moves 1 ms per message (under the rate
+# limits). Last: the same private-message load over memory pairs vs. kernel socketpairs -> the kernel's share.
+def bench_simulated(clients: int = 100_000, dms: int = 50_000, n_rooms: int = 1000, room_msgs: int = 20_000,
+                    all_msgs: int = 5, joins: int = 20, small: int = 1000) -> Dict[str, float]:
+    import random
+    import Outbox
+    from Sim_Net import SimNetwork, memory_socketpair
+
+    def cpu(work: List[tuple], net) -> float:
+        t0 = time.process_time()
+        for client, line in work:
+            client.send(line)
+            net.advance(0.001)
+        return time.process_time() - t0
+
+    rng = random.Random(5)
+    net = SimNetwork()     # Pseudo-users "__sim..." keep the USERS lines short (like connect_clients)
+    t0 = time.process_time()
+    sim = [net.attach(f"__sim{i}") for i in range(clients)]
+    result = {"clients": float(clients), "attach_us": (time.process_time() - t0) / clients * 1e6}
+
+    t0 = time.process_time()    # The real join path: SESSION + USERS to everyone + announcement (O(users) each)
+    for i in range(joins):
+        net.connect(f"joiner{i}", keep=False)
+    result["join_ms"] = (time.process_time() - t0) / joins * 1000
+
+    work = [(sim[rng.randrange(clients)], f"__sim{rng.randrange(clients)}:d{m}:hello there") for m in range(dms)]
+    before = Outbox.stats["frames"]
+    result["dm_us_per_msg"] = cpu(work, net) / dms * 1e6
+    result["dm_lines_per_msg"] = (Outbox.stats["frames"] - before) / dms    # Target + the sender's own copy
+
+    members = [sim[i::n_rooms] for i in range(n_rooms)]     # clients / n_rooms members per room
+    cpu([(c, f"CMD:JOIN:#r{r}") for r, room in enumerate(members) for c in room], net)
+    work = []
+    for m in range(room_msgs):
+        r = rng.randrange(n_rooms)
+        work.append((rng.choice(members[r]), f"#r{r}:g{m}:hello room"))
+    result["room_us_per_msg"] = cpu(work, net) / room_msgs * 1e6
+    result["room_us_per_line"] = result["room_us_per_msg"] / len(members[0])
+
+    work = [(sim[rng.randrange(clients)], f"ALL:a{m}:hello everyone") for m in range(all_msgs)]
+    took = cpu(work, net)
+    result["all_ms_per_msg"] = took / all_msgs * 1000
+    result["all_us_per_line"] = took / (all_msgs * (clients + joins)) * 1e6
+
+    # Kernel share: `small` clients, private messages, every receiver drained (else socketpair buffers fill up)
+    def small_run(pair) -> Tuple[float, int]:
+        net = SimNetwork(pair=pair)
+        rng = random.Random(9)
+        users = [net.attach(f"u{i}", keep=True) for i in range(small)]
+        work = [(users[rng.randrange(small)], rng.randrange(small)) for _ in range(dms // 10)]
+        total = 0
+        t0 = time.process_time()
+        for m, (sender, target) in enumerate(work):
+            sender.send(f"u{target}:k{m}:hello there")
+            net.advance(0.001)
+            total += sum(len(line) for line in sender.lines() + users[target].lines())
+        took = time.process_time() - t0
+        for u in users:
+            u.conn.sock.close()
+            u.sock.close()
+        return took / len(work) * 1e6, total
+
+    mem_us, mem_bytes = small_run(memory_socketpair)
+    mem_us_again, mem_bytes_again = small_run(memory_socketpair)
+    kernel_us, kernel_bytes = small_run(socket.socketpair)
+    result.update({"small_memory_us_per_msg": min(mem_us, mem_us_again), "small_kernel_us_per_msg": kernel_us,
+                   "kernel_share_pct": (1 - min(mem_us, mem_us_again) / kernel_us) * 100,
+                   "deterministic": float(mem_bytes == mem_bytes_again == kernel_bytes)})
+    return result
+
+
+# ==========================
+# ===== Protocol codec =====
+# ==========================
+# Encode / decode cost per line: the codec (frames, escaping, dispatch table) vs. the old f-string / split -->
+def bench_codec(n: int = 200_000) -> Dict[str, float]:
+    import Protocol
+    text = "see you at the build review later today, bring the logs please"
+    messy = "a|b:c\nsecond line \\ with a backslash | and pipes"
+    line = f"MSG|alice|ALL|1792365739000-0a1b2c|42|{text}"
+    messy_line = Protocol.Msg("alice", "ALL", "1792365739000-0a1b2c", "42", messy).encode()
+    send_line = f"ALL:1792365739000-0a1b2c:{text}"
+
+    def old_decode():
+        parts = line.split("|")
+        return parts[0], parts[1], parts[2], parts[3], int(parts[4]), "|".join(parts[5:])
+
+    def old_command():
+        target, rest = send_line.split(":", 1)
+        return target, *rest.split(":", 1)
+
+    return {
+        "encode_fstring_ns": ns_per_call(lambda: f"MSG|alice|ALL|1792365739000-0a1b2c|{42}|{text}", n),
+        "encode_frame_ns": ns_per_call(lambda: Protocol.Msg("alice", "ALL", "1792365739000-0a1b2c", "42", text).encode(), n),
+        "encode_escaped_ns": ns_per_call(lambda: Protocol.Msg("alice", "ALL", "1792365739000-0a1b2c", "42", messy).encode(), n),
+        "decode_split_ns": ns_per_call(old_decode, n),
+        "decode_frame_ns": ns_per_call(lambda: Protocol.decode(line), n),
+        "decode_escaped_ns": ns_per_call(lambda: Protocol.decode(messy_line), n),
+        "command_split_ns": ns_per_call(old_command, n),
+        "command_frame_ns": ns_per_call(lambda: Protocol.decode_command(send_line), n),
+    }
+
+# ==========================
+# ===== Session memory =====
+# ==========================
+# Bytes the server holds per idle connection (target: well under 10 KB).
+# Part 1, Sim_Net: `counts` users attached, Python heap growth per user (tracemalloc) minus the in-memory socket
+# pair standing in for the kernel -> Main_Server's own state (Session, rate limiter, resume record, registries;
+# the ~80 bytes of each SimClient handle count too). Part 2, real TCP: `tcp_clients` joined clients, the server
+# process' RSS growth per client with a thread per connection vs. the event loop (what part 1 cannot see:
+# thread stacks, socket objects, the selector).
+def bench_session_memory(counts=(1000, 10_000, 50_000), tcp_clients: int = 1000) -> Dict[str, float]:
+    import gc
+    import tracemalloc
+    from Sim_Net import SimNetwork, memory_socketpair
+
+    def traced() -> int:
+        gc.collect()
+        return tracemalloc.get_traced_memory()[0]
+
+    def rss(pid: int) -> int:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+    result = {"target_bytes": 10 * 1024.0}
+    for n in counts:
+        net = SimNetwork()
+        tracemalloc.start()
+        base = traced()
+        pairs = [memory_socketpair(False) for _ in range(n)]
+        pair_bytes = traced() - base
+        del pairs
+        base = traced()
+        users = [net.attach(f"__idle{i}") for i in range(n)]
+        result[f"sim_{n}_bytes_per_conn"] = (traced() - base - pair_bytes) / n
+        tracemalloc.stop()
+        del users
+    SimNetwork()    # Forget the last population
+
+    for transport in ("threads", "loop"):
+        port = free_port()
+        proc = start_server(port, "--transport", transport, "--log-level", "warning")
+        socks = []
+        try:
+            time.sleep(0.5)
+            before = rss(proc.pid)
+            socks = connect_clients(port, tcp_clients)
+            last_join = f"__bench{tcp_clients - 1} -> has joined the chat"
+            joined = read_until(socks, lambda s, line: line.endswith(last_join), timeout=300.0)
+            read_until(socks, lambda s, line: False, timeout=1.0)   # Whatever is still on its way: now idle
+            result[f"tcp_{transport}_{tcp_clients}_bytes_per_conn"] = (rss(proc.pid) - before) / tcp_clients
+            result[f"tcp_{transport}_joined"] = float(len(joined))
+        finally:
+            for s in socks:
+                s.close()
+            proc.kill()
+    return result
+
+
+# ======================
+# ===== Heartbeats =====
+# ======================
+# Idle detection over Sim_Net (virtual clock: minutes of silence cost no time). `n` quiet users, dead_pct of them
+# never answer a PING, the others answer every one. Reports how long after going silent the dead ones were reaped
+# (virtual seconds; the bound is idle + timeout + one tick) and whether every live one stayed. Then the timer cost
+# per connection: moving a key on the wheel and a wheel tick, vs. a timer per socket (a threading.Timer thread each).
+def bench_heartbeat(counts=(1000, 5000), dead_pct: float = 2.0, timers: int = 100_000) -> Dict[str, float]:
+    import Main_Server
+    import Protocol
+    from Clocks import VirtualClock
+    from Sim_Net import SimNetwork
+    from Timer_Wheel import TimerWheel
+
+    idle, timeout = Main_Server.heartbeat['idle'] or 30.0, Main_Server.heartbeat['timeout']
+    result = {"idle_sec": idle, "timeout_sec": timeout}
+    for n in counts:
+        net = SimNetwork(heartbeat=idle)
+        users = [net.attach(f"__hb{i}", keep=True) for i in range(n)]
+        dead = n * dead_pct // 100
+        live = users[int(dead):]
+        before = Main_Server.heartbeat_stats["reaped"]
+        reaped_after = 0.0
+        t0 = time.process_time()
+        for second in range(1, int(idle + timeout) + 5):
+            net.advance(1.0)
+            for user in live:
+                for line in user.lines():
+                    if line.startswith("PING|"):
+                        user.send(Protocol.Pong(Protocol.decode(line).stamp).encode())
+            if not reaped_after and Main_Server.heartbeat_stats["reaped"] - before >= dead:
+                reaped_after = float(second)
+        result[f"{n}_cpu_us_per_conn"] = (time.process_time() - t0) / n * 1e6    # Pings, pongs, reaping + its broadcasts
+        result[f"{n}_reaped"] = float(Main_Server.heartbeat_stats["reaped"] - before)
+        result[f"{n}_reaped_after_sec"] = reaped_after
+        result[f"{n}_live_kept"] = float(sum(u.conn.id in Main_Server.connections for u in live) == len(live))
+    SimNetwork()    # Forget the last population
+
+    # The wheel alone: `timers` keys spread over one idle period, each moved once, then ticked through a period
+    def nothing():
+        pass
+
+    clock = VirtualClock()
+    wheel = TimerWheel(clock, 1.0, 512)
+    for i in range(timers):
+        wheel.schedule(i, 1 + i % int(idle), nothing)
+    keys = iter(range(timers))
+    result["wheel_move_ns"] = ns_per_call(lambda: wheel.schedule(next(keys), idle, nothing), timers)
+    t0 = time.perf_counter()
+    for _ in range(int(idle)):
+        clock.now += 1.0
+        wheel.advance()
+    result["wheel_tick_us_per_timer"] = (time.perf_counter() - t0) / idle / (timers / idle) * 1e6
+
+    # One timer per socket: a threading.Timer started per connection, then cancelled
+    started = []
+    t0 = time.perf_counter()
+    for _ in range(1000):
+        timer = threading.Timer(idle, len)
+        timer.daemon = True
+        timer.start()
+        started.append(timer)
+    result["thread_timer_start_us"] = (time.perf_counter() - t0) / 1000 * 1e6
+    result["thread_timer_threads"] = float(threading.active_count())
+    for timer in started:
+        timer.cancel()
+    return result
+
+
+BENCHMARKS = {
+    "rate_limiter": bench_rate_limiter,
+    "drain": bench_drain,
+    "hot_restart": lambda: bench_drain(handoff=True),
+    "batching": bench_batching,
+    "compression": bench_compression,
+    "client_state": bench_client_state,
+    "startup": bench_startup,
+    "rooms": bench_rooms,
+    "federation": bench_federation,
+    "search": bench_search,
+    "mailbox": bench_mailbox,
+    "logging": bench_logging,
+    "profiler": bench_profiler,
+    "simulated": bench_simulated,
+    "codec": bench_codec,
+    "session_memory": bench_session_memory,
+    "heartbeat": bench_heartbeat,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        print(f"--- {name} ---")
+        for key, value in BENCHMARKS[name]().items():
+            if isinstance(value, float):
+                print(f"{key:>28}: {value:,.3f}" if abs(value) < 10 else f"{key:>28}: {value:,.1f}")
+            else:
+                print(f"{key:>28}: {value}")
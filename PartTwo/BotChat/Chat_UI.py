@@ -12,14 +12,39 @@ import time
 import uuid
 import asyncio
 
-from Common_Setups import SERVER_IP, SERVER_PORT
+from Backoff import ExponentialBackoff
+from Common_Setups import (
+    RECONNECT_BASE_SEC, RECONNECT_MAX_SEC, GAP_FETCH_DELAY_SEC, channel_of,
+    is_room, valid_room, ROOM_PREFIX,
+    COMPRESSION_ENABLED,
+)
+import Compression
+import Protocol
+from Avatar_Store import avatar_hash
+from Search_Index import tokenize, highlight
+from Connection_Manager import connections
 from State_Globals import (
     messages,
     active_users_list,
     avatar_urls,
+    avatar_blobs,
     BG_COLORS,
     user_colors_cache,
     avatar_seeds,
+    chat_disconnectors,
+    set_active_users,
+    message_seqs,
+    pending_msg_ids,
+    track_seq,
+    still_missing,
+    set_seq_epoch,
+    store_message,
+    load_older_messages,
+    has_older_messages,
+    search_index,
+    search_state,
+    find_messages,
+    load_until,
 )
 
 
@@ -50,12 +75,12 @@ name_edit_timer: dict[str, Optional[Any]] = {'t': None}  # Timer for username ch
 # ============================
 # ===== Messages counter =====
 # ============================
-# Count how many messages should be visible for this user -->
-def count_relevant_messages(own_name: str) -> int:
+# Count how many messages should be visible for this user (`joined`: the rooms it is a member of) -->
+def count_relevant_messages(own_name: str, joined=()) -> int:
     c = 0
     for _mid, sender, _text, _stamp, target in messages:    # "Runs" on all the stored messages
         target_norm = 'ALL' if str(target or '').upper() == 'ALL' else str(target or '')
-        if target_norm == 'ALL' or target_norm == own_name or sender == own_name:   # Checks how many messages relevant to me
+        if target_norm == 'ALL' or target_norm == own_name or sender == own_name or target_norm in joined:   # Checks how many messages relevant to me
             c += 1
     return c
 
@@ -84,15 +109,17 @@ async def build_chat_ui(request: Request) -> None:
     name_input = None
     text = None
     target = None
+    room_select = None
     scroll_btn = None
     badge = None
+    search_input = None
 
     # --------------------------------
     # 2) Scroll + Rename sync state
     # --------------------------------
     # Variables to track after scrolling positions -->
     new_msg_counter = {'count': 0}  # A variable to track after messages that weren't read yet
-    last_count = [count_relevant_messages(my_name)]  # Saves the last amount of new messages
+    last_count = [count_relevant_messages(my_name, ())]  # Saves the last amount of new messages
     is_up = [False]  # Saves the information if the user is currently up
     #ui.on('scroll_state', lambda e: is_up.__setitem__(0, bool((e.args or {}).get('up', False))))  # Catches the event from the JavaScript on chat_messages
 
@@ -112,17 +139,35 @@ async def build_chat_ui(request: Request) -> None:
     ui.on('scroll_state', on_scroll_state)
     latest_confirmed_name = [my_name]  # Rename pending state (thread -> UI)
     avatar_dirty = {'flag': False} # New Avatar flag
+    avatar_wait = {}  # avatar hash -> names waiting for it (CMD:AVATAR_GET sent, AVATAR_BLOB not here yet)
     name_edit_timer = {'t': None}  # timer handle
     name_dirty = {'flag': False}  # user typed but didn't confirm yet
+    reconnect_hint = {'window': None, 'shown': False}  # RECONNECT|System|<me>|<min_ms>|<max_ms> from a draining server
+    session = {'token': None, 'last_msg_id': ''}  # SESSION token + last MSG seen -> CMD:RESUME after a dropped connection
+    link_notices = []  # Connection state changes (thread -> UI notifications)
+    backoff = ExponentialBackoff(RECONNECT_BASE_SEC, RECONNECT_MAX_SEC)  # Reset once the server accepted us again
+    closing = {'done': False}   # Closed or Open flag (set by handle_disconnect, stops reconnecting)
+    caps = {'zlib': False}  # Server accepted compression (ACK ... CAPS|zlib) on the current connection
+    caps_offer = Protocol.Caps(Compression.CAPABILITY).encode() + "\n" if COMPRESSION_ENABLED else ""
+    my_rooms = set()    # Rooms this tab is a member of (server confirmed: ACK ... JOINED)
+    known_rooms = set()  # Rooms that exist on the server (ROOMS|System|<me>|#a,#b) -> room selector options
+    room_state = {'dirty': False, 'focus': None}  # Thread -> UI: refresh the selectors / switch "Send to" to a room
+
+    # One protocol line as bytes (long lines compressed once the server agreed to it) -->
+    def to_wire(line: str) -> bytes:
+        if caps['zlib']:
+            line = Compression.encode_line(line)
+        return (line + "\n").encode("utf-8")
 
     # -------------------------------
     # 3) Server-Client connections
     # -------------------------------
+    loop = asyncio.get_running_loop()   # NiceGUI's event loop (the listener thread reports back to it)
+    server_closed = loop.create_future()  # Resolved when the server closed our socket (or it broke)
     # Creating a soket connection to the Server -->
     try:
-        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client_socket.connect((SERVER_IP, SERVER_PORT))
-        client_socket.sendall((my_name + "\n").encode('utf-8'))  # Sending an "introduction" message to the server with our name
+        client_socket = connections.connect()  # Warm socket from the pool when there is one
+        client_socket.sendall((my_name + "\n" + caps_offer + Protocol.ListRooms().encode() + "\n").encode('utf-8'))  # Sending an "introduction" message to the server with our name
         ui.notify(f"Connected as {my_name}", type='positive')
     except Exception as e:
         ui.query('body').style('background-color: #1a0202; color: white;')
@@ -239,12 +284,7 @@ async def build_chat_ui(request: Request) -> None:
 
     def choose_avatar(url: str):
         ui.context.client.storage['my_avatar'] = url    # Local
-
-        # tell server so it can broadcast to everyone
-        try:
-            client_socket.sendall(f"CMD:AVATAR:{url}\n".encode("utf-8"))
-        except Exception as e:
-            print("Failed to send avatar to server:", e)
+        avatar_blobs[avatar_hash(url)] = url    # Our own AVATAR line (hash only) needs no fetch
 
         # שמירה גם במפה המקומית כדי שמייד יופיע
         me = str(ui.context.client.storage.get('my_name', my_name)).strip()
@@ -258,9 +298,9 @@ async def build_chat_ui(request: Request) -> None:
             avatar_img_footer.source = url
             avatar_img_footer.update()
 
-        # Tell server to broadcast my avatar to everyone:
+        # Tell server to broadcast my avatar to everyone (it stores the URL, the others get its hash):
         try:
-            client_socket.sendall(f"CMD:AVATAR:{url}\n".encode("utf-8"))
+            client_socket.sendall(to_wire(Protocol.SetAvatar(url).encode()))
         except Exception as e:
             print("Failed to send avatar update:", e)
 
@@ -316,16 +356,21 @@ async def build_chat_ui(request: Request) -> None:
     def chat_messages() -> None:
         own_name = ui.context.client.storage.get('my_name', '')  # Gets "my name" from the storage
         own_avatar = ui.context.client.storage.get('my_avatar', '')  # Gets "my avatar" from the storage
+        terms = search['terms']  # Words of the current search (highlighted in the bubbles)
         # Filter messages to show only those relevant to the current user (Private or Global)
         relevant_messages = []
         for msg_id, sender, text, stamp, target in messages:
             raw_target = (target or '')
             target_norm = 'ALL' if raw_target.upper() == 'ALL' else raw_target  # Don't miss an "ALL" no matter how it written
-            # Only if the message is for everyone / send to me / sent by me
-            if target_norm == 'ALL' or target_norm == own_name or sender == own_name:
+            # Only if the message is for everyone / send to me / sent by me / in one of my rooms
+            if target_norm == 'ALL' or target_norm == own_name or sender == own_name or target_norm in my_rooms:
                 relevant_messages.append(
                     (msg_id, sender, text, stamp, target_norm))  # Keep if it's to ALL / to me / by me
 
+        # Older history stays on disk until asked for -->
+        if has_older_messages():
+            ui.button('Load older messages', on_click=load_older).props('flat dense no-caps').classes('self-center text-gray-400')
+
         # Shows the messages that were meant to me or sent from me -->
         if relevant_messages:
             for msg_id, sender, text, stamp, target_id in relevant_messages:  # To who I sent/received a message to/from
@@ -334,6 +379,8 @@ async def build_chat_ui(request: Request) -> None:
                 label = ""
                 if target_id == 'ALL':
                     label = "To All"
+                elif is_room(target_id):
+                    label = f"In {target_id}"
                 elif sent_by_me:
                     label = f"To {target_id}" if target_id != 'ALL' else ""
                 elif target_id != 'ALL':
@@ -349,7 +396,11 @@ async def build_chat_ui(request: Request) -> None:
                     avatar = avatar_urls.get(sender) or get_avatar_url(sender)  # otherwise, use synced avatar_urls OR generate based on name   @@@@@
 
                 # Build the message bubble component & properties -->
-                msg = ui.chat_message(name=sender, text=text, stamp=f"{stamp} {label}".strip(), avatar=avatar,sent=sent_by_me).props(f'key="{msg_id}"')
+                marked = highlight(text, terms) if terms and not terms.isdisjoint(tokenize(text)) else None
+                msg = ui.chat_message(name=sender, text=marked or text, text_html=marked is not None,
+                                      stamp=f"{stamp} {label}".strip(), avatar=avatar,sent=sent_by_me).props(f'key="{msg_id}" id="m-{msg_id}"')
+                if msg_id == search['hit']:
+                    msg.classes('search-hit')  # The result we jumped to
                 if is_system:
                     msg.classes('system-msg')  # Different style for system messages
                 else:
@@ -360,16 +411,165 @@ async def build_chat_ui(request: Request) -> None:
                 ui.icon('chat_bubble_outline').classes('text-5xl mb-2')
                 ui.label('No messages yet')
 
+    # One more page of stored history at the top (not counted as "new" messages) -->
+    def load_older():
+        if load_older_messages():
+            last_count[0] = count_relevant_messages(ui.context.client.storage.get('my_name', my_name), my_rooms)
+            chat_messages.refresh()
+
+    # ----------------------------------------------------
+    # 6.1) Search: the inverted index, results + jumping
+    # ----------------------------------------------------
+    search = {'query': '', 'terms': set(), 'results': [], 'hit': None, 'took_ms': 0.0}
+
+    @ui.refreshable
+    def search_results() -> None:
+        if not search['query']:
+            return
+        found = find_messages(search['results'])
+        note = f"{len(search['results'])} results ({search['took_ms']:.1f} ms)"
+        if not search_state['indexed_history']:
+            note += " - older messages are still being indexed"
+        ui.label(note).classes('text-gray-300 text-sm')
+        for mid in search['results']:
+            if mid not in found:
+                continue
+            _mid, sender, msg_text, stamp, _target = found[mid]
+            with ui.row().classes('w-full no-wrap items-start gap-2 p-1 rounded-lg cursor-pointer hover:bg-white/10') \
+                    .on('click', lambda _=None, mid=mid: jump_to(mid)):
+                ui.label(f"{stamp} {sender}").classes('text-xs text-gray-300 w-28 shrink-0')
+                ui.html(highlight(msg_text, search['terms'])).classes('text-sm text-white')
+
+    # Enter in the search box -> newest matches this user may see (same rule as the chat) -->
+    def run_search() -> None:
+        query = (search_input.value or '').strip() if search_input is not None else ''
+        if not query:
+            clear_search()
+            return
+        me = ui.context.client.storage.get('my_name', my_name)
+        t0 = time.perf_counter()
+        search['results'] = search_index.search(query, me, my_rooms)
+        search['took_ms'] = (time.perf_counter() - t0) * 1000
+        search['query'], search['terms'], search['hit'] = query, set(tokenize(query)), None
+        search_results.refresh()
+        chat_messages.refresh()  # Highlight the matches in the chat too
+        search_dialog.open()
+
+    def clear_search() -> None:
+        search.update(query='', terms=set(), results=[], hit=None)
+        search_results.refresh()
+        chat_messages.refresh()
+
+    # Show a result in the chat: load older pages if needed, then scroll it into view -->
+    def jump_to(msg_id: str) -> None:
+        search_dialog.close()
+        if not load_until(msg_id):
+            ui.notify('This message is not stored anymore', type='warning', position='top')
+            return
+        last_count[0] = count_relevant_messages(ui.context.client.storage.get('my_name', my_name), my_rooms)  # Older ones are not "new"
+        search['hit'] = msg_id
+        chat_messages.refresh()
+        ui.run_javascript(f'document.getElementById("m-{msg_id}")?.scrollIntoView({{block: "center"}})')
+
+    with ui.dialog() as search_dialog:
+        with ui.card().classes(
+                'w-[560px] max-w-[92vw] bg-white/10 backdrop-blur-xl border border-white/20 rounded-2xl shadow-2xl p-5'):
+            with ui.row().classes('w-full items-center justify-between'):
+                ui.label('Search results').classes('text-white text-2xl font-bold')
+                ui.button(icon='close', on_click=search_dialog.close) \
+                    .props('flat round dense') \
+                    .classes('text-white hover:bg-white/10')
+            with ui.scroll_area().classes('w-full h-[60vh]'):
+                search_results()
+
     # ------------------------------
     # 7) Listener thread (server)
     # ------------------------------
+    # Connect again after the connection broke: resume the session (or join again with our name) -->
+    # Runs on the listener thread; returns False only when we are closing on purpose.
+    def reconnect() -> bool:
+        nonlocal client_socket
+        try: client_socket.close()
+        except Exception: pass
+        link_notices.append(('Connection lost, reconnecting...', 'warning'))
+
+        window = reconnect_hint['window']  # A draining server told us when to come back
+        delay = random.uniform(window[0], window[1]) / 1000 if window else backoff.next_delay()
+        while not closing['done']:
+            time.sleep(delay)
+            if closing['done']: break
+            try:
+                new_socket = connections.connect(timeout=5.0)  # Finds the server again if it moved
+                rejoin = ""
+                if session['token']:
+                    hello = Protocol.Resume(session['token'], session['last_msg_id']).encode()
+                else:
+                    hello = latest_confirmed_name[0]
+                    rejoin = "".join(Protocol.JoinRoom(r).encode() + "\n" for r in sorted(my_rooms))  # A new session has no rooms yet
+                new_socket.sendall((hello + "\n" + caps_offer + rejoin).encode('utf-8'))
+            except OSError as e:
+                print(f"Reconnect failed: {e}")
+                delay = backoff.next_delay()
+                continue
+            client_socket = new_socket
+            caps['zlib'] = False  # Until the new connection agrees again
+            reconnect_hint['window'], reconnect_hint['shown'] = None, False
+            return True
+        return False
+
+    # Next chunk from the server; reconnects transparently. Returns ("", _) when the listener should stop -->
+    def receive_chunk():
+        reconnected = False
+        while True:
+            try:
+                chunk = client_socket.recv(4096)
+                if chunk:
+                    return chunk.decode('utf-8', errors='replace'), reconnected
+            except OSError as e:
+                if not closing['done']:
+                    print(f"Error receiving: {e}")
+            if closing['done'] or not reconnect():
+                return "", reconnected
+            reconnected = True
+
+    # Ask the server for skipped seqs of a channel, unless they show up by themselves meanwhile -->
+    def fetch_gap_later(channel: str, other: str, lo: int, hi: int) -> None:
+        def fetch():
+            missing = still_missing(channel, lo, hi)
+            if not missing or closing['done']: return
+            try:
+                client_socket.sendall(to_wire(Protocol.History(other, str(missing[0]), str(missing[-1])).encode()))
+            except OSError:
+                pass  # Reconnecting; the resume replay covers it
+        timer = threading.Timer(GAP_FETCH_DELAY_SEC, fetch)
+        timer.daemon = True
+        timer.start()
+
+    # Show `who` with the avatar `h`: from the cache, or ask the server for it once -->
+    def use_avatar(who: str, h: str) -> None:
+        url = avatar_blobs.get(h)
+        if url is not None:
+            if avatar_urls.get(who) != url:
+                avatar_urls[who] = url
+                avatar_dirty['flag'] = True
+            return
+        waiting = avatar_wait.setdefault(h, set())
+        if not waiting:
+            try:
+                client_socket.sendall(to_wire(Protocol.GetAvatar(h).encode()))
+            except OSError:
+                avatar_wait.pop(h, None)
+                return
+        waiting.add(who)
+
     # A function for listening to messages from the server (will run on background) -->
     def listen_to_server():
         buffer = ""  # Accumulates partial TCP chunks
         while True:
-            try:  # receiving a message from the server (up to 1024 bits)
-                chunk = client_socket.recv(4096).decode('utf-8', errors='replace')
+            try:  # receiving a message from the server (up to 4096 bytes)
+                chunk, reconnected = receive_chunk()
                 if not chunk: break
+                if reconnected: buffer = ""  # A half line from the old connection is garbage
                 buffer += chunk
 
                 # ---- stage 1: Identifying the type of message by the protocol ---
@@ -378,66 +578,153 @@ async def build_chat_ui(request: Request) -> None:
                     line = line.strip()
                     if not line: continue
 
-                    parts = line.split("|")
-                    if len(parts) < 2: continue  # protect protection from "broken" messages
+                    # Compressed line -> put the lines inside back in front of the buffer:
+                    if line.startswith(Compression.PREFIX):
+                        try:
+                            buffer = Compression.decode_line(line) + "\n" + buffer
+                        except ValueError as e:
+                            print(f"Dropped a broken compressed line: {e}")
+                        continue
+
+                    frame = Protocol.decode(line)
+                    if frame is None: continue  # protect protection from "broken" (or unknown) messages
 
-                    msg_type = parts[0].strip()  # Could be MSG / USERS / ERR / ACK
+                    msg_type = frame.TYPE  # Could be MSG / USERS / ERR / ACK
 
                     # ---- option A: the server sent list of updated users ----
-                    if msg_type == "USERS" and len(parts) >= 4:
+                    if msg_type == "USERS":
                         # The format: USERS|System|All|user1,user2,user3
-                        users_str = parts[3]
-                        active_users_list.clear()
-                        if users_str:  # if the list is not empty, we will update
-                            active_users_list.extend([u.strip() for u in users_str.split(",") if u.strip()])
+                        users_str = frame.names
+                        set_active_users([u.strip() for u in users_str.split(",") if u.strip()])
 
                     # ---- option A.1: server error (e.g., name taken) ----
-                    elif msg_type == "ERR" and len(parts) >= 4:
+                    elif msg_type == "ERR":
                         # ERR|System|<who>|<code>
-                        err_code = parts[3].strip()
+                        err_code = frame.code.strip()
+                        if err_code == "RESUME_FAILED":  # Session expired -> the next attempt joins again
+                            session['token'] = None
+                            continue
+                        if err_code == "NO_AVATAR":  # The server dropped it meanwhile -> default avatar stays
+                            continue
                         ui.notify(f"Server error: {err_code}", type='negative', position='top')
 
                     # ---- option A.2: server ack (e.g., name changed approved) ----
-                    elif msg_type == "ACK" and len(parts) >= 5:
+                    elif msg_type == "ACK":
                         # ACK|System|<old>|NAME_CHANGED|<new>
-                        action = parts[3].strip()
-                        if action == "NAME_CHANGED":
-                            latest_confirmed_name[0] = parts[4].strip()
+                        action = frame.action.strip()
+                        if action == "CAPS":
+                            caps['zlib'] = (frame.value.strip() == Compression.CAPABILITY)
+                        if action in ("NAME_CHANGED", "RESUMED"):
+                            latest_confirmed_name[0] = frame.value.strip()
+                        if action == "RESUMED":
+                            link_notices.append(('Reconnected', 'positive'))
+                        if action in ("JOINED", "PARTED"):
+                            room = frame.value.strip()
+                            if action == "JOINED":
+                                my_rooms.add(room)
+                                known_rooms.add(room)
+                                room_state['focus'] = room
+                            else:
+                                my_rooms.discard(room)
+                            room_state['dirty'] = True
+
+                    # ---- option A.2.2: the rooms that exist on the server ----
+                    elif msg_type == "ROOMS":
+                        # ROOMS|System|<me>|#room1,#room2
+                        known_rooms.update(r.strip() for r in frame.names.split(",") if r.strip())
+                        room_state['dirty'] = True
+
+                    # ---- option A.2.1: our session token (for resuming after a dropped connection) ----
+                    elif msg_type == "SESSION":
+                        # SESSION|System|<me>|<token>|<epoch>
+                        session['token'] = frame.token.strip()
+                        if frame.epoch:
+                            set_seq_epoch(frame.epoch.strip())
+                        backoff.reset()
 
                     # ---- option A.3: server rename event (avatar seed sync) ----
-                    elif msg_type == "RENAME" and len(parts) >= 3:
+                    elif msg_type == "RENAME":
                         # RENAME|old|new
-                        old_n = parts[1].strip()
-                        new_n = parts[2].strip()
+                        old_n = frame.old.strip()
+                        new_n = frame.new.strip()
                         if old_n and new_n:
                             avatar_seeds[new_n] = avatar_seeds.get(old_n, old_n)
                         continue  # לא מוסיפים הודעה לצ'אט
 
                     # ---- option A.4: server change to avatar ---- @@@@@
-                    elif msg_type == "AVATAR" and len(parts) >= 3:
-                        # AVATAR|username|url
-                        who = parts[1].strip()
-                        url = "|".join(parts[2:]).strip()  # safe if '|' somehow appears
-                        if who and url:
+                    elif msg_type == "AVATAR":
+                        # AVATAR|username|hash
+                        who = frame.name.strip()
+                        if who:
+                            use_avatar(who, frame.avatar_hash.strip())
+                        continue
+
+                    # ---- option A.4.1: everyone's avatar (right after joining) ----
+                    elif msg_type == "AVATARS":
+                        # AVATARS|System|<me>|name1=hash1,name2=hash2
+                        for pair in frame.pairs.split(","):
+                            who, _, h = pair.rpartition("=")
+                            if who:
+                                use_avatar(who, h)
+                        continue
+
+                    # ---- option A.4.2: an avatar we asked for ----
+                    elif msg_type == "AVATAR_BLOB":
+                        # AVATAR_BLOB|System|<hash>|<url>
+                        h = frame.avatar_hash.strip()
+                        url = frame.url.strip()
+                        if avatar_hash(url) != h:  # Content-addressed: the URL must match its hash
+                            continue
+                        avatar_blobs[h] = url
+                        for who in avatar_wait.pop(h, ()):
                             avatar_urls[who] = url
-                            avatar_dirty['flag'] = True
-                            # אם זה אני - נשמור גם ב-storage כדי שהטופ/פוטר והבועות שלי יתעדכנו
-                            '''me = str(ui.context.client.storage.get('my_name', my_name)).strip()
-                            if who == me:
-                                ui.context.client.storage['my_avatar'] = url
-
-                            '''
-                            chat_messages.refresh()
+                        avatar_dirty['flag'] = True
+                        continue
+
+                    # ---- option A.5: server is draining (restart) -> reconnect later ----
+                    elif msg_type == "RECONNECT":
+                        # RECONNECT|System|<me>|<min_ms>|<max_ms>
+                        try:
+                            reconnect_hint['window'] = (int(frame.min_ms), int(frame.max_ms))
+                        except ValueError:
+                            pass
+                        continue
+
+                    # ---- option A.6: heartbeat -> answer at once (a client that stays silent is evicted) ----
+                    elif msg_type == "PING":
+                        # PING|System|<me>|<stamp>
+                        try:
+                            client_socket.sendall(to_wire(Protocol.Pong(frame.stamp).encode()))
+                        except OSError:
+                            pass  # Reconnecting anyway
                         continue
 
                     # ---- option B: the server sent a normal chat message ----
-                    elif msg_type == "MSG" and len(parts) >= 5:
-                        # MSG|sender|target|msg_id|content(with possible |)
-                        sender = parts[1].strip()
-                        raw_target = parts[2].strip()
+                    elif msg_type == "MSG":
+                        # MSG|sender|target|msg_id|seq|content (escaped: '|' and line breaks inside are fine)
+                        sender = frame.sender.strip()
+                        raw_target = frame.target.strip()
                         target_id = 'ALL' if raw_target.upper() == 'ALL' else raw_target
-                        msg_id = parts[3].strip()
-                        content = "|".join(parts[4:])  # חשוב: אם יש '|' בתוך הודעה, שלא יחתוך לך
+                        msg_id = frame.msg_id.strip()
+                        try: seq = int(frame.seq)
+                        except ValueError: continue
+                        content = frame.text
+                        session['last_msg_id'] = msg_id  # A resume asks the server for everything after this one
+
+                        # Server order: O(1) dedup + gap detection by the channel's seq -->
+                        channel = channel_of(sender, target_id)
+                        is_new, gap = track_seq(channel, seq)
+                        if gap is not None:
+                            if channel == 'ALL' or is_room(channel):
+                                other = channel
+                            else:
+                                other = target_id if sender == latest_confirmed_name[0] else sender
+                            fetch_gap_later(channel, other, *gap)
+                        if not is_new: continue  # Already stored (another tab, a replay or a resend)
+                        if msg_id in pending_msg_ids:  # Our own message: shown when sent, now it has its seq
+                            pending_msg_ids.discard(msg_id)
+                            message_seqs[msg_id] = (channel, seq)
+                            continue
 
                         # Hide launcher system messages from chat users -->
                         if sender == 'System' and '__LAUNCHER__' in content: continue
@@ -451,16 +738,22 @@ async def build_chat_ui(request: Request) -> None:
                             except Exception as e:
                                 print(f"Error parsing system msg: {e}")
                         '''
-                        if any(m[0] == msg_id for m in messages): continue  # If there is already a message with the same msg_id, we don't add it
                         # creating variables for the presentation -->
                         stamp = datetime.now().strftime('%H:%M')
                         # adding to the global list (saving the real target_id so we would know if it's private or for all) -->
-                        messages.append((msg_id, sender, content, stamp, target_id))
+                        store_message((msg_id, sender, content, stamp, target_id), channel, seq)
+                        search_index.add(msg_id, sender, target_id, content)
 
             except Exception as e:
-                print(f"Error receiving: {e}")
+                print(f"Error handling server data: {e}")
                 break
 
+        # Tell the event loop that the connection is over (wakes up an awaiting disconnect) -->
+        try:
+            loop.call_soon_threadsafe(lambda: server_closed.done() or server_closed.set_result(True))
+        except RuntimeError:
+            pass  # Event loop already closed (app shutting down)
+
     threading.Thread(target=listen_to_server,daemon=True).start()  # Activating the thread that is listening to the server
 
     # ----------------
@@ -476,6 +769,14 @@ async def build_chat_ui(request: Request) -> None:
             avatar_dirty['flag'] = False
             chat_messages.refresh()
 
+        if reconnect_hint['window'] and not reconnect_hint['shown']:
+            reconnect_hint['shown'] = True
+            ui.notify('Server is restarting...', type='warning', position='top')
+
+        while link_notices:
+            notice, kind = link_notices.pop(0)
+            ui.notify(notice, type=kind, position='top')
+
         # Name sync from server ACK:
         # === מנגנון סנכרון: אם יש חוסר תאמה, מבצעים עדכון כפוי ===
         if current_me != confirmed_name:
@@ -499,6 +800,7 @@ async def build_chat_ui(request: Request) -> None:
                 new_tgt = new_name if tgt == old_name else tgt
                 if new_sender != sender or new_tgt != tgt:  # If it's my old name or a different target
                     messages[i] = (mid, new_sender, msg_text, stamp, new_tgt)
+            search_index.rename(old_name, new_name)
             chat_messages.refresh()
 
             # הודעה למשתמש
@@ -515,17 +817,29 @@ async def build_chat_ui(request: Request) -> None:
             # מעדכנים את המשתנה המקומי להמשך הפונקציה
             current_me = confirmed_name
 
+        # refresh the room selector (rooms on the server + mine):
+        if room_state['dirty']:
+            room_state['dirty'] = False
+            room_select.options = sorted(known_rooms | my_rooms)
+            if room_select.value not in my_rooms:  # Typed name -> "#name" once joined; None after leaving
+                room_select.value = room_state['focus'] if room_state['focus'] in my_rooms else None
+            room_select.update()
+
         # refresh target select options:
         current_options = {'ALL': 'Everyone'}
+        for room in sorted(my_rooms):
+            current_options[room] = room
         for user in active_users_list:
             u = str(user).strip()
             if u and u != current_me: current_options[u] = u
         if target.value not in current_options and target.value != 'ALL':
             target.value = 'ALL'
         target.options = current_options  # Refreshing all the users (except myself)
+        if room_state['focus'] in current_options:  # Just joined a room -> talk there
+            target.value, room_state['focus'] = room_state['focus'], None
         target.update()
 
-        current_relevant = count_relevant_messages(current_me)  # Updating the current count
+        current_relevant = count_relevant_messages(current_me, my_rooms)  # Updating the current count
         if current_relevant > last_count[0]:  # Checking if you have messages if you haven't read yet
             chat_messages.refresh()  # Refreshing the chat bubbles on the screen
             if is_up[0]:  # If there is a new message and the user is scrolled up
@@ -558,7 +872,7 @@ async def build_chat_ui(request: Request) -> None:
             return
         try:
             if client_socket.fileno() == -1:
-                ui.notify('You are disconnected. Please refresh.', type='negative')
+                ui.notify('Reconnecting to the server... try again in a moment.', type='warning')
                 return
 
             raw_target = (target.value or 'ALL') if target is not None else 'ALL'
@@ -570,11 +884,13 @@ async def build_chat_ui(request: Request) -> None:
                 return
 
             msg_id = f"{int(time.time() * 1000)}-{uuid.uuid4().hex[:6]}"
-            payload = f"{recipient}:{msg_id}:{msg}"
-            client_socket.sendall((payload + "\n").encode("utf-8"))
+            payload = Protocol.Send(recipient, msg_id, msg).encode()  # ":" / "|" / line breaks in msg are escaped
+            pending_msg_ids.add(msg_id)  # The server's echo carries the seq (and is not shown twice)
+            client_socket.sendall(to_wire(payload))
 
             stamp = datetime.now().strftime('%H:%M')
             messages.append((msg_id, current_name, msg, stamp, recipient))
+            search_index.add(msg_id, current_name, recipient, msg)
             chat_messages.refresh()
 
             if text is not None: text.value = ''
@@ -586,6 +902,36 @@ async def build_chat_ui(request: Request) -> None:
         except Exception as e:
             ui.notify(f"Error sending: {e}", type='negative')
 
+    # Room selector: picking (or typing) a room joins it -->
+    def on_room_change(e):
+        room = str(e.value or '').strip()
+        if not room or room in my_rooms:
+            if room:
+                target.value = room
+            return
+        if not room.startswith(ROOM_PREFIX):
+            room = ROOM_PREFIX + room
+        if not valid_room(room):
+            ui.notify('Room names: letters, digits, "_" or "-" (up to 24)', type='warning', position='top')
+            room_select.value = None
+            return
+        try:
+            client_socket.sendall(to_wire(Protocol.JoinRoom(room).encode()))  # ACK ... JOINED adds it to my_rooms
+        except OSError:
+            ui.notify('Reconnecting to the server... try again in a moment.', type='warning')
+
+    # Leave the room that is selected -->
+    def leave_room():
+        room = room_select.value
+        if not room or room not in my_rooms:
+            return
+        try:
+            client_socket.sendall(to_wire(Protocol.PartRoom(room).encode()))
+        except OSError:
+            return
+        if target.value == room:
+            target.value = 'ALL'
+
     # The function for updating your username from the name_input slot in the footer -->
     def update_name():
         new_name = (name_input.value or '').strip() if name_input is not None else ''
@@ -615,7 +961,7 @@ async def build_chat_ui(request: Request) -> None:
 
         # If everything is clear we'll update the name and show a "Success" notification
         try:
-            cmd = f"CMD:NAME_CHANGE:{new_name}"
+            cmd = Protocol.NameChange(new_name).encode()
             client_socket.sendall((cmd + "\n").encode("utf-8"))
             name_dirty['flag'] = False
         except Exception as e:
@@ -652,44 +998,34 @@ async def build_chat_ui(request: Request) -> None:
     # --------------------------
     # 10) Disconnect handling
     # --------------------------
-    closing = {'done': False}   # Closed or Open flag
-
     # Send QUIT only if socket is still open -->
     def safe_send_quit():
         try:
             if client_socket is not None and client_socket.fileno() != -1:
-                client_socket.sendall(b"CMD:QUIT\n")
+                client_socket.sendall((Protocol.Quit().encode() + "\n").encode("utf-8"))
                 print(">>> CMD:QUIT SENT")
         except Exception as ex:
             print(">>> CMD:QUIT send failed:", ex)
 
-    # The function to handle the event of a client leaving the chat -->
-    def handle_disconnect():
+    # The function to handle the event of a client leaving the chat (async: never blocks the event loop) -->
+    async def handle_disconnect():
         if closing['done']: return
         closing['done'] = True
+        chat_disconnectors.discard(handle_disconnect)
 
         print(">>> STARTING CLEAN DISCONNECT HANDSHAKE")
 
-        # 1. Send the Quit command
+        # 1. Send the Quit command (a few bytes -> goes straight into the socket buffer)
         safe_send_quit()
 
-        # 2. Wait for the SERVER to close the connection (The Handshake)
-        # We try to read from the socket. If the server processes CMD:QUIT,
-        # it will close the socket, causing recv to return b'' (empty bytes).
+        # 2. Wait for the SERVER to close the connection (The Handshake).
+        # The listener thread sees recv() return b'' and resolves `server_closed`;
+        # we simply await it here, so other tabs keep running meanwhile.
         try:
-            client_socket.settimeout(2.0)  # Don't wait forever, 2s max
-            try:
-                while True:
-                    data = client_socket.recv(1024)
-                    if not data:
-                        print(">>> SERVER ACKNOWLEDGED DISCONNECT (Socket closed by server)")
-                        break
-            except socket.timeout:
-                print(">>> SERVER TIMEOUT (Force closing locally)")
-            except Exception as e:
-                print(f">>> Socket read error (Expected): {e}")
-        except Exception:
-            pass
+            await asyncio.wait_for(asyncio.shield(server_closed), 2.0)  # Don't wait forever, 2s max
+            print(">>> SERVER ACKNOWLEDGED DISCONNECT (Socket closed by server)")
+        except asyncio.TimeoutError:
+            print(">>> SERVER TIMEOUT (Force closing locally)")
 
         # 3. Now it is safe to close locally
         try:
@@ -697,21 +1033,20 @@ async def build_chat_ui(request: Request) -> None:
         except Exception:
             pass
 
+    chat_disconnectors.add(handle_disconnect)  # Lets the launcher close many sessions at once
+
     # immediate disconnections -->
     async def close_me_now():
         print(">>> close_me_now TRIGGERED")
 
-        # 1. Close the socket connection
+        # 1. Close the socket connection (QUIT + await the server's close, with a timeout)
         # We wrap this in a try-block to ensure it runs even if something else is wrong
         try:
-            handle_disconnect()
+            await handle_disconnect()
         except Exception as e:
             print(f"Error disconnecting: {e}")
 
-        # 2. Wait 0.5s to ensure the "CMD:QUIT" message leaves the computer
-        await asyncio.sleep(0.5)
-
-        # 3. Force the window to close
+        # 2. Force the window to close
         # We use a try/except block here.
         # It IS expected to fail with a TimeoutError because the window closes
         # before it can say "Goodbye" to Python. We just ignore that error.
@@ -725,7 +1060,7 @@ async def build_chat_ui(request: Request) -> None:
 
     # When the tab is closed: client has disconnected -->
     ui.context.client.on_disconnect(handle_disconnect)
-    ui.on('page_closing', lambda _e: handle_disconnect())   # Closing the socket as soon as thw window closed
+    ui.on('page_closing', lambda _e: handle_disconnect())   # Closing the socket as soon as thw window closed (runs as a task)
 
     await ui.context.client.connected()
     await ui.run_javascript('window.addEventListener("beforeunload", () => { emitEvent("page_closing", {}); });')
@@ -786,6 +1121,10 @@ async def build_chat_ui(request: Request) -> None:
                     .system-msg .q-message-stamp { color: #ffffff !important; opacity: 0.9; }
 
                     .system-msg .q-message-name { color: #ffffff !important; font-size: 0.75rem !important; opacity: 0.7; }
+
+                    /* Search: matched words + the result we jumped to */
+                    mark { background: #fde047; color: black; border-radius: 3px; padding: 0 2px; }
+                    .search-hit .q-message-text { box-shadow: 0 0 0 3px #fde047 !important; }
                 </style>
                 ''')
 
@@ -819,6 +1158,12 @@ async def build_chat_ui(request: Request) -> None:
             .classes('text-white w-7 h-7 p-0 min-w-0 text-lg '
                      'transition-transform duration-150 hover:scale-110') \
             .tooltip('Open Launcher')
+        # The search box: Enter searches, the x clears the highlights -->
+        search_input = ui.input(placeholder='Search') \
+            .props('dense borderless clearable dark input-style="color: white"') \
+            .classes('w-36') \
+            .on('keydown.enter', run_search) \
+            .on('clear', clear_search)
 
     # A button for auto-scrolling when you have new messages (hidden at first) -->
     with ui.button(on_click=scroll_to_bottom_and_reset) \
@@ -862,6 +1207,13 @@ async def build_chat_ui(request: Request) -> None:
                 .props('dense outlined dark color=white popup-content-class="bg-red-750 text-white"') \
                 .classes('w-32')
 
+            # The room selector: join a room (type a new name to create it), the icon leaves it -->
+            room_select = ui.select(options=[], label='Room', with_input=True, new_value_mode='add-unique',
+                                    on_change=on_room_change) \
+                .props('dense outlined dark color=white popup-content-class="bg-red-750 text-white"') \
+                .classes('w-28')
+            ui.button(icon='logout', on_click=leave_room).props('flat dense round color=white').tooltip('Leave room')
+
             # The send button -->
             ui.button(icon='send', on_click=send) \
                 .props('flat') \
@@ -0,0 +1,81 @@
+"""Time source of the server: the real clock, or a virtual one that only moves when told to (Sim_Net)"""
+
+import heapq
+import itertools
+import threading
+import time
+from typing import Callable
+
+
+class RealClock:
+    """Wall clock + one long-lived timer thread.
+
+    call_later only puts the timer into a heap; the "clock-timers" thread (started by the first call) sleeps
+    until the earliest one is due and runs it. No thread per timer: the timer wheel re-arms its tick here
+    forever. Callbacks run one after another on that thread, so they must be short (the wheel's tick is).
+    """
+
+    def __init__(self):
+        self.timers = []    # heap of (due, n, fn, args)
+        self.order = itertools.count()
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def time(self) -> float:
+        return time.time()
+
+    def monotonic(self) -> float:
+        return time.monotonic()
+
+    def call_later(self, delay: float, fn: Callable, *args) -> None:
+        with self.cond:
+            heapq.heappush(self.timers, (time.monotonic() + delay, next(self.order), fn, args))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="clock-timers", daemon=True)
+                self.thread.start()
+            self.cond.notify()
+
+    def _run(self) -> None:
+        while True:
+            with self.cond:
+                while not self.timers:
+                    self.cond.wait()
+                wait = self.timers[0][0] - time.monotonic()
+                if wait > 0:
+                    self.cond.wait(wait)
+                    continue
+                _due, _n, fn, args = heapq.heappop(self.timers)
+            try:
+                fn(*args)
+            except Exception:   # A broken callback must not stop every later timer
+                pass
+
+
+class VirtualClock:
+    """Starts at `start` and moves only on advance(); timers run inside advance(), in time order.
+
+    Monotonic and wall time are the same number here (the default start looks like a unix time).
+    """
+
+    def __init__(self, start: float = 1e9):
+        self.now = float(start)
+        self.timers = []    # heap of (due, n, fn, args)
+        self.order = itertools.count()
+
+    def time(self) -> float:
+        return self.now
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def call_later(self, delay: float, fn: Callable, *args) -> None:
+        heapq.heappush(self.timers, (self.now + delay, next(self.order), fn, args))
+
+    # Move forward by `seconds`, running every timer that falls due on the way -->
+    def advance(self, seconds: float) -> None:
+        until = self.now + seconds
+        while self.timers and self.timers[0][0] <= until:
+            due, _, fn, args = heapq.heappop(self.timers)
+            self.now = max(self.now, due)
+            fn(*args)
+        self.now = until
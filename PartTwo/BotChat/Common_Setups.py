@@ -7,10 +7,134 @@
 SERVER_IP = '10.0.0.16'     # Localhost
 SERVER_PORT = 8081          # TCP port used by the server
 
+# Finding the server: BOTCHAT_SERVER=host[:port] (env) > SERVER_IP > LAN discovery (UDP broadcast) -->
+DISCOVERY_ENABLED = True                    # Clients ask the LAN when SERVER_IP does not answer ("auto" = always ask)
+DISCOVERY_PORT = 8082                       # UDP port the server answers discovery probes on
+DISCOVERY_TIMEOUT_SEC = 0.5                 # How long a client waits for an answer
+POOL_SPARES = 1                             # Connected sockets kept warm per client process (next tab / reconnect)
+POOL_MAX_IDLE_SEC = 20.0                    # Warm sockets older than this are replaced (below FIRST_LINE_TIMEOUT_SEC)
+
+# ======================================
+# ===== Server Protection (Limits) ====
+# ======================================
+# Token buckets checked for every line a client sends (0 = unlimited) -->
+RATE_LIMIT_CONN_MSGS_PER_SEC = 20           # Per connection: messages / second
+RATE_LIMIT_CONN_BYTES_PER_SEC = 64 * 1024   # Per connection: bytes / second
+RATE_LIMIT_GLOBAL_MSGS_PER_SEC = 2000       # Whole server: messages / second
+RATE_LIMIT_GLOBAL_BYTES_PER_SEC = 4 * 1024 * 1024   # Whole server: bytes / second
+RATE_LIMIT_BURST_SECONDS = 2.0              # Bucket size = rate * this (short bursts are fine)
+RATE_LIMIT_ACTION = "error"                 # delay / drop / error (ERR ... RATE_LIMITED) / disconnect
+FIRST_LINE_TIMEOUT_SEC = 30.0               # A connection that sends no first line (name / resume / peer hello) is closed
+
+# Graceful drain (SIGTERM) and hot restart (SIGHUP) -->
+DRAIN_TIMEOUT_SEC = 5.0                     # Max time to wait for clients to leave before force closing
+DRAIN_RECONNECT_MIN_MS = 500                # RECONNECT hint: clients wait a random delay in [min, max]
+DRAIN_RECONNECT_MAX_MS = 5000               # (spreads the reconnect herd after a restart)
+
+# Outbound micro-batching (opt-in): gather each connection's lines and flush them with one writev -->
+SEND_BATCH_WINDOW_MS = 0.0                  # 0 = off (one send per line); e.g. 2.0 for busy servers
+SEND_BATCH_MAX_BYTES = 16 * 1024            # Flush a connection early once this much is waiting
+SEND_BATCH_MAX_QUEUED_BYTES = 4 * 1024 * 1024   # A client that stops reading is dropped once this much waits for it
+
+# Server transport: a handler thread per client, or every client on one event-loop thread (Main_Server --transport) -->
+SERVER_TRANSPORT = "threads"                # threads / loop (no thread stack per connection: a few KB per idle client)
+LOOP_MAX_QUEUED_BYTES = 4 * 1024 * 1024     # Event loop: a client that stops reading is dropped once this much waits for it
+
+# Heartbeats: a quiet client gets a PING, no line back in time -> the connection is dead (sleeping laptop, NAT timeout) -->
+HEARTBEAT_IDLE_SEC = 30.0                   # Silence before the server sends a PING (0 = off; Main_Server --heartbeat-sec)
+HEARTBEAT_TIMEOUT_SEC = 10.0                # No line within this long after the PING -> evicted (LEAVE to everyone)
+TIMER_WHEEL_TICK_SEC = 1.0                  # Server timers (heartbeats, resume grace) share one timer wheel of this resolution
+TIMER_WHEEL_SLOTS = 512                     # Ticks per turn of the wheel (later timers wait extra turns)
+
+# Protocol lines (Protocol: one codec for every line, fields escaped) -->
+PROTOCOL_MAX_LINE_BYTES = 256 * 1024        # Longer lines are not decoded; a client that sends one is disconnected
+
+# Compression (negotiated per connection: CMD:CAPS:zlib) -->
+COMPRESSION_ENABLED = True                  # Chat windows / launcher offer it to the server
+COMPRESS_MIN_BYTES = 256                    # Shorter lines are sent as they are
+COMPRESS_LEVEL = 6                          # zlib level (1 = fastest ... 9 = smallest)
+COMPRESS_MAX_DECODED_BYTES = 4 * 1024 * 1024  # Refuse compressed lines that inflate beyond this
+
+# Reconnect + session resume -->
+RECONNECT_BASE_SEC = 0.5                    # First retry delay (doubles on every failure, with jitter)
+RECONNECT_MAX_SEC = 30.0                    # Retry delay never grows above this
+RESUME_GRACE_SEC = 60.0                     # A dropped user keeps its name/session this long (no "left" message)
+SERVER_HISTORY_SIZE = 500                   # Recent MSG lines kept by the server for replay on resume
+RESUME_STATE_FILE = ".botchat_sessions.json"  # Sessions + history handed to the successor on hot restart
+GAP_FETCH_DELAY_SEC = 0.5                   # Client waits this long for a reordered MSG before asking for the gap
+IDEMPOTENCY_WINDOW = 4096                   # Recent (sender, msg_id) pairs the server remembers (resends are not duplicated)
+
+# Server log: JSON lines written by a background thread (Server_Log), also echoed to stdout -->
+LOG_FILE = ".botchat_server.log"            # Next to the code (BOTCHAT_LOG_FILE overrides, "-" = no file)
+LOG_LEVEL = "info"                          # debug / info / warning / error / off (Main_Server --log-level)
+LOG_ECHO = True                             # Also print the human readable text (manual runs)
+LOG_FLUSH_SEC = 0.2                         # The writer wakes up this often and writes everything waiting
+LOG_MAX_PENDING = 100_000                   # Records waiting for the writer; more are dropped (never block)
+LOG_MAX_BYTES = 10 * 1024 * 1024            # Rotate the file at this size ...
+LOG_BACKUPS = 3                             # ... keeping this many old files (.1 = newest)
+LOG_SAMPLE_EVERY = {"msg": 100}             # High volume events: keep one record in N
+
+# Profiling a running server (admin: CMD:PROFILE:<BOTCHAT_ADMIN_TOKEN>:<seconds>, or SIGUSR1) -->
+PROFILE_DIR = ".botchat_profiles"           # <name>.collapsed (flamegraph input) + <name>.top.txt, next to the code
+PROFILE_DEFAULT_SEC = 10.0                  # Length of a profile (SIGUSR1, or no seconds given)
+PROFILE_MAX_SEC = 120.0
+PROFILE_INTERVAL_SEC = 0.005                # Time between samples (200 per second) ...
+PROFILE_MAX_OVERHEAD = 0.02                 # ... stretched so sampling never takes more than 2% of the time
+PROFILE_TOP_N = 25                          # Functions listed in the summary
+
+# Mailboxes: private messages to an offline name wait on the server's disk until it connects -->
+MAILBOX_ENABLED = True
+MAILBOX_DIR = ".botchat_mailboxes"          # One append-only file per recipient, next to the code
+MAILBOX_MAX_PER_USER = 1000                 # A full mailbox rejects new messages (ERR MAILBOX_FULL)
+MAILBOX_TTL_SEC = 7 * 24 * 3600.0           # Older messages are dropped, never delivered
+MAILBOX_SWEEP_SEC = 600.0                   # How often expired mailboxes are deleted (+ MAILBOX_STATS logged)
+
+# Avatars: stored once per content hash on the server, AVATAR lines carry only the hash -->
+AVATAR_STORE_MAX = 1024                     # Avatars the server keeps (unused ones are dropped first)
+AVATAR_MAX_BYTES = 32 * 1024                # Largest avatar URL / data URL the server accepts
+
+# Federation: several servers linked into one chat (Main_Server --node-id / --peers) -->
+PEER_RECONNECT_BASE_SEC = 0.5               # Retry delay for a lost peer link (doubles up to the max)
+PEER_RECONNECT_MAX_SEC = 10.0
+
+# Rooms: targets that start with "#" (only members receive their messages) -->
+ROOM_PREFIX = "#"
+ROOM_NAME_MAX = 24                          # Characters after the "#"
+
+def is_room(name: str) -> bool:
+    return str(name).startswith(ROOM_PREFIX)
+
+# "#" + letters / digits / "_" / "-" (no "|", ":" or "," - they separate protocol fields) -->
+def valid_room(name: str) -> bool:
+    body = str(name)[len(ROOM_PREFIX):]
+    return is_room(name) and 0 < len(body) <= ROOM_NAME_MAX and all(c.isalnum() or c in "_-" for c in body)
+
+# Message channels: every MSG gets a seq number from the server, counted per channel -->
+# "ALL" for the public chat, "#room" for a room, "DM:<a>\n<b>" (names sorted) for a private conversation.
+def channel_of(sender: str, target: str) -> str:
+    if str(target).upper() == "ALL":
+        return "ALL"
+    if is_room(target):
+        return target
+    a, b = sorted((sender, target))
+    return f"DM:{a}\n{b}"
+
 # ================================
 # ===== UI / Client Settings ====
 # ================================
 CHAT_UI_PORT = 8080         # Port where NiceGUI client runs
+UI_READY_TIMEOUT_SEC = 15.0                 # Run_App opens the launcher once the UI server answers (at most this long)
+PREWARM_CHAT_UI = True                      # Import the chat page in the background after the launcher opened
+
+# Client state persistence (messages, avatars, colors survive a restart of Run_App.py) -->
+CLIENT_STATE_ENABLED = True
+CLIENT_STATE_DB = ".botchat_client_state.db"   # SQLite file (WAL) next to the code
+CLIENT_STATE_LOAD_RECENT = 500              # Messages loaded at startup (and per "load older" page)
+CLIENT_STATE_FLUSH_MS = 200                 # Writes are gathered this long and committed together
+
+# Search (inverted index over the stored history, built in the background at startup) -->
+SEARCH_RESULTS_MAX = 50                     # Newest matches shown per query
+SEARCH_INDEX_BATCH = 5000                   # Stored messages read + indexed per step at startup
 
 # ================================
 # ===== Paths / Executables =====
@@ -0,0 +1,62 @@
+"""Optional compression of protocol lines (zlib/deflate + shared dictionary, negotiated per connection)"""
+
+import base64
+import binascii
+import zlib
+from functools import lru_cache
+
+from Common_Setups import COMPRESS_MIN_BYTES, COMPRESS_LEVEL, COMPRESS_MAX_DECODED_BYTES
+
+# Negotiation: the client sends CMD:CAPS:zlib, the server answers ACK|System|<who>|CAPS|zlib -->
+CAPABILITY = "zlib"
+PREFIX = "Z|"   # A compressed line: Z|<base64 of raw deflate> (may hold several protocol lines)
+
+# Shared dictionary: strings that show up in almost every line. Deflate can point back into it,
+# so even a single message compresses well. Most frequent tokens go last (shortest distances).
+ZDICT = (
+    "https://api.dicebear.com/7.x/bottts/svg?seed="
+    "data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAA"
+    "data:image/svg+xml;base64,PHN2ZyB4bWxucz0iaHR0cDovL3d3dy53My5vcmcvMjAwMC9zdmciIH"
+    "https://api.dicebear.com/7.x/adventurer/svg?seed=&backgroundColor="
+    " has changed the user_name to-> "
+    " -> has disconnected"
+    " -> has joined the chat"
+    "ACK|System|RENAME|AVATAR|ERR|System|"
+    "USERS|System|ALL|,"
+    "MSG|System|ALL|"
+    "MSG|"
+).encode("utf-8")
+
+_WBITS = -15    # Raw deflate: no zlib header/checksum (TCP already checks the bytes)
+
+
+def compress(data: bytes) -> bytes:
+    c = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, _WBITS, 9, zlib.Z_DEFAULT_STRATEGY, ZDICT)
+    return c.compress(data) + c.flush()
+
+
+def decompress(data: bytes) -> bytes:
+    d = zlib.decompressobj(_WBITS, ZDICT)
+    out = d.decompress(data, COMPRESS_MAX_DECODED_BYTES)
+    if d.unconsumed_tail:  # Would grow past the limit (zip bomb / broken peer)
+        raise ValueError("compressed line too large")
+    return out
+
+
+# The line to put on the wire: compressed only above the threshold and only if it got smaller -->
+# Cached: a broadcast sends the same line to every connection, so it is compressed once.
+@lru_cache(maxsize=64)
+def encode_line(line: str) -> str:
+    if len(line) < COMPRESS_MIN_BYTES:
+        return line
+    packed = PREFIX + base64.b64encode(compress(line.encode("utf-8"))).decode("ascii")
+    return packed if len(packed) < len(line) else line
+
+
+# Back to the original text (may contain several lines separated by \n). Raises ValueError if broken -->
+def decode_line(line: str) -> str:
+    try:
+        raw = base64.b64decode(line[len(PREFIX):], validate=True)
+        return decompress(raw).decode("utf-8", errors="replace")
+    except (binascii.Error, zlib.error) as e:
+        raise ValueError(f"bad compressed line: {e}") from e
@@ -0,0 +1,199 @@
+"""Client side connections to the chat server: finding it (config / env / LAN discovery) + a pool of warm sockets"""
+
+import os
+import select
+import socket
+import threading
+import time
+from typing import List, Optional, Tuple
+
+from Common_Setups import (
+    SERVER_IP, SERVER_PORT, DISCOVERY_ENABLED, DISCOVERY_PORT, DISCOVERY_TIMEOUT_SEC,
+    POOL_SPARES, POOL_MAX_IDLE_SEC,
+)
+
+SERVER_ENV = "BOTCHAT_SERVER"       # host[:port] -> always use this address (no discovery)
+
+# Discovery: a UDP broadcast answered by every server on the LAN (Main_Server.start_discovery_responder) -->
+DISCOVERY_PROBE = b"BOTCHAT_DISCOVER"
+DISCOVERY_REPLY = "BOTCHAT_SERVER"  # Answer: BOTCHAT_SERVER|<tcp port>
+
+Address = Tuple[str, int]
+
+
+# "host", "host:port" -> (host, port) -->
+def parse_address(text: str, default_port: int = SERVER_PORT) -> Address:
+    host, sep, port = text.strip().rpartition(":")
+    if not sep:
+        return text.strip(), default_port
+    return host, int(port)
+
+
+# Ask the LAN (and this machine) where a server is. Returns the first answer, or None -->
+def discover(timeout: float = DISCOVERY_TIMEOUT_SEC) -> Optional[Address]:
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        for target in ("<broadcast>", "127.0.0.1"):
+            try:
+                s.sendto(DISCOVERY_PROBE, (target, DISCOVERY_PORT))
+            except OSError:
+                pass  # No broadcast route (offline laptop) -> localhost still works
+        deadline = time.monotonic() + timeout
+        while True:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                return None
+            s.settimeout(left)
+            try:
+                data, (host, _port) = s.recvfrom(256)
+            except OSError:
+                return None
+            kind, _, port = data.decode("utf-8", errors="replace").partition("|")
+            if kind == DISCOVERY_REPLY and port.strip().isdigit():
+                return host, int(port)
+
+
+# Health check without sending anything: a closed peer shows up as readable with 0 bytes -->
+def is_alive(sock: socket.socket) -> bool:
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        if not readable:
+            return True                 # Idle and open
+        return sock.recv(1, socket.MSG_PEEK) != b""   # Readable: data (alive) or EOF (dead)
+    except (OSError, ValueError):
+        return False
+
+
+class ConnectionManager:
+    """Where the server is + a few connected (not yet introduced) sockets kept warm for the next user.
+
+    The protocol is one user per TCP connection, so sockets are handed out, not shared: the launcher
+    probe, the launcher observer and every chat tab take a warm socket (no connect round trip) and
+    the pool refills itself in the background.
+    """
+
+    def __init__(self, spares: int = POOL_SPARES, max_idle: float = POOL_MAX_IDLE_SEC):
+        self.spares_wanted = spares
+        self.max_idle = max_idle
+        self.spares: List[Tuple[socket.socket, Address, float]] = []   # (socket, address, connected at)
+        self.lock = threading.Lock()
+        self.refilling = False
+        self.current: Optional[Address] = None  # Last address that accepted a connection
+        self.stats = {"connects": 0, "reused": 0, "discovered": 0, "dead_spares": 0}
+
+    # ----- Address -----
+    # Addresses to try, best first. Discovery only runs if none of the known ones answered -->
+    def candidates(self) -> List[Address]:
+        override = os.environ.get(SERVER_ENV)
+        if override:
+            return [parse_address(override)]
+        found = [self.current] if self.current else []
+        if SERVER_IP and SERVER_IP != "auto":
+            found.append((SERVER_IP, SERVER_PORT))
+        return list(dict.fromkeys(found))
+
+    def _connect(self, timeout: float, allow_discovery: bool = True) -> Tuple[socket.socket, Address]:
+        error: Optional[OSError] = None
+        tried = self.candidates()
+        may_discover = allow_discovery and DISCOVERY_ENABLED and not os.environ.get(SERVER_ENV)
+        for address in tried:
+            try:  # A stale address should not hold up discovery for long
+                return self._open(address, min(timeout, 1.0) if may_discover else timeout), address
+            except OSError as e:
+                error = e
+        if may_discover:
+            address = discover()
+            if address is not None and address not in tried:
+                sock = self._open(address, timeout)     # Raises like a normal connect
+                print(f"Chat server found at {address[0]}:{address[1]} (discovery)")
+                self.stats["discovered"] += 1
+                return sock, address
+        raise error or OSError("Chat server not found")
+
+    def _open(self, address: Address, timeout: float) -> socket.socket:
+        sock = socket.create_connection(address, timeout=timeout)
+        sock.settimeout(None)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.stats["connects"] += 1
+        if address != self.current:
+            self.current = address
+            self._drop_spares(keep=address)     # Spares to an old address are useless now
+        return sock
+
+    # ----- Pool -----
+    def _drop_spares(self, keep: Optional[Address] = None) -> None:
+        with self.lock:
+            old = [s for s, address, _t in self.spares if address != keep]
+            self.spares = [entry for entry in self.spares if entry[1] == keep]
+        for sock in old:
+            try: sock.close()
+            except OSError: pass
+
+    # A healthy warm socket, or None -->
+    def _take_spare(self) -> Optional[socket.socket]:
+        now = time.monotonic()
+        while True:
+            with self.lock:
+                if not self.spares:
+                    return None
+                sock, address, born = self.spares.pop()
+            if address == self.current and now - born < self.max_idle and is_alive(sock):
+                self.stats["reused"] += 1
+                return sock
+            self.stats["dead_spares"] += 1
+            try: sock.close()
+            except OSError: pass
+
+    def _refill_later(self) -> None:
+        with self.lock:
+            if self.refilling or len(self.spares) >= self.spares_wanted:
+                return
+            self.refilling = True
+        threading.Thread(target=self._refill, name="connection-pool-refill", daemon=True).start()
+
+    def _refill(self) -> None:
+        try:
+            while True:
+                with self.lock:
+                    if len(self.spares) >= self.spares_wanted:
+                        return
+                try:
+                    sock, address = self._connect(timeout=2.0)
+                except OSError:
+                    return  # Server is down: the next connect() finds out (and tries discovery) itself
+                with self.lock:
+                    self.spares.append((sock, address, time.monotonic()))
+        finally:
+            with self.lock:
+                self.refilling = False
+
+    # ----- Public -----
+    # A connected socket (blocking) for one new user/observer. Raises OSError if no server is reachable -->
+    def connect(self, timeout: float = 5.0) -> socket.socket:
+        sock = self._take_spare()
+        if sock is None:
+            sock, _address = self._connect(timeout)
+        self._refill_later()
+        return sock
+
+    # Launcher probe: answered from the pool when possible (no new connection every poll) -->
+    def server_is_up(self, timeout: float = 0.25) -> bool:
+        with self.lock:
+            spares = list(self.spares)
+        if any(address == self.current and is_alive(sock) for sock, address, _t in spares):
+            return True
+        self._drop_spares()     # All dead -> the server went away (or moved)
+        try:
+            sock, address = self._connect(timeout, allow_discovery=False)  # Polled by the launcher: keep it short
+        except OSError:
+            return False
+        with self.lock:
+            self.spares.append((sock, address, time.monotonic()))   # The probe becomes the next spare
+        return True
+
+    def close(self) -> None:
+        self._drop_spares()
+
+
+# One manager per client process (launcher + all chat tabs share it) -->
+connections = ConnectionManager()
@@ -0,0 +1,198 @@
+"""Event-loop transport: every client socket on one thread (selectors), no thread stack per connection"""
+
+import heapq
+import itertools
+import selectors
+import socket
+import threading
+import time
+from typing import Callable, List
+
+from Outbox import QueuedSocket
+
+READ = selectors.EVENT_READ
+READ_WRITE = selectors.EVENT_READ | selectors.EVENT_WRITE
+
+
+class EventLoop:
+    """Readiness of every client socket in one selector, handled on one thread.
+
+    add(conn) hands over an accepted connection (from any thread); conn.sock is a QueuedSocket made by wrap().
+    Whatever arrives goes to on_data(conn, data): True keeps the connection, False closes it (then on_close(conn)
+    runs), None means on_data gave the socket to somebody else (detach). Writes go through each QueuedSocket:
+    what the kernel does not take at once is sent from here when the socket is writable again.
+    Nothing that runs on this thread may block - one slow call stalls every client: blocking work goes to another
+    thread, which hands its result back with call_soon(); call_later() timers run here (the select timeout).
+    pause(conn, seconds) stops reading one connection for a while (rate limit backpressure without sleeping).
+    """
+
+    def __init__(self, on_data: Callable, on_close: Callable, max_queued: int, recv_bytes: int = 4096):
+        self.on_data = on_data
+        self.on_close = on_close
+        self.max_queued = max_queued
+        self.recv_bytes = recv_bytes
+        self.sel = selectors.DefaultSelector()
+        self.wake_r, self.wake_w = socket.socketpair()     # Other threads poke the select() awake through this
+        self.wake_r.setblocking(False)
+        self.wake_w.setblocking(False)
+        self.sel.register(self.wake_r, READ, None)
+        self.lock = threading.Lock()
+        self.incoming: List = []        # Connections to register (added by the accept thread)
+        self.writers: List[QueuedSocket] = []  # Sockets that started queueing (write interest to turn on)
+        self.timers: List = []          # heap of (due, n, fn, args): call_soon / call_later, run on this thread
+        self.order = itertools.count()
+        self.stopped = False
+        self.thread = threading.Thread(target=self._run, name="event-loop", daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopped = True
+        self._wake()
+        self.thread.join(2.0)
+
+    def wrap(self, sock: socket.socket) -> QueuedSocket:
+        return QueuedSocket(sock, self._want_write, self.max_queued)
+
+    def add(self, conn) -> None:
+        with self.lock:
+            self.incoming.append(conn)
+        self._wake()
+
+    # Stop watching a connection and give its socket back in blocking mode (on the loop thread, from on_data) -->
+    def detach(self, conn) -> socket.socket:
+        self.sel.unregister(conn.sock)
+        conn.sock.sock.setblocking(True)
+        return conn.sock.sock
+
+    # Run fn(*args) on the loop thread (from any thread) -->
+    def call_soon(self, fn: Callable, *args) -> None:
+        self.call_later(0.0, fn, *args)
+
+    def call_later(self, delay: float, fn: Callable, *args) -> None:
+        with self.lock:
+            heapq.heappush(self.timers, (time.monotonic() + delay, next(self.order), fn, args))
+        self._wake()
+
+    # Read nothing from this connection for `seconds` (on the loop thread, from on_data). Its queued writes wait
+    # too; afterwards on_data(conn, b"") runs, so lines it already sent are handled before anything new is read -->
+    def pause(self, conn, seconds: float) -> None:
+        try:
+            self.sel.unregister(conn.sock)
+        except (KeyError, ValueError):
+            return
+        self.call_later(seconds, self._unpause, conn)
+
+    def _unpause(self, conn) -> None:
+        qsock = conn.sock
+        try:
+            self.sel.register(qsock, READ_WRITE if qsock.queued else READ, conn)
+        except (OSError, ValueError):   # Closed meanwhile (e.g. a drain)
+            self.on_close(conn)
+            return
+        self._deliver(qsock, conn, b"")
+
+    def _want_write(self, qsock: QueuedSocket) -> None:
+        with self.lock:
+            self.writers.append(qsock)
+        self._wake()
+
+    def _wake(self) -> None:
+        try:
+            self.wake_w.send(b"\0")
+        except (BlockingIOError, OSError):  # Full: the loop is awake anyway
+            pass
+
+    def _run(self) -> None:
+        while not self.stopped:
+            for key, events in self.sel.select(timeout=self._timeout()):
+                conn = key.data
+                if conn is None:
+                    try:
+                        while self.wake_r.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+                if events & selectors.EVENT_WRITE and not self._write(key.fileobj, conn):
+                    continue
+                if events & READ:
+                    self._read(key.fileobj, conn)
+            self._take_pending()
+            self._run_timers()
+
+    # Until the next timer (at most 0.5 s: the loop notices stop() in time) -->
+    def _timeout(self) -> float:
+        with self.lock:
+            if not self.timers:
+                return 0.5
+            return min(0.5, max(0.0, self.timers[0][0] - time.monotonic()))
+
+    def _run_timers(self) -> None:
+        now = time.monotonic()
+        due = []
+        with self.lock:
+            while self.timers and self.timers[0][0] <= now:
+                due.append(heapq.heappop(self.timers))
+        for _due, _n, fn, args in due:
+            try:
+                fn(*args)
+            except Exception:   # Same rule as on_data: one broken callback must not stop the loop
+                pass
+
+    # New connections + sockets with queued bytes (the selector is only touched on this thread) -->
+    def _take_pending(self) -> None:
+        with self.lock:
+            incoming, self.incoming = self.incoming, []
+            writers, self.writers = self.writers, []
+        for conn in incoming:
+            try:
+                self.sel.register(conn.sock, READ, conn)
+            except (OSError, ValueError):   # Closed before we got to it (e.g. a drain)
+                self.on_close(conn)
+        for qsock in writers:
+            try:
+                key = self.sel.get_key(qsock)
+            except (KeyError, ValueError):  # Closed / detached meanwhile
+                continue
+            if key.events != READ_WRITE:
+                self.sel.modify(qsock, READ_WRITE, key.data)
+
+    def _read(self, qsock: QueuedSocket, conn) -> None:
+        try:
+            data = qsock.sock.recv(self.recv_bytes)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self._close(qsock, conn)
+            return
+        self._deliver(qsock, conn, data)
+
+    def _deliver(self, qsock: QueuedSocket, conn, data: bytes) -> None:
+        try:
+            keep = self.on_data(conn, data)
+        except Exception:   # on_data handles its own errors; the loop must never die for one client
+            keep = False
+        if keep is False:
+            self._close(qsock, conn)
+
+    # Writable: send what waits. False -> the connection is gone -->
+    def _write(self, qsock: QueuedSocket, conn) -> bool:
+        try:
+            done = qsock.flush()
+        except OSError:
+            self._close(qsock, conn)
+            return False
+        if done:
+            self.sel.modify(qsock, READ, conn)
+        return True
+
+    def _close(self, qsock: QueuedSocket, conn) -> None:
+        try:
+            self.sel.unregister(qsock)
+        except (KeyError, ValueError):
+            pass
+        self.on_close(conn)
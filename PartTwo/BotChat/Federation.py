@@ -0,0 +1,319 @@
+"""Several servers, one chat: peer links between Main_Server nodes (roster gossip + message forwarding)"""
+
+import hmac
+import socket
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from Backoff import ExponentialBackoff
+from Common_Setups import PEER_RECONNECT_BASE_SEC, PEER_RECONNECT_MAX_SEC
+import Protocol
+import Server_Log
+
+PEER_HELLO = "CMD:PEER:"    # First line of a peer link: CMD:PEER:<node id of the dialing server>:<secret>
+PEER_SECRET_ENV = "BOTCHAT_PEER_SECRET"     # Shared by every node of the cluster; unset -> no federation
+
+# Lines on a peer link (node -> node), never sent to users (Protocol.PEER_FRAMES, fields escaped) -->
+# PEER|<node>|<secret>                         answer to the hello
+# ROSTER|<node>|name1,name2                    every name the node holds (sent when the link comes up)
+# JOINED|<node>|<name> / LEFT|<node>|<name>    roster changes
+# FWD|<target>|<sender>|<msg_id>|<text>        a chat message (target: ALL, #room or a user of the receiving node)
+# AVATAR|<name>|<url>                          a user of the sending node picked an avatar
+# RAW|<line>                                   a line for every user of the receiving node (e.g. RENAME)
+
+
+class PeerLink:
+    """One TCP connection to another node. `initiator` is the node that dialed it."""
+
+    def __init__(self, sock: socket.socket, node: str, initiator: str):
+        self.sock = sock
+        self.node = node
+        self.initiator = initiator
+        self.send_lock = threading.Lock()
+        self.closed = False
+
+    def send(self, line: str) -> bool:
+        try:
+            with self.send_lock:
+                self.sock.sendall((line + "\n").encode("utf-8"))
+            return True
+        except OSError:
+            self.close()
+            return False
+
+    def close(self) -> None:
+        self.closed = True
+        try: self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError: pass
+
+
+class Cluster:
+    """This node's view of the cluster (full mesh: every node links to every other node).
+
+    Only configured peers get a link: a hello must name a node of `peers` and carry the cluster's `secret`
+    (and so must the answer to ours). What a peer says about names is taken for its own node only.
+
+    The server passes its hooks in; Federation never imports Main_Server:
+      local_names()                      names held here (online + parked)
+      local_avatars()                    (name, avatar URL) of our users that picked one
+      deliver(target, sender, id, text)  publish a forwarded message to our own users
+      roster_changed()                   the cluster's user list changed (-> USERS)
+      name_conflict(name)                a peer holds a name we hold too, and the peer wins
+      avatar_changed(name, url)          a remote user picked an avatar
+      raw(line)                          send a line to all our users
+    """
+
+    def __init__(self, node_id: str, peers: List[str], local_names: Callable[[], List[str]],
+                 local_avatars: Callable[[], List[Tuple[str, str]]],
+                 deliver: Callable[[str, str, str, str], None], roster_changed: Callable[[], None],
+                 name_conflict: Callable[[str], None], avatar_changed: Callable[[str, str], None],
+                 raw: Callable[[str], None], secret: str):
+        self.node_id = node_id
+        self.secret = secret
+        self.peers = [p for p in peers if p and p != node_id]
+        self.local_names = local_names
+        self.local_avatars = local_avatars
+        self.deliver = deliver
+        self.roster_changed = roster_changed
+        self.name_conflict = name_conflict
+        self.avatar_changed = avatar_changed
+        self.raw = raw
+        self.lock = threading.Lock()
+        self.links: Dict[str, PeerLink] = {}    # node -> live link
+        self.remote: Dict[str, str] = {}        # name -> node that holds it
+        self.remote_avatars: Dict[str, str] = {}  # remote name -> avatar URL (for late joiners here)
+        self.stopping = False
+        # Lines sent: user messages to every node / to one node, System announcements, roster + avatars -->
+        self.stats = {"to_all": 0, "to_one": 0, "system": 0, "roster": 0, "received": 0, "links_up": 0,
+                      "rejected": 0, "dropped": 0}
+
+    # ----- Roster -----
+    def owner_of(self, name: str) -> Optional[str]:
+        with self.lock:
+            return self.remote.get(name)
+
+    def remote_names(self) -> List[str]:
+        with self.lock:
+            return list(self.remote)
+
+    def remote_avatar_urls(self) -> Dict[str, str]:
+        with self.lock:
+            return dict(self.remote_avatars)
+
+    def local_joined(self, name: str) -> None:
+        self._to_all(Protocol.PeerJoined(self.node_id, name).encode())
+
+    def local_left(self, name: str) -> None:
+        self._to_all(Protocol.PeerLeft(self.node_id, name).encode())
+
+    # ----- Forwarding (never re-forwarded by the receiver: full mesh, no loops) -----
+    # ALL / #room: once per node, not once per user -->
+    def forward_all(self, target: str, sender: str, msg_id: str, text: str) -> None:
+        self._to_all(Protocol.Forward(target, sender, msg_id, text).encode(), "system" if sender == "System" else "to_all")
+
+    # A private message: only to the node that holds the target. False if nobody does -->
+    def forward_to_owner(self, target: str, sender: str, msg_id: str, text: str) -> bool:
+        node = self.owner_of(target)
+        with self.lock:
+            link = self.links.get(node) if node else None
+        if link is None:
+            return False
+        self.stats["to_one"] += 1
+        return link.send(Protocol.Forward(target, sender, msg_id, text).encode())
+
+    def forward_avatar(self, name: str, url: str) -> None:
+        self._to_all(Protocol.PeerAvatar(name, url).encode())
+
+    def forward_raw(self, line: str) -> None:
+        self._to_all(Protocol.Raw(line).encode())
+
+    def _to_all(self, line: str, kind: str = "roster") -> None:
+        with self.lock:
+            links = list(self.links.values())
+        for link in links:
+            if link.send(line):
+                self.stats[kind] += 1
+
+    # ----- Links -----
+    def start(self) -> None:
+        for address in self.peers:
+            threading.Thread(target=self._dial_loop, args=(address,), name=f"peer-{address}", daemon=True).start()
+
+    def stop(self) -> None:
+        self.stopping = True
+        with self.lock:
+            links = list(self.links.values())
+        for link in links:
+            link.close()
+
+    # Keep a link to one configured peer (node id == its "host:port") -->
+    def _dial_loop(self, address: str) -> None:
+        backoff = ExponentialBackoff(PEER_RECONNECT_BASE_SEC, PEER_RECONNECT_MAX_SEC)
+        host, _, port = address.rpartition(":")
+        while not self.stopping:
+            with self.lock:
+                linked = address in self.links
+            if linked:  # It dialed us (or our link is up): nothing to do
+                time.sleep(PEER_RECONNECT_BASE_SEC)
+                continue
+            try:
+                sock = socket.create_connection((host, int(port)), timeout=2.0)
+                sock.settimeout(None)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                sock.sendall((Protocol.PeerHello(self.node_id, self.secret).encode() + "\n").encode("utf-8"))
+            except (OSError, ValueError):
+                time.sleep(backoff.next_delay())
+                continue
+            backoff.reset()
+            self.serve(sock, "", dialed=address)
+            if not self.stopping:
+                time.sleep(backoff.next_delay())
+
+    # Run one link until it closes (called on the dialing thread, or on the server's handler thread) -->
+    # `hello` is the CMD:PEER line we accepted (empty when we dialed); `buffer` holds what came after it.
+    def serve(self, sock: socket.socket, buffer: str, hello: str = "", dialed: str = "") -> None:
+        try:
+            if hello:
+                frame = Protocol.PeerHello.from_wire(hello[len(PEER_HELLO):])
+                node = frame.node.strip() if frame is not None else "?"
+                if frame is None or node not in self.peers or not self._trusted(frame.secret):
+                    self._reject(node, "hello from an unknown node or with a wrong secret")
+                    sock.close()
+                    return
+                initiator = node
+                sock.sendall((Protocol.PeerAccept(self.node_id, self.secret).encode() + "\n").encode("utf-8"))
+            else:
+                line, buffer = self._read_line(sock, buffer)
+                frame = Protocol.decode_peer(line) if line is not None else None
+                if not isinstance(frame, Protocol.PeerAccept) or not self._trusted(frame.secret):
+                    self._reject(dialed, "answer without the cluster secret")
+                    sock.close()
+                    return
+                node = dialed   # The address we dialed is the node id (whatever it calls itself)
+                initiator = self.node_id
+                if frame.node.strip() != dialed:
+                    Server_Log.log.warning("peer", f"Peer {dialed} calls itself {frame.node}", node=frame.node, dialed=dialed)
+        except OSError:
+            sock.close()
+            return
+        link = PeerLink(sock, node, initiator)
+        if not self._register(link):
+            sock.close()
+            return
+        Server_Log.log.info("peer", f"Peer link up: {node}", node=node, up=True)
+        link.send(Protocol.Roster(self.node_id, ",".join(self.local_names())).encode())
+        for name, url in self.local_avatars():
+            link.send(Protocol.PeerAvatar(name, url).encode())
+        try:
+            while True:
+                line, buffer = self._read_line(sock, buffer)
+                if line is None:
+                    break
+                if line:
+                    self._handle(node, line)
+        finally:
+            self._unregister(link)
+            sock.close()
+
+    def _trusted(self, secret: str) -> bool:
+        return bool(self.secret) and hmac.compare_digest(secret.encode("utf-8"), self.secret.encode("utf-8"))
+
+    def _reject(self, node: str, why: str) -> None:
+        self.stats["rejected"] += 1
+        Server_Log.log.warning("peer", f"Peer link refused ({node}): {why}", node=node)
+
+    @staticmethod
+    def _read_line(sock: socket.socket, buffer: str):
+        while "\n" not in buffer:
+            try:
+                chunk = sock.recv(65536)
+            except OSError:
+                return None, buffer
+            if not chunk:
+                return None, buffer
+            buffer += chunk.decode("utf-8", errors="replace")
+        line, buffer = buffer.split("\n", 1)
+        return line.strip(), buffer
+
+    # Two links to the same node (both dialed at once): both sides keep the one dialed by the smaller id -->
+    def _register(self, link: PeerLink) -> bool:
+        with self.lock:
+            old = self.links.get(link.node)
+            if old is not None and not old.closed and old.initiator != link.initiator:
+                if old.initiator == min(self.node_id, link.node):
+                    link.close()
+                    return False
+            self.links[link.node] = link
+            self.stats["links_up"] += 1
+        if old is not None and old is not link:
+            old.close()
+        return True
+
+    def _unregister(self, link: PeerLink) -> None:
+        link.close()
+        with self.lock:
+            if self.links.get(link.node) is not link:
+                return  # Replaced by a newer link: its roster is still valid
+            del self.links[link.node]
+            gone = [n for n, node in self.remote.items() if node == link.node]
+            for name in gone:
+                del self.remote[name]
+                self.remote_avatars.pop(name, None)
+        Server_Log.log.info("peer", f"Peer link down: {link.node}", node=link.node, up=False)
+        if gone:
+            self.roster_changed()
+
+    # ----- Incoming peer lines -----
+    # `node` is the link's (authenticated) node: the node fields inside the lines are not trusted -->
+    def _handle(self, node: str, line: str) -> None:
+        frame = Protocol.decode_peer(line)
+        self.stats["received"] += 1
+        kind = type(frame)
+        if kind is Protocol.Forward:
+            if frame.sender != "System" and not self._holds(node, frame.sender):
+                self.stats["dropped"] += 1  # Only its own users (or the node itself) speak through a link
+                return
+            self.deliver(frame.target, frame.sender, frame.msg_id, frame.text)
+        elif kind in (Protocol.Roster, Protocol.PeerJoined):
+            names = frame.names.split(",") if kind is Protocol.Roster else [frame.name]
+            self._claim(node, [n for n in names if n], replace=(kind is Protocol.Roster))
+        elif kind is Protocol.PeerLeft:
+            name = frame.name
+            with self.lock:
+                if self.remote.get(name) != node:
+                    return
+                del self.remote[name]
+                self.remote_avatars.pop(name, None)
+            self.roster_changed()
+        elif kind is Protocol.PeerAvatar:
+            if not self._holds(node, frame.name):
+                self.stats["dropped"] += 1
+                return
+            with self.lock:
+                self.remote_avatars[frame.name] = frame.url
+            self.avatar_changed(frame.name, frame.url)
+        elif kind is Protocol.Raw:
+            self.raw(frame.line)
+
+    def _holds(self, node: str, name: str) -> bool:
+        with self.lock:
+            return self.remote.get(name) == node
+
+    # A node says it holds these names. A name held here too: the smaller node id keeps it -->
+    def _claim(self, owner: str, names: List[str], replace: bool) -> None:
+        ours = set(self.local_names())
+        lost = []
+        with self.lock:
+            if replace:
+                for name in [n for n, node in self.remote.items() if node == owner]:
+                    del self.remote[name]
+            for name in names:
+                if name in ours:
+                    if owner > self.node_id:
+                        continue    # Ours: that node drops its user when it hears about ours
+                    lost.append(name)
+                self.remote[name] = owner
+        for name in lost:
+            self.name_conflict(name)
+        self.roster_changed()
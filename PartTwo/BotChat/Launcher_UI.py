@@ -1,5 +1,6 @@
 """SettingUp the Launcher Window UI and Functions"""
 
+import asyncio
 import os
 import signal
 import socket
@@ -11,10 +12,16 @@ import time
 from typing import Optional, Dict
 
 from fastapi import Request
-from nicegui import ui
+from nicegui import ui, background_tasks, run
 
-from Common_Setups import SERVER_IP, SERVER_PORT
-from State_Globals import active_users_list, messages
+from Backoff import ExponentialBackoff
+import Compression
+import Protocol
+from Connection_Manager import connections
+from Common_Setups import (
+    SERVER_PORT, DRAIN_TIMEOUT_SEC, RECONNECT_BASE_SEC, RECONNECT_MAX_SEC, COMPRESSION_ENABLED,
+)
+from State_Globals import active_users_list, messages, chat_disconnectors, roster_listeners, set_active_users
 
 
 # ===========================================
@@ -29,17 +36,14 @@ async def build_launcher_ui(request: Request) -> None:
     SERVER_SCRIPT = os.path.join(os.path.dirname(__file__), 'Main_Server.py')  # The path to the server
     server_proc: Dict[str, Optional[subprocess.Popen]] = {'p': None}  # Holds the server process reference so we use it later
 
-    # Check server availability by trying to connect to the TCP port -->
-    def is_server_running() -> bool:
-        try:  # Try to connect quickly. If it works, server is running.
-            with socket.create_connection((SERVER_IP, SERVER_PORT), timeout=0.25):
-                return True
-        except OSError:
-            return False
+    # Check server availability (a warm pooled socket counts; otherwise one quick connect) -->
+    # The connect blocks, so it runs on a worker thread, never on the UI event loop:
+    async def is_server_running() -> bool:
+        return await run.io_bound(connections.server_is_up)
 
     # Start server as a subprocess -->
-    def start_server() -> bool:
-        if is_server_running():  # Checks if it is already running: if it is we don't need it
+    async def start_server() -> bool:
+        if await is_server_running():  # Checks if it is already running: if it is we don't need it
             return True
         try:
             server_proc['p'] = subprocess.Popen(
@@ -78,10 +82,10 @@ async def build_launcher_ui(request: Request) -> None:
             ui.notify("No local server proc; trying to stop by port...", type='warning')
             kill_server_by_port()
             return
-        try:  # Try to terminate gracefully
+        try:  # Try to terminate gracefully (SIGTERM -> the server drains its clients first)
             p.terminate()
             try:
-                p.wait(timeout=1.5)
+                p.wait(timeout=DRAIN_TIMEOUT_SEC + 1.0)
             except Exception:  # Didn't worked: kill it
                 p.kill()
         finally:  # Always reset handle
@@ -95,59 +99,82 @@ async def build_launcher_ui(request: Request) -> None:
     launcher_socket: Optional[socket.socket] = None
 
     # Connect to server as a special launcher client -->
-    # (name starts with __LAUNCHER__)
+    # (name starts with __LAUNCHER__). Reconnects with exponential backoff when the server goes away.
+    observer = {'running': False, 'stop': False, 'token': None}
+
     def start_launcher_observer():
-        nonlocal launcher_socket
-        if launcher_socket is not None: return
+        if observer['running']: return  # One observer thread per launcher window
+        observer['running'], observer['stop'] = True, False
 
         def run_observer_thread():
             nonlocal launcher_socket
+            backoff = ExponentialBackoff(RECONNECT_BASE_SEC, RECONNECT_MAX_SEC)
+            name = f"__LAUNCHER__{uuid.uuid4().hex[:6]}"
 
-            # --- PHASE 1: Connection Retry Loop ---
-            # Keep trying to connect until the server wakes up
-            while launcher_socket is None:
+            while not observer['stop']:
+                # --- PHASE 1: Connection Retry Loop ---
+                # Keep trying to connect until the server wakes up (waiting longer after every failure)
                 try:
-                    temp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    temp_sock.connect((SERVER_IP, SERVER_PORT))
+                    temp_sock = connections.connect(timeout=5.0)
 
-                    # Handshake
-                    name = f"__LAUNCHER__{uuid.uuid4().hex[:6]}"
-                    temp_sock.sendall(name.encode('utf-8'))
+                    # Handshake (resume the previous session if the connection dropped)
+                    hello = Protocol.Resume(observer['token']).encode() if observer['token'] else name
+                    if COMPRESSION_ENABLED:  # Big rosters come compressed
+                        hello += "\n" + Protocol.Caps(Compression.CAPABILITY).encode()
+                    temp_sock.sendall((hello + "\n").encode('utf-8'))
 
                     launcher_socket = temp_sock  # Success!
                     print(">>> Launcher Observer CONNECTED successfully.")
                 except Exception:
-                    # Server not ready yet? Wait 1 second and try again.
-                    time.sleep(1.0)
-
-            # --- PHASE 2: Listening Loop ---
-            buffer = ""
-            while True:
-                try:
-                    chunk = launcher_socket.recv(4096).decode("utf-8", errors="replace")
-                    if not chunk: break
-                    buffer += chunk
-
-                    while "\n" in buffer:
-                        line, buffer = buffer.split("\n", 1)
-                        line = line.strip()
-                        if not line: continue
-
-                        parts = line.split("|")
-                        # Check for USERS update message
-                        if len(parts) >= 4 and parts[0] == "USERS":
-                            users_str = parts[3]
-                            active_users_list.clear()
-                            if users_str.strip():
-                                active_users_list.extend([
+                    # Server not ready yet? Wait a bit (backoff + jitter) and try again.
+                    time.sleep(backoff.next_delay())
+                    continue
+
+                # --- PHASE 2: Listening Loop ---
+                buffer = ""
+                while True:
+                    try:
+                        chunk = temp_sock.recv(4096).decode("utf-8", errors="replace")
+                        if not chunk: break
+                        buffer += chunk
+
+                        while "\n" in buffer:
+                            line, buffer = buffer.split("\n", 1)
+                            line = line.strip()
+                            if not line: continue
+                            if line.startswith(Compression.PREFIX):  # Lines inside go back to the buffer
+                                try:
+                                    buffer = Compression.decode_line(line) + "\n" + buffer
+                                except ValueError:
+                                    pass
+                                continue
+
+                            frame = Protocol.decode(line)
+                            # Check for USERS update message
+                            if isinstance(frame, Protocol.Users):
+                                users_str = frame.names
+                                set_active_users([  # Fires roster-change events only if something changed
                                     u.strip() for u in users_str.split(",")
                                     if u.strip() and not u.strip().startswith("__")
                                 ])
-                except Exception:
-                    break
-
-            # If we fall out of the loop, reset so we can try again later if needed
-            launcher_socket = None
+                            elif isinstance(frame, Protocol.Session):
+                                observer['token'] = frame.token.strip()
+                                backoff.reset()
+                            elif isinstance(frame, Protocol.Err) and frame.code == "RESUME_FAILED":
+                                observer['token'] = None  # Expired -> join again with the name
+                            elif isinstance(frame, Protocol.Ping):  # Heartbeat: a silent observer is evicted
+                                temp_sock.sendall((Protocol.Pong(frame.stamp).encode() + "\n").encode("utf-8"))
+                    except Exception:
+                        break
+
+                # If we fall out of the loop, reset and try again (unless the launcher is closing)
+                launcher_socket = None
+                try: temp_sock.close()
+                except Exception: pass
+                if not observer['stop']:
+                    time.sleep(backoff.next_delay())
+
+            observer['running'] = False
 
         # Start the background thread
         threading.Thread(target=run_observer_thread, daemon=True).start()
@@ -157,8 +184,10 @@ async def build_launcher_ui(request: Request) -> None:
     # Close the launcher observer socket when the UI client disconnects -->
     def stop_launcher_observer():
         nonlocal launcher_socket
+        observer['stop'] = True
         try:
             if launcher_socket is not None:
+                launcher_socket.sendall((Protocol.Quit().encode() + "\n").encode("utf-8"))
                 launcher_socket.close()
         except Exception:
             pass
@@ -171,6 +200,10 @@ async def build_launcher_ui(request: Request) -> None:
     # ----------------------------------
     # ----- Close all chat windows -----
     # ----------------------------------
+    # Run all the chat disconnect handshakes concurrently on the event loop -->
+    async def disconnect_all_chat_sessions():
+        await asyncio.gather(*(disconnect() for disconnect in list(chat_disconnectors)), return_exceptions=True)
+
     # The function to close all the active chats -->
     def close_all_chats():
         # A JavaScript command that is closing all the windows that were opened
@@ -191,7 +224,10 @@ async def build_launcher_ui(request: Request) -> None:
             window.chatWindowCount = 0;
             window.openedWindows = [];
         ''')
-        active_users_list.clear()  # Clear active users list on the launcher side
+        # Disconnect every chat session of this process too, all at once (each one awaits its own QUIT handshake) -->
+        if chat_disconnectors:
+            background_tasks.create(disconnect_all_chat_sessions(), name='disconnect_all_chats')
+        set_active_users([])  # Clear active users list on the launcher side
         ui.notify('Active users list cleared', type='info', color='green')
 
     # ---------------------------------
@@ -220,12 +256,12 @@ async def build_launcher_ui(request: Request) -> None:
     server_toggle = None
 
     # Update the server icon + toggle switch to reflect actual server state -->
-    def update_server_ui():
+    async def update_server_ui():
         nonlocal server_icon, server_toggle
         if server_icon is None or server_toggle is None:
             return
 
-        running = is_server_running()
+        running = await is_server_running()
 
         # icon + color:
         if running:  # If server is running -> green cloud_done icon
@@ -244,7 +280,7 @@ async def build_launcher_ui(request: Request) -> None:
             server_toggle.update()
 
     # Callback fired when user toggles the server switch in UI -->
-    def on_server_toggle(e):
+    async def on_server_toggle(e):
         val = None
         # Set value as appeared:
         if isinstance(e.args, dict):
@@ -252,57 +288,110 @@ async def build_launcher_ui(request: Request) -> None:
         elif isinstance(e.args, (list, tuple)) and e.args:
             val = e.args[0]
         want_on = bool(val)  # What the server want
-        running = is_server_running()  # Actual current state
+        running = await is_server_running()  # Actual current state
         if want_on == running: return
         if want_on:  # Starting server
-            if not start_server(): ui.notify('Failed to start server (check console)', type='negative')
+            if not await start_server(): ui.notify('Failed to start server (check console)', type='negative')
         else:  # Stopping server: close all chat windows and clear state
             close_all_chats()
             try:
                 messages.clear()
             except Exception:
                 pass
-            active_users_list.clear()
+            set_active_users([])
             stop_server()
-        update_server_ui()  # Refresh UI indicator
+        await update_server_ui()  # Refresh UI indicator
 
     # ---------------------------------------------
     # ----- Dialog UI to display active users -----
     # ---------------------------------------------
     # Setting the dialogue window for showing the activity users -->
+    USERS_PAGE_SIZE = 50  # Rows per page (big rosters are paged, not rendered all at once)
+    roster_view = {'rows': {}, 'page': 0, 'query': ''}  # rows: name -> row element currently on screen
+
     with ui.dialog() as users_dialog, ui.card().classes('w-80 bg-red-950 border border-white/20 shadow-2xl p-4'):
         ui.label('Active Users:').classes('text-white text-xl font-bold mb-4 border-b border-white/10 w-full pb-2')
+        users_search = ui.input(placeholder='Search users...', on_change=lambda e: set_roster_query(e.value)) \
+            .props('dense dark clearable color=white input-style="color: white"') \
+            .classes('w-full mb-2')
+        with ui.column().classes('w-full items-center gap-0') as users_empty:  # Shown only when nothing matches
+            ui.label('No data available yet...').classes('text-gray-400 italic text-sm')
+            ui.label('(Open a chat window to sync)').classes('text-gray-600 text-xs')
         users_list_container = ui.column().classes(
-            'w-full gap-3')  # A container that will update every time we open the window
+            'w-full gap-3 overflow-visible')  # Rows are added/removed one by one (keyed by name)
+        with ui.row().classes('w-full items-center justify-between mt-2') as users_pager:
+            ui.button(icon='chevron_left', on_click=lambda: change_roster_page(-1)).props('flat dense round color=white')
+            users_page_label = ui.label('').classes('text-gray-300 text-xs')
+            ui.button(icon='chevron_right', on_click=lambda: change_roster_page(1)).props('flat dense round color=white')
         with ui.row().classes('w-full justify-end mt-4'):
             ui.button('CLOSE', on_click=users_dialog.close).props('flat').classes(
                 'text-white border border-white/40 squared-full px-4')  # Closing button and properties
 
+    # Build ONE user row (only called for names that are new on screen) -->
+    def make_user_row(name: str):
+        with users_list_container:
+            with ui.row().classes(
+                    'items-center w-full justify-between bg-white/5 p-2 rounded-lg overflow-visible min-w-0') as row:
+                with ui.row().classes('items-center gap-3 min-w-0'):
+                    ui.icon(name='account_circle', color='red-200').classes('text-3xl shrink-0')
+                    ui.label(name).classes('text-white font-large truncate')
+                ui.icon(name='link', color='green-400').classes(
+                    'text-xl shrink-0 opacity-80 hover:opacity-100 transition-all').tooltip('Connected')
+        return row
+
+    # Diff the rows on screen against the current roster page: remove gone rows, add new ones, fix order -->
+    # (a row is only moved when the one at its index is another: renames / re-sorts, not every refresh)
+    def render_roster():
+        query = roster_view['query'].casefold()
+        matching = [n for n in active_users_list if query in n.casefold()] if query else list(active_users_list)
+        pages = max(1, -(-len(matching) // USERS_PAGE_SIZE))
+        roster_view['page'] = min(roster_view['page'], pages - 1)
+        start = roster_view['page'] * USERS_PAGE_SIZE
+        visible = matching[start:start + USERS_PAGE_SIZE]
+
+        rows = roster_view['rows']
+        wanted = set(visible)
+        for name in [n for n in rows if n not in wanted]:  # 1) Rows that left the page
+            users_list_container.remove(rows.pop(name))
+        on_screen = users_list_container.default_slot.children  # Live list: follows every move
+        for index, name in enumerate(visible):  # 2) New rows + rows whose place changed, put at their index
+            if name not in rows:
+                rows[name] = make_user_row(name)
+            if index >= len(on_screen) or on_screen[index] is not rows[name]:
+                rows[name].move(target_index=index)
+
+        users_empty.set_visibility(not visible)
+        users_pager.set_visibility(pages > 1)
+        users_page_label.text = f'{roster_view["page"] + 1} / {pages}  ({len(matching)} users)'
+
+    def set_roster_query(value):
+        roster_view['query'] = str(value or '').strip()
+        roster_view['page'] = 0
+        render_roster()
+
+    def change_roster_page(step: int):
+        roster_view['page'] = max(0, roster_view['page'] + step)
+        render_roster()
+
     # A function for updating and showing the dialogue content-->
     def show_active_users():
-        users_list_container.clear()  # Clearing the old list
-        users_list_container.classes('overflow-visible')  # Ensure the container can grow
-        with users_list_container:
-            if not active_users_list:  # If we have no users yet
-                ui.label('No data available yet...').classes('text-gray-400 italic text-sm')
-                ui.label('(Open a chat window to sync)').classes('text-gray-600 text-xs')
-            else:  # Create one row per user
-                for name in active_users_list:
-                    with ui.row().classes(
-                            'items-center w-full justify-between bg-white/5 p-2 rounded-lg overflow-visible min-w-0'):
-                        with ui.row().classes('items-center gap-3 min-w-0'):
-                            ui.icon(name='account_circle', color='red-200').classes('text-3xl shrink-0')
-                            ui.label(name).classes('text-white font-large truncate')
-                        ui.icon(name='link', color='green-400').classes(
-                            'text-xl shrink-0 opacity-80 hover:opacity-100 transition-all').tooltip('Connected')
+        render_roster()
         users_dialog.open()  # Finally open the dialog
 
-    # If dialog is open, refresh it periodically -->
-    def refresh_users_dialog():
-        if users_dialog.value:
-            show_active_users()
+    # Roster-change events (fired by the observer thread) -> re-diff on the UI loop, only if the dialog is open -->
+    ui_loop = asyncio.get_running_loop()
+
+    def on_roster_change(_added, _removed):
+        def apply():
+            if users_dialog.value:
+                render_roster()
+        try:
+            ui_loop.call_soon_threadsafe(apply)
+        except RuntimeError:
+            pass  # Loop closed
 
-    ui.timer(0.5, refresh_users_dialog)  # Every 0.5 sec check if dialog is open and refresh its content
+    roster_listeners.append(on_roster_change)
+    ui.context.client.on_disconnect(lambda: on_roster_change in roster_listeners and roster_listeners.remove(on_roster_change))
 
     # -------------------------------------------------------------
     # ----- Launcher presence + focus bridge (anti-duplicate) -----
@@ -340,7 +429,7 @@ async def build_launcher_ui(request: Request) -> None:
     # ----------------------------------------------------------
     # ----- Start launcher observer (only if server is up) -----
     # ----------------------------------------------------------
-    if is_server_running():
+    if await is_server_running():
         start_launcher_observer()
 
     # ------------------------------
@@ -380,7 +469,7 @@ async def build_launcher_ui(request: Request) -> None:
                 server_toggle = ui.switch().props('color=blue')
                 server_toggle.on('update:model-value', on_server_toggle)
 
-            update_server_ui()
+            await update_server_ui()
             ui.timer(3.0, update_server_ui)  # polling עדין, לא “דוחף” סתם
 
             # Headlines, Icons and Info -->
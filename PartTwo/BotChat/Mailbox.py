@@ -0,0 +1,153 @@
+"""Store-and-forward: private messages to users that are offline wait on disk until they connect"""
+
+import base64
+import os
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+from Common_Setups import MAILBOX_DIR, MAILBOX_MAX_PER_USER, MAILBOX_TTL_SEC
+from Protocol import escape, unescape
+
+DIR_ENV = "BOTCHAT_MAILBOX_DIR"     # Overrides MAILBOX_DIR (benchmarks, several servers on one machine)
+SUFFIX = ".box"
+LATENCY_SAMPLES = 10_000            # Delivery latencies kept for the percentiles
+
+# One mailbox = one append-only file, one line per message: <queued at, unix ms>|<sender>|<msg_id>|<text>
+# (fields escaped like protocol fields: a text may hold "|" or line breaks)
+Queued = Tuple[str, str, str, int]  # (sender, msg_id, text, queued at ms)
+
+
+# Nickname <-> file name (reversible, safe for any file system) -->
+def file_name(nick: str) -> str:
+    return base64.urlsafe_b64encode(nick.encode("utf-8")).decode("ascii").rstrip("=") + SUFFIX
+
+def nick_of(name: str) -> str:
+    body = name[:-len(SUFFIX)]
+    return base64.urlsafe_b64decode(body + "=" * (-len(body) % 4)).decode("utf-8")
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+class MailboxStore:
+    """Mailboxes of offline users, on disk.
+
+    Only a few numbers per mailbox stay in RAM (depth + newest message time), so the queued
+    messages themselves cost disk, not memory. A mailbox holds at most `max_per_user` messages
+    (more -> rejected) and messages older than `ttl` are never delivered (dropped on delivery,
+    whole mailboxes by sweep()).
+    """
+
+    def __init__(self, directory: Optional[str] = None, max_per_user: int = MAILBOX_MAX_PER_USER,
+                 ttl: float = MAILBOX_TTL_SEC):
+        here = os.path.dirname(os.path.abspath(__file__))
+        self.directory = directory or os.environ.get(DIR_ENV) or os.path.join(here, MAILBOX_DIR)
+        self.max_per_user = max_per_user
+        self.ttl_ms = int(ttl * 1000)
+        self.lock = threading.Lock()
+        self.depth: Dict[str, int] = {}     # nick -> queued messages
+        self.newest: Dict[str, int] = {}    # nick -> time of its newest message (ms)
+        self.latencies: deque = deque(maxlen=LATENCY_SAMPLES)   # queued -> delivered (ms)
+        self.stats = {"queued": 0, "delivered": 0, "expired": 0, "rejected": 0}
+        os.makedirs(self.directory, exist_ok=True)
+        self._scan()
+
+    def _path(self, nick: str) -> str:
+        return os.path.join(self.directory, file_name(nick))
+
+    # Startup: what earlier runs left behind (counts lines; the messages are not kept) -->
+    def _scan(self) -> None:
+        for name in os.listdir(self.directory):
+            if not name.endswith(SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+                nick = nick_of(name)
+            except (OSError, ValueError):
+                continue
+            count = data.count(b"\n")
+            if count:
+                self.depth[nick] = count
+                self.newest[nick] = int(time.time() * 1000)     # Unknown without parsing: keep for one TTL
+            else:
+                os.remove(path)
+
+    # Queue one message. False if the mailbox is full -->
+    def put(self, nick: str, sender: str, msg_id: str, text: str) -> bool:
+        now = int(time.time() * 1000)
+        record = f"{now}|{escape(sender)}|{escape(msg_id)}|{escape(text)}\n".encode("utf-8")
+        with self.lock:
+            if self.depth.get(nick, 0) >= self.max_per_user:
+                self.stats["rejected"] += 1
+                return False
+            with open(self._path(nick), "ab") as f:
+                f.write(record)
+            self.depth[nick] = self.depth.get(nick, 0) + 1
+            self.newest[nick] = now
+            self.stats["queued"] += 1
+        return True
+
+    def has_mail(self, nick: str) -> bool:
+        with self.lock:
+            return nick in self.depth
+
+    # Empty a mailbox (the user just connected): everything still inside its TTL, oldest first -->
+    def take(self, nick: str) -> List[Queued]:
+        with self.lock:
+            if self.depth.pop(nick, None) is None:
+                return []
+            self.newest.pop(nick, None)
+            path = self._path(nick)
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+                os.remove(path)
+            except OSError:
+                return []
+        now = int(time.time() * 1000)
+        found, expired = [], 0
+        for raw in data.decode("utf-8", errors="replace").splitlines():
+            stamp, sender, msg_id, text = (raw.split("|", 3) + ["", "", ""])[:4]
+            try:
+                queued = int(stamp)
+            except ValueError:
+                continue
+            if now - queued > self.ttl_ms:
+                expired += 1
+                continue
+            found.append((unescape(sender), unescape(msg_id), unescape(text), queued))
+            self.latencies.append(now - queued)
+        with self.lock:
+            self.stats["expired"] += expired
+            self.stats["delivered"] += len(found)
+        return found
+
+    # Drop mailboxes whose newest message is past the TTL (nobody came for them) -->
+    def sweep(self) -> int:
+        cutoff = int(time.time() * 1000) - self.ttl_ms
+        with self.lock:
+            old = [nick for nick, newest in self.newest.items() if newest < cutoff]
+            for nick in old:
+                self.stats["expired"] += self.depth.pop(nick, 0)
+                del self.newest[nick]
+                try: os.remove(self._path(nick))
+                except OSError: pass
+        return len(old)
+
+    # Depth + delivery latency numbers (logged by the server) -->
+    def metrics(self) -> dict:
+        with self.lock:
+            depths = list(self.depth.values())
+            latencies = list(self.latencies)
+            result = dict(self.stats)
+        result.update({"mailboxes": len(depths), "waiting": sum(depths), "max_depth": max(depths, default=0),
+                       "latency_p50_ms": percentile(latencies, 50), "latency_p99_ms": percentile(latencies, 99)})
+        return result
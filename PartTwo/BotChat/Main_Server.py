@@ -1,19 +1,66 @@
+import hmac
+import itertools
+import json
+import os
+import queue
+import signal
 import socket
+import subprocess
+import sys
 import threading
 import time
 import uuid
+from collections import OrderedDict, deque
 
-from Common_Setups import SERVER_PORT
+from Common_Setups import (
+    SERVER_PORT, DRAIN_TIMEOUT_SEC, DRAIN_RECONNECT_MIN_MS, DRAIN_RECONNECT_MAX_MS,
+    RESUME_GRACE_SEC, SERVER_HISTORY_SIZE, RESUME_STATE_FILE, IDEMPOTENCY_WINDOW, channel_of, is_room, valid_room,
+    SEND_BATCH_WINDOW_MS, SEND_BATCH_MAX_BYTES, SEND_BATCH_MAX_QUEUED_BYTES, DISCOVERY_ENABLED, DISCOVERY_PORT,
+    MAILBOX_ENABLED, MAILBOX_SWEEP_SEC, LOG_LEVEL, PROFILE_DEFAULT_SEC, PROFILE_MAX_SEC,
+    PROTOCOL_MAX_LINE_BYTES, SERVER_TRANSPORT, LOOP_MAX_QUEUED_BYTES,
+    HEARTBEAT_IDLE_SEC, HEARTBEAT_TIMEOUT_SEC, TIMER_WHEEL_TICK_SEC, TIMER_WHEEL_SLOTS, FIRST_LINE_TIMEOUT_SEC,
+)
+import Compression
+import Outbox
+import Protocol
+from Avatar_Store import AvatarStore, avatar_hash
+from Clocks import RealClock
+from Event_Loop import EventLoop
+from Federation import Cluster, PEER_HELLO, PEER_SECRET_ENV
+from Mailbox import MailboxStore
+from Profiler import SamplingProfiler
+from Server_Log import log, LEVELS
+from Connection_Manager import DISCOVERY_PROBE, DISCOVERY_REPLY
+from Rate_Limiter import ConnectionLimiter, ACTION_DELAY, ACTION_DROP, ACTION_ERROR, ACTION_DISCONNECT
+from Timer_Wheel import TimerWheel
+
+clock = RealClock()  # time / timers of the routing code (Sim_Net swaps in a VirtualClock)
+wheel = TimerWheel(clock, TIMER_WHEEL_TICK_SEC, TIMER_WHEEL_SLOTS)  # Every server timer (started in wake_up_server)
 
 def make_msg_id() -> str:
-    return f"{int(time.time() * 1000)}-{uuid.uuid4().hex[:6]}"
+    return f"{int(clock.time() * 1000)}-{uuid.uuid4().hex[:6]}"
+
+compressing = set()  # Sockets that negotiated CMD:CAPS:zlib (long lines go out compressed)
+batcher = None  # Outbox.Batcher when micro-batching is on (--batch-ms > 0), else one sendall per line
 
 # Send one protocol line (server -> clients) -->
 def send_line(sock: socket.socket, line: str) -> None:
-    try:
-        sock.sendall((line + "\n").encode("utf-8"))
-    except Exception:
-        pass
+    if sock in compressing:
+        line = Compression.encode_line(line)    # Unchanged below COMPRESS_MIN_BYTES
+    data = (line + "\n").encode("utf-8")
+    if batcher is not None:
+        batcher.send(sock, data)    # Goes out with the connection's next flush (<= window)
+    else:
+        Outbox.send_now(sock, data)
+
+# Send one frame (Protocol: its fields escaped) -->
+def send_frame(sock: socket.socket, frame: Protocol.Frame) -> None:
+    send_line(sock, frame.encode())
+
+# Push out whatever is still batched for this socket (before shutdown / close) -->
+def flush_lines(sock: socket.socket) -> None:
+    if batcher is not None:
+        batcher.flush_socket(sock)
 
 # ====================
 # ===== Server CFG ===
@@ -24,6 +71,57 @@ PORT = SERVER_PORT
 
 online_users = {}  # nickname -> socket
 online_users_lock = threading.Lock()
+connections = {}   # session id -> Session of every open client connection (guarded by online_users_lock)
+event_loop = None  # Event_Loop.EventLoop with --transport loop (else one handler thread per client)
+
+# Drain / hot restart state -->
+LISTEN_FD_ENV = "BOTCHAT_LISTEN_FD"     # Set by a draining server for its successor (inherited listening socket)
+ADMIN_TOKEN_ENV = "BOTCHAT_ADMIN_TOKEN"  # Secret for admin commands (CMD:PROFILE); unset -> no admin commands
+draining = threading.Event()            # Set once the server stopped accepting and is draining
+stop_request = {'mode': None}           # None / "drain" / "handoff" (written by the signal handlers)
+client_threads = set()                  # Live handler threads (joined while draining)
+client_threads_lock = threading.Lock()
+introducing = set()                     # Accepted sockets that sent no first line yet (probes, clients' warm spares)
+
+# Sessions (reconnect + resume), guarded by online_users_lock -->
+sessions = {}       # token -> {'nick', 'avatar' (hash), 'sock', 'expires', 'rooms'}  (sock is None while "parked")
+parked_names = {}   # nickname -> token of a dropped user inside its grace period (name stays reserved)
+history = deque(maxlen=SERVER_HISTORY_SIZE)  # (msg_id, sender, target, line, channel, seq) of the latest MSG lines
+
+# Server-assigned message order, guarded by online_users_lock -->
+server_epoch = uuid.uuid4().hex[:8]     # Changes when the seq counters restart (a hot restart keeps it)
+channel_seqs = {}                       # channel ("ALL" / "DM:a\nb") -> last seq given out (1, 2, 3, ...)
+channel_history = {}                    # channel -> deque of its latest MSG lines (seqs are contiguous)
+seen_ids = OrderedDict()                # (sender, client msg_id) -> MSG line (idempotency: a resend is not a new message)
+rooms = {}                              # "#room" -> sockets of its connected members (a room MSG goes only to these)
+kicked = set()                          # Sockets of users that lost their name to another node (session ends)
+cluster = None                          # Federation.Cluster when the server runs with --peers (else a lone server)
+mailboxes = None                        # Mailbox.MailboxStore (opened in wake_up_server when MAILBOX_ENABLED)
+mailbox_jobs = queue.Queue()            # Event loop: (fn, args, then) for the mailbox worker (disk I/O off the loop)
+heartbeat = {'idle': HEARTBEAT_IDLE_SEC, 'timeout': HEARTBEAT_TIMEOUT_SEC}  # idle 0 -> no heartbeats
+heartbeat_stats = {"pings": 0, "pongs": 0, "reaped": 0}   # Printed as HEARTBEAT_STATS when the server drains
+RESUME_STATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), RESUME_STATE_FILE)
+
+
+# Avatar hashes some session still points to (the store never drops these) -->
+def avatars_in_use() -> list:
+    with online_users_lock:
+        used = [s['avatar'] for s in sessions.values() if s['avatar']]
+    if cluster is not None:
+        used += [avatar_hash(url) for url in cluster.remote_avatar_urls().values()]
+    return used
+
+avatars = AvatarStore(avatars_in_use)   # hash -> avatar URL, each avatar stored once
+
+
+# Everyone's avatar as nick=hash pairs: one compact line for a client that just joined -->
+def send_avatar_snapshot(sock: socket.socket, who: str) -> None:
+    with online_users_lock:
+        pairs = [f"{s['nick']}={s['avatar']}" for s in sessions.values() if s['avatar']]
+    if cluster is not None:  # Users of the other nodes (their avatars are stored here too)
+        pairs += [f"{name}={avatar_hash(url)}" for name, url in cluster.remote_avatar_urls().items()]
+    if pairs:
+        send_frame(sock, Protocol.Avatars("System", who, ",".join(pairs)))
 
 
 # Sending a list of users separated by (,) -->
@@ -33,9 +131,11 @@ def tell_everyone_who_is_online() -> None:
         # Hide pseudo-users like __LAUNCHER__...
         current_users = [n for n in online_users.keys() if not str(n).startswith("__")]
         sockets = list(online_users.values())
+    if cluster is not None:  # The whole cluster is one chat
+        current_users += cluster.remote_names()
 
     all_names = ",".join(current_users)
-    system_message = f"USERS|System|ALL|{all_names}"    # Format: TYPE|SENDER|TARGET|CONTENT
+    system_message = Protocol.Users("System", "ALL", all_names).encode()   # USERS|System|ALL|a,b,c
 
     for user_socket in sockets:
         send_line(user_socket, system_message)
@@ -49,6 +149,48 @@ def broadcast(line: str) -> None:
         send_line(s, line)
 
 
+# Give a message the next seq of its channel and remember it (resume + history fetch) -->
+# Returns (line, is_new); a msg_id this sender already used returns the original line and False.
+def publish(sender: str, target: str, msg_id: str, text: str):
+    channel = channel_of(sender, target)
+    with online_users_lock:
+        key = (sender, msg_id)
+        line = seen_ids.get(key)
+        if line is not None:
+            return line, False
+        seq = channel_seqs.get(channel, 0) + 1
+        channel_seqs[channel] = seq
+        line = Protocol.Msg(sender, target, msg_id, str(seq), text).encode()
+        history.append((msg_id, sender, target, line, channel, seq))
+        recent = channel_history.get(channel)
+        if recent is None:
+            recent = channel_history[channel] = deque(maxlen=SERVER_HISTORY_SIZE)
+        recent.append(line)
+        seen_ids[key] = line
+        if len(seen_ids) > IDEMPOTENCY_WINDOW:
+            seen_ids.popitem(last=False)
+    return line, True
+
+
+# MSG lines of one channel with lo <= seq <= hi (only what is still kept) -->
+def channel_range(channel: str, lo: int, hi: int) -> list:
+    with online_users_lock:
+        recent = channel_history.get(channel)
+        if not recent:
+            return []
+        first = channel_seqs[channel] - len(recent) + 1    # Seqs in the deque are contiguous
+        lo, hi = max(lo, first), min(hi, channel_seqs[channel])
+        return [recent[seq - first] for seq in range(lo, hi + 1)]
+
+
+# A System message to everyone (kept in the history too) -->
+def announce(text: str) -> None:
+    msg_id = make_msg_id()
+    broadcast(publish("System", "ALL", msg_id, text)[0])
+    if cluster is not None:
+        cluster.forward_all("ALL", "System", msg_id, text)
+
+
 # Server-side reserved names protection -->
 def is_reserved_name(name: str) -> bool:
     n = (name or "").strip()
@@ -56,176 +198,1128 @@ def is_reserved_name(name: str) -> bool:
         return True
     if n.casefold() == "system":
         return True
+    if is_room(n):  # "#..." is a room, never a user
+        return True
+    if n == Protocol.CMD:  # "CMD:..." lines are commands, never a message to a user called CMD
+        return True
     # We REMOVED the check for "__LAUNCHER__" here.
     # This allows the Launcher to connect and listen to updates.
     # The 'tell_everyone_who_is_online' function handles hiding it from the list.
     return False
 
 
-def handle_single_client(client_socket: socket.socket, address):
-    nickname = None
+# Online or parked (a dropped user may still come back and resume) or held by another node -->
+# Call with online_users_lock held.
+def name_in_use(name: str) -> bool:
+    if name in online_users or name in parked_names:
+        return True
+    return cluster is not None and cluster.owner_of(name) is not None
+
+
+# ===============
+# ===== Rooms ===
+# ===============
+# Membership lives in the session (survives a resume / hot restart); `rooms` indexes the live sockets -->
+def join_room(token: str, sock: socket.socket, room: str) -> bool:
+    with online_users_lock:
+        session = sessions.get(token)
+        if session is None:
+            return False
+        is_new = room not in session['rooms']
+        session['rooms'].add(room)
+        rooms.setdefault(room, set()).add(sock)
+    return is_new
+
+# Returns True if the user was a member -->
+def part_room(token: str, sock: socket.socket, room: str) -> bool:
+    with online_users_lock:
+        session = sessions.get(token)
+        was_member = session is not None and room in session['rooms']
+        if was_member:
+            session['rooms'].discard(room)
+        unsubscribe(sock, room)
+    return was_member
+
+# Drop one socket from a room's index (call with online_users_lock held) -->
+def unsubscribe(sock: socket.socket, room: str) -> None:
+    members = rooms.get(room)
+    if members is not None:
+        members.discard(sock)
+        if not members:
+            del rooms[room]
+
+def in_room(token: str, room: str) -> bool:
+    with online_users_lock:
+        session = sessions.get(token)
+        return session is not None and room in session['rooms']
+
+# Fan-out to a room: only its subscribed sockets -->
+def send_to_room(room: str, line: str) -> None:
+    with online_users_lock:
+        sockets = list(rooms.get(room, ()))
+    for s in sockets:
+        send_line(s, line)
+
+# A System message inside one room (kept in its channel history) -->
+def announce_room(room: str, text: str) -> None:
+    msg_id = make_msg_id()
+    send_to_room(room, publish("System", room, msg_id, text)[0])
+    if cluster is not None:
+        cluster.forward_all(room, "System", msg_id, text)
+
+
+# ============================
+# ===== Sessions / Resume ====
+# ============================
+# A new session for a user that just joined; the token lets it resume after a dropped connection -->
+def open_session(nickname: str, sock: socket.socket) -> str:
+    token = uuid.uuid4().hex
+    with online_users_lock:
+        sessions[token] = {'nick': nickname, 'avatar': '', 'sock': sock, 'expires': None, 'rooms': set()}
+    return token
+
+# Give a (parked or still registered) session to a new socket. Returns the nickname or None -->
+def take_over_session(token: str, sock: socket.socket):
+    with online_users_lock:
+        session = sessions.get(token)
+        if session is None:
+            return None
+        nickname = session['nick']
+        stale = session['sock']
+        parked_names.pop(nickname, None)
+        session['sock'], session['expires'] = sock, None
+        online_users[nickname] = sock
+        for room in session['rooms']:  # The new connection gets the room messages from now on
+            if stale is not None:
+                unsubscribe(stale, room)
+            rooms.setdefault(room, set()).add(sock)
+    wheel.cancel(("park", token))
+    if stale is not None:  # The old connection is half-dead (we never saw it close) -> kick it
+        try: stale.shutdown(socket.SHUT_RDWR)
+        except OSError: pass
+    return nickname
+
+# The MSG lines this user missed after `last_msg_id` (everything we still have if that id is unknown) -->
+def missed_lines(nickname: str, last_msg_id: str, joined=()) -> list:
+    with online_users_lock:
+        recent = list(history)
+    for i in range(len(recent) - 1, -1, -1):
+        if recent[i][0] == last_msg_id:
+            recent = recent[i + 1:]
+            break
+    return [h[3] for h in recent if h[2] in ("ALL", nickname) or h[1] == nickname or h[2] in joined]
+
+# Connection dropped without CMD:QUIT -> keep the name and session for RESUME_GRACE_SEC -->
+def park_session(token: str, grace: float = RESUME_GRACE_SEC) -> None:
+    with online_users_lock:
+        session = sessions.get(token)
+        if session is None:
+            return
+        session['sock'], session['expires'] = None, clock.time() + grace
+        parked_names[session['nick']] = token
+    wheel.schedule(("park", token), grace, expire_session, token)   # Parking again moves the same timer
+
+# Grace period is over and the user did not come back -> now it really left -->
+def expire_session(token: str) -> None:
+    with online_users_lock:
+        session = sessions.get(token)
+        if session is None or session['sock'] is not None:
+            return  # Resumed meanwhile
+        left = session['expires'] - clock.time()
+        if left <= 0:
+            del sessions[token]
+            parked_names.pop(session['nick'], None)
+    if left > 0:    # The wall clock went back since it was parked: not yet
+        wheel.schedule(("park", token), left, expire_session, token)
+        return
+    if cluster is not None:
+        cluster.local_left(session['nick'])
+    if not draining.is_set():
+        broadcast(Protocol.Leave("System", "ALL", session['nick'], "expired").encode())
+        announce(f"{session['nick']} -> has disconnected")
+
+# Hand sessions + history to the successor of a hot restart (every session is parked there) -->
+def save_resume_state() -> None:
+    with online_users_lock:
+        state = {'sessions': {t: {'nick': s['nick'], 'avatar': s['avatar'], 'rooms': sorted(s['rooms'])}
+                              for t, s in sessions.items()},
+                 'history': list(history), 'epoch': server_epoch, 'channel_seqs': channel_seqs}
+        in_use = [s['avatar'] for s in sessions.values() if s['avatar']]
+    state['avatars'] = avatars.export(in_use)
     try:
-        # ------------------------------------------------------------
-        # ----- Stage 1: receiving the first name and connecting -----
-        # ------------------------------------------------------------
-        nickname = client_socket.recv(1024).decode('utf-8', errors='replace')
-        nickname = nickname.strip()
-        if not nickname: return
+        with open(RESUME_STATE_PATH, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+    except OSError as e:
+        log.error("resume_state", f"Could not save sessions: {e}", error=str(e))
+
+def load_resume_state() -> None:
+    try:
+        with open(RESUME_STATE_PATH, encoding="utf-8") as f:
+            state = json.load(f)
+        os.remove(RESUME_STATE_PATH)
+    except (OSError, ValueError):
+        return
+    global server_epoch
+    with online_users_lock:
+        server_epoch = state.get('epoch', server_epoch)  # Same epoch + counters -> clients keep their seqs
+        channel_seqs.update(state.get('channel_seqs', {}))
+        for h in state.get('history', []):
+            history.append(tuple(h))
+            # The newest lines of a channel are contiguous in `history`, so the rebuilt deques are too:
+            channel_history.setdefault(h[4], deque(maxlen=SERVER_HISTORY_SIZE)).append(h[3])
+        for token, s in state.get('sessions', {}).items():
+            sessions[token] = {'nick': s['nick'], 'avatar': s.get('avatar', ''), 'sock': None, 'expires': None,
+                               'rooms': set(s.get('rooms', []))}
+    avatars.load(state.get('avatars', {}))
+    for token in list(sessions):
+        park_session(token)
+    log.info("resume_state", f"Loaded {len(sessions)} sessions from the previous server", sessions=len(sessions))
+
+
+# CMD:CAPS:<cap1,cap2,...> -> turn on what we support, tell the client what that is -->
+def negotiate_caps(sock: socket.socket, caps: str, who: str) -> None:
+    offered = {c.strip() for c in caps.split(",")}
+    if Compression.CAPABILITY in offered:
+        compressing.add(sock)
+        send_frame(sock, Protocol.Ack("System", who, "CAPS", Compression.CAPABILITY))
+
+
+# ====================
+# ===== Mailboxes ====
+# ====================
+# Mailbox disk I/O (append + fsync, read + delete): on the caller's thread with the thread transport. The event loop
+# hands it to one worker thread - in order, so a put queued before a join's take is in the file it reads - and
+# then(result) runs back on the loop thread -->
+def mailbox_io(fn, args: tuple, then) -> None:
+    if event_loop is None:
+        then(fn(*args))
+    else:
+        mailbox_jobs.put((fn, args, then))
 
-        # block reserved names:
-        if is_reserved_name(nickname):
-            send_line(client_socket, f"ERR|System|{nickname}|NAME_TAKEN")
+def start_mailbox_worker() -> None:
+    def work():
+        while True:
+            fn, args, then = mailbox_jobs.get()
             try:
-                client_socket.close()
-            except Exception:
-                pass
-            return
+                result = fn(*args)
+            except Exception as e:
+                log.error("mailbox", f"Mailbox I/O failed: {e}", error=repr(e))
+                continue
+            event_loop.call_soon(then, result)
+    threading.Thread(target=work, name="mailbox-io", daemon=True).start()
+
+def take_mail(nickname: str) -> list:
+    return mailboxes.take(nickname) if mailboxes.has_mail(nickname) else []
+
+# A user connected with a name that has mail: everything queued goes out in one write -->
+def deliver_mailbox(sock: socket.socket, nickname: str) -> None:
+    if mailboxes is None:
+        return
+    if event_loop is None and not mailboxes.has_mail(nickname):
+        return
+    mailbox_io(take_mail, (nickname,), lambda queued: send_mail(sock, nickname, queued))
+
+def send_mail(sock: socket.socket, nickname: str, queued: list) -> None:
+    # Same (sender, msg_id) -> publish gives back the line the sender already got (same seq), if still known
+    lines = [publish(sender, nickname, msg_id, text)[0] for sender, msg_id, text, _queued in queued]
+    if lines:
+        send_line(sock, "\n".join(lines))
+        log.info("mailbox", f"{nickname}: delivered {len(lines)} queued messages", user=nickname, delivered=len(lines))
+
+# Delete expired mailboxes now and then, log the numbers -->
+def start_mailbox_sweeper() -> None:
+    def sweep():
+        while True:
+            time.sleep(MAILBOX_SWEEP_SEC)
+            mailboxes.sweep()
+            log.info("mailbox_stats", **mailboxes.metrics())
+    threading.Thread(target=sweep, name="mailbox-sweeper", daemon=True).start()
+
+
+# ====================
+# ===== Profiling ====
+# ====================
+def is_admin(secret: str) -> bool:
+    token = os.environ.get(ADMIN_TOKEN_ENV, "")
+    return bool(token) and hmac.compare_digest(secret.encode("utf-8"), token.encode("utf-8"))
 
+# Sample every thread's stack for `seconds` (in the background). Returns the file name, None if one is running -->
+def start_profile(seconds: float, who: str):
+    profiler = SamplingProfiler(max(0.1, min(seconds, PROFILE_MAX_SEC)))
+
+    def done(p: SamplingProfiler) -> None:
+        log.info("profile", f"Profile written: {p.base}.collapsed + .top.txt "
+                            f"({p.result['samples']} samples, overhead {p.result['overhead'] * 100:.2f}%)",
+                 by=who, path=p.base, **p.result)
+
+    if not profiler.start(done):
+        return None
+    log.info("profile", f"Profiling for {profiler.seconds:g}s (asked by {who})", by=who, seconds=profiler.seconds)
+    return profiler.base
+
+
+# =====================
+# ===== Federation ====
+# =====================
+# Names this node holds (online + parked): what the other nodes must not hand out -->
+def local_names() -> list:
+    with online_users_lock:
+        return [n for n in online_users if not str(n).startswith("__")] + list(parked_names)
+
+def local_avatars() -> list:
+    with online_users_lock:
+        pairs = [(s['nick'], s['avatar']) for s in sessions.values() if s['avatar']]
+    found = [(nick, avatars.get(h)) for nick, h in pairs]
+    return [(nick, url) for nick, url in found if url]
+
+# A message forwarded by another node: it gets our own seq and goes to our own users only -->
+def deliver_from_peer(target: str, sender: str, msg_id: str, text: str) -> None:
+    line, is_new = publish(sender, target, msg_id, text)
+    if not is_new:
+        return
+    if target == "ALL":
+        broadcast(line)
+    elif is_room(target):
+        send_to_room(target, line)
+    else:
         with online_users_lock:
-            if nickname in online_users:
-                send_line(client_socket, f"ERR|System|{nickname}|NAME_TAKEN")
-                try: client_socket.close()
-                except Exception: pass
-                return
-            online_users[nickname] = client_socket
+            target_socket = online_users.get(target)
+        if target_socket is not None:   # Parked: it is in the history for the resume
+            send_line(target_socket, line)
 
-        print(f"--> NEW FRIEND: {nickname} joined from {address}")
+# A user of another node picked an avatar: store the URL here, our clients fetch it from us -->
+def remote_avatar_changed(name: str, url: str) -> None:
+    h = avatars.put(url)
+    if h is not None:
+        broadcast(Protocol.Avatar(name, h).encode())
 
-        # Updating list of users -->
-        tell_everyone_who_is_online()
+# Two nodes gave out the same name at the same moment and the other node won: our user loses it -->
+def lose_name(name: str) -> None:
+    with online_users_lock:
+        user_socket = online_users.get(name)
+        token = parked_names.pop(name, None)
+        if token is not None:
+            sessions.pop(token, None)
+        if user_socket is not None:
+            kicked.add(user_socket)
+    if user_socket is not None:
+        log.warning("name_conflict", f"{name} is taken on another node -> disconnecting ours", user=name)
+        send_frame(user_socket, Protocol.Err("System", name, "NAME_TAKEN"))
+        flush_lines(user_socket)
+        try: user_socket.shutdown(socket.SHUT_RDWR)
+        except OSError: pass
+
+
+# =====================
+# ===== Connections ===
+# =====================
+# The routing below never touches the network itself: it reads lines it is given and writes with send_line.
+# handle_single_client runs it over a TCP socket (one thread each), receive_data on the event loop (--transport
+# loop: one thread for all), Sim_Net over in-memory sockets.
+_session_ids = itertools.count(1)
 
-        # "Join Message": happens only once in the beginning -->
-        broadcast(f"MSG|System|ALL|{make_msg_id()}|{nickname} -> has joined the chat")
+
+class Session:
+    """One client connection, whatever carries it: a TCP socket (thread transport), an Outbox.QueuedSocket (event
+    loop, its outbound queue) or a Sim_Net.MemorySocket. Registered in `connections` by id; the resume record in
+    `sessions` (token -> ...) is separate and outlives it.
+
+    Slots only, no dict per object: with the event loop an idle client is this object, its rate limiter and its
+    socket - no thread stack (Benchmarks.py session_memory).
+    """
+    __slots__ = ("id", "sock", "address", "nickname", "token", "clean_exit", "limiter", "buffer",
+                 "lines_in", "bytes_in", "last_seen", "reaped", "hold")
+
+    def __init__(self, sock, address):
+        self.id = next(_session_ids)
+        self.sock = sock
+        self.address = address
+        self.nickname = None
+        self.token = None
+        self.clean_exit = False     # CMD:QUIT (or kicked) -> the session ends; otherwise it is parked for a resume
+        self.limiter = ConnectionLimiter()  # Per-connection (+ global) messages/sec and bytes/sec buckets
+        self.buffer = ""            # Received text after the last complete line
+        self.lines_in = 0           # Counters (logged when the connection closes)
+        self.bytes_in = 0
+        self.last_seen = clock.monotonic()  # Last line from the client (heartbeats: silence -> PING)
+        self.reaped = False         # Evicted by the heartbeat (no line back after a PING)
+        self.hold = 0.0             # Event loop, RATE_LIMIT_ACTION "delay": seconds to stop reading after this line
+
+
+# A new connection from any transport: its Session, registered by id -->
+def open_connection(sock, address) -> Session:
+    conn = Session(sock, address)
+    with online_users_lock:
+        connections[conn.id] = conn
+    return conn
+
+
+# Event loop: the same first-line timeout as handle_single_client (on the loop thread). The shutdown shows up as EOF -->
+def drop_if_silent(conn: Session) -> None:
+    with client_threads_lock:
+        silent = conn.sock in introducing
+    if silent:
+        log.info("first_line_timeout", f"{conn.address}: no first line in {FIRST_LINE_TIMEOUT_SEC:g}s, closing",
+                 address=conn.address[0])
+        try: conn.sock.shutdown(socket.SHUT_RDWR)
+        except OSError: pass
+
+
+# Thread transport: one TCP connection from accept() to close -->
+def handle_single_client(client_socket: socket.socket, address):
+    conn = open_connection(client_socket, address)
+    try:
+        # ------------------------------------------------------------
+        # ----- Stage 1: receiving the first name and connecting -----
+        # ------------------------------------------------------------
+        with client_threads_lock:
+            introducing.add(client_socket)
+        client_socket.settimeout(FIRST_LINE_TIMEOUT_SEC)  # Heartbeats only watch joined users: a silent one frees its thread
+        try:
+            first_data = client_socket.recv(1024)
+        except socket.timeout:
+            log.info("first_line_timeout", f"{address}: no first line in {FIRST_LINE_TIMEOUT_SEC:g}s, closing",
+                     address=address[0])
+            return
+        finally:
+            with client_threads_lock:
+                introducing.discard(client_socket)
+        client_socket.settimeout(None)
+        conn.bytes_in += len(first_data)
+        first_data = first_data.decode('utf-8', errors='replace')
+        first_line, _, buffer = first_data.partition("\n")  # Anything after the first line is already a command
+        first_line = first_line.strip()
+        if not first_line: return
+        if first_line.startswith(PEER_HELLO):  # Another server of the cluster: this thread runs the peer link
+            if cluster is not None:
+                with online_users_lock:
+                    connections.pop(conn.id, None)
+                cluster.serve(client_socket, buffer, hello=first_line)
+            return
+        conn.buffer = start_connection(conn, first_line, buffer)
+        if conn.buffer is None:
+            return
 
         # -------------------------------------------------------------------
         # ----- Stage 2: the main loop that listens to all the messages -----
         # -------------------------------------------------------------------
-        buffer = ""
         while True:
-            chunk = client_socket.recv(4096).decode('utf-8', errors='replace')
-            if not chunk:
-                break
-            buffer += chunk
-
-            while "\n" in buffer:
-                incoming_data, buffer = buffer.split("\n", 1)
-                incoming_data = incoming_data.strip()
-                if not incoming_data:
-                    continue
-
-                # ----- Client requested clean exit -----
-                if incoming_data.startswith("CMD:QUIT"):
-                    print(f"{nickname} requested quit")
-                    buffer = ""  # optional: drop remaining buffered commands
-                    raise ConnectionResetError  # or: return / break out nicely
-
-                # ----- Name Change Command -----
-                if incoming_data.startswith("CMD:NAME_CHANGE:"):
-                    _, _, new_name_req = incoming_data.split(":", 2)
-
-                    # Updating the dictionary: the old for the new
-                    old_name = nickname
-                    new_name = new_name_req.strip()  # Updating the local variable in the server
-
-                    # validate new name on server side too:
-                    if is_reserved_name(new_name):
-                        send_line(client_socket, f"ERR|System|{old_name}|NAME_TAKEN")
-                        continue
-
-                    with online_users_lock:
-                        if (not new_name) or (new_name in online_users):
-                            send_line(client_socket, f"ERR|System|{old_name}|NAME_TAKEN")
-                            continue
-
-                        # Move socket from old_name to new_name:
-                        if old_name in online_users:
-                            del online_users[old_name]
-                        nickname = new_name
-                        online_users[nickname] = client_socket   # Re-enlisting
-
-                    # ack to the client who requested it -->
-                    send_line(client_socket, f"ACK|System|{old_name}|NAME_CHANGED|{nickname}")
-
-                    print(f"--> {old_name} has changed the user_name to-> {nickname}")
-
-                    # Update list + Inform everyone -->
-                    tell_everyone_who_is_online()
-                    broadcast(f"RENAME|{old_name}|{nickname}")
-                    broadcast(f"MSG|System|ALL|{make_msg_id()}|{old_name} has changed the user_name to-> {nickname}")   # Message to everybody about the change
-                    continue    # Skipping the rest of the loop because it's a command and not a normal text
-
-                # ----- Avatar Change Command -----
-                if incoming_data.startswith("CMD:AVATAR:"):
-                    _, _, avatar_url = incoming_data.split(":", 2)
-                    avatar_url = avatar_url.strip()
-                    print("SERVER GOT AVATAR:", nickname, avatar_url)
-                    if avatar_url:
-                        # broadcast to everyone: AVATAR|username|url
-                        broadcast(f"AVATAR|{nickname}|{avatar_url}")
-                    continue
-
-                # ----- Handling normal messages (TARGET:MSG_ID:TEXT) -----
-                if ":" in incoming_data:
-                    target_raw, rest = incoming_data.split(":", 1)
-                    target_raw = target_raw.strip()
-                    if ":" not in rest:
-                        continue
-                    msg_id, message_text = rest.split(":", 1)
-
-                    target_is_all = (target_raw.upper() == "ALL")
-                    target = "ALL" if target_is_all else target_raw
-
-                    if target_is_all:
-                        formatted_msg = f"MSG|{nickname}|ALL|{msg_id}|{message_text}"
-                        with online_users_lock:
-                            sockets = list(online_users.values())
-                        for user_socket in sockets:
-                            send_line(user_socket, formatted_msg)
-                    else:
-                        # Lookup exact username (no .upper())
-                        with online_users_lock:
-                            target_socket = online_users.get(target)
-                        if target_socket:   # Sending to target
-                            formatted_msg = f"MSG|{nickname}|{target}|{msg_id}|{message_text}"
-                            send_line(target_socket, formatted_msg)
-                            if target != nickname:  # Preventing duplication in client
-                                send_line(client_socket, formatted_msg)
+            if "\n" not in conn.buffer:  # Lines that came with the first packet are handled before reading more
+                chunk = client_socket.recv(4096)
+                if not chunk:
+                    break
+                conn.bytes_in += len(chunk)
+                conn.buffer += chunk.decode('utf-8', errors='replace')
+                if line_too_long(conn):
+                    break
+
+            while "\n" in conn.buffer:
+                incoming_data, conn.buffer = conn.buffer.split("\n", 1)
+                if not handle_line(conn, incoming_data):
+                    return
 
     except (ConnectionResetError, BrokenPipeError):
         pass
     except Exception as e:
-        print(f"Error handling client {nickname}: {e}")
+        log.error("client_error", f"Error handling client {conn.nickname}: {e}", user=conn.nickname, error=repr(e))
     finally:    # Handling exit
-        should_announce = False
+        end_connection(conn)
+        with client_threads_lock:
+            client_threads.discard(threading.current_thread())
+
+
+# A line that never ends: drop the connection -->
+def line_too_long(conn: Session) -> bool:
+    if "\n" in conn.buffer or len(conn.buffer) <= PROTOCOL_MAX_LINE_BYTES:
+        return False
+    log.warning("line_too_long", f"{conn.nickname}: line over {PROTOCOL_MAX_LINE_BYTES} bytes, disconnecting",
+                user=conn.nickname)
+    return True
+
+
+# Event-loop transport: bytes a client sent (on the loop thread, so nothing here may block for long).
+# The same stages as handle_single_client. True -> keep reading, False -> close, None -> handed off (peer link) -->
+def receive_data(conn: Session, data: bytes):
+    conn.bytes_in += len(data)
+    conn.buffer += data.decode('utf-8', errors='replace')
+    try:
+        if conn.nickname is None:  # Stage 1: the first packet holds the name (or CMD:RESUME)
+            with client_threads_lock:
+                introducing.discard(conn.sock)
+            first_line, _, buffer = conn.buffer.partition("\n")
+            first_line = first_line.strip()
+            if not first_line:
+                return False
+            if first_line.startswith(PEER_HELLO):  # A peer link blocks on its socket: it gets a thread of its own
+                if cluster is None:
+                    return False
+                with online_users_lock:
+                    connections.pop(conn.id, None)
+                peer_socket = event_loop.detach(conn)
+                threading.Thread(target=cluster.serve, args=(peer_socket, buffer), kwargs={"hello": first_line},
+                                 daemon=True).start()
+                return None
+            conn.buffer = start_connection(conn, first_line, buffer)
+            if conn.buffer is None:
+                return False
+
+        while "\n" in conn.buffer:  # Stage 2: every complete line
+            incoming_data, conn.buffer = conn.buffer.split("\n", 1)
+            if not handle_line(conn, incoming_data):
+                return False
+            if conn.hold:   # Over its rate: the rest waits until the loop reads this connection again
+                event_loop.pause(conn, conn.hold)
+                conn.hold = 0.0
+                return True
+        return not line_too_long(conn)
+    except (ConnectionResetError, BrokenPipeError):
+        return False
+    except Exception as e:
+        log.error("client_error", f"Error handling client {conn.nickname}: {e}", user=conn.nickname, error=repr(e))
+        return False
+
+
+# The first line of a connection: a name (join) or CMD:RESUME. Returns the unread rest, None = connection over -->
+def start_connection(conn: Session, first_line: str, buffer: str = ""):
+    client_socket, address = conn.sock, conn.address
+    if buffer.startswith("CMD:CAPS:"):  # Negotiated before the join/resume, so a replay is compressed too
+        caps_line, _, buffer = buffer.partition("\n")
+        caps = Protocol.decode_command(caps_line.strip())
+        if isinstance(caps, Protocol.Caps):
+            negotiate_caps(client_socket, caps.caps, "?")
+
+    # ----- Resume: CMD:RESUME:<token>:<last_msg_id> -----
+    hello = Protocol.decode_command(first_line) if first_line.startswith("CMD:") else None
+    if isinstance(hello, Protocol.Resume):
+        token = hello.token.strip()
+        nickname = take_over_session(token, client_socket)
+        if nickname is None:  # Unknown or expired session -> the client joins again with its name
+            send_frame(client_socket, Protocol.Err("System", "?", "RESUME_FAILED"))
+            return None
+        conn.nickname, conn.token = nickname, token
+        log.info("resume", f"--> {nickname} resumed from {address}", user=nickname, address=address[0])
+        send_frame(client_socket, Protocol.Session("System", nickname, token, server_epoch))
+        send_frame(client_socket, Protocol.Ack("System", nickname, "RESUMED", nickname))
+        with online_users_lock:
+            joined = set(sessions[token]['rooms'])
+        missed = missed_lines(nickname, hello.last_msg_id.strip(), joined)
+        if missed:
+            send_line(client_socket, "\n".join(missed))  # One write for the whole backlog
+        send_avatar_snapshot(client_socket, nickname)  # What changed while we were away
+        with online_users_lock:
+            avatar_hash = sessions.get(token, {}).get('avatar')
+        if avatar_hash:
+            broadcast(Protocol.Avatar(nickname, avatar_hash).encode())
+        tell_everyone_who_is_online()
+        watch_connection(conn)
+        return buffer
+
+    nickname = first_line
+    conn.nickname = nickname
+
+    # block reserved names:
+    if is_reserved_name(nickname):
+        send_frame(client_socket, Protocol.Err("System", nickname, "NAME_TAKEN"))
+        flush_lines(client_socket)
+        try:
+            client_socket.close()
+        except Exception:
+            pass
+        return None
+
+    with online_users_lock:
+        if name_in_use(nickname):
+            send_frame(client_socket, Protocol.Err("System", nickname, "NAME_TAKEN"))
+            flush_lines(client_socket)
+            try: client_socket.close()
+            except Exception: pass
+            return None
+        online_users[nickname] = client_socket
+    if cluster is not None:  # Claim the name on every node
+        cluster.local_joined(nickname)
+
+    conn.token = open_session(nickname, client_socket)
+    send_frame(client_socket, Protocol.Session("System", nickname, conn.token, server_epoch))
+    send_avatar_snapshot(client_socket, nickname)  # Late joiners learn the avatars already picked
+    log.info("join", f"--> NEW FRIEND: {nickname} joined from {address}", user=nickname, address=address[0])
+
+    # Updating list of users -->
+    tell_everyone_who_is_online()
+
+    # "Join Message": happens only once in the beginning -->
+    announce(f"{nickname} -> has joined the chat")
+    deliver_mailbox(client_socket, nickname)  # Private messages that came while this name was offline
+    watch_connection(conn)
+    return buffer
+
+
+# One line from a joined client. False -> the connection ends (QUIT, rate limit disconnect) -->
+def handle_line(conn: Session, incoming_data: str) -> bool:
+    conn.last_seen = clock.monotonic()  # Any line (an empty one too) proves the client is alive
+    incoming_data = incoming_data.strip()
+    if not incoming_data:
+        return True
+    conn.lines_in += 1
+
+    # ----- Compressed line (may hold several lines) -> handle the lines inside -----
+    if incoming_data.startswith(Compression.PREFIX):
+        try:
+            inner = Compression.decode_line(incoming_data)
+        except ValueError as e:
+            log.warning("bad_frame", f"{conn.nickname}: {e}", user=conn.nickname, error=str(e))
+            return True
+        return all(handle_line(conn, line) for line in inner.split("\n"))
+
+    frame = Protocol.decode_command(incoming_data)
+
+    # ----- Client requested clean exit -----
+    if type(frame) is Protocol.Quit:
+        log.info("quit", f"{conn.nickname} requested quit", user=conn.nickname)
+        conn.clean_exit = True
+        return False
+
+    # ----- Flood protection (everything except QUIT is counted) -----
+    verdict, wait = conn.limiter.decide(len(incoming_data), clock.monotonic())
+    if verdict == ACTION_DELAY:     # Let it through, but hold back only this client
+        if event_loop is None:
+            time.sleep(wait)        # Its own handler thread
+        else:
+            conn.hold = max(conn.hold, wait)    # Not read for a while (receive_data); never sleep the loop
+    elif verdict == ACTION_DISCONNECT:
+        log.warning("rate_limit", f"{conn.nickname} disconnected: rate limit", user=conn.nickname)
+        conn.clean_exit = True
+        return False
+    if verdict == ACTION_ERROR:
+        send_frame(conn.sock, Protocol.Err("System", conn.nickname, "RATE_LIMITED"))
+        return True
+    if verdict == ACTION_DROP or frame is None:     # Unknown command / broken line: ignored
+        return True
+
+    return COMMAND_HANDLERS[type(frame)](conn, frame)
+
+
+# =================================================
+# ===== Commands (one handler per frame type) =====
+# =================================================
+# Each handler gets the connection and the decoded frame. False -> the connection ends -->
+
+# ----- Name Change Command: CMD:NAME_CHANGE:<new name> -----
+def cmd_name_change(conn: Session, frame: Protocol.NameChange) -> bool:
+    client_socket, token = conn.sock, conn.token
+
+    # Updating the dictionary: the old for the new
+    old_name = conn.nickname
+    new_name = frame.name.strip()  # Updating the local variable in the server
+
+    # validate new name on server side too:
+    if is_reserved_name(new_name):
+        send_frame(client_socket, Protocol.Err("System", old_name, "NAME_TAKEN"))
+        return True
+
+    with online_users_lock:
+        if (not new_name) or name_in_use(new_name):
+            send_frame(client_socket, Protocol.Err("System", old_name, "NAME_TAKEN"))
+            return True
+
+        # Move socket from old_name to new_name:
+        if old_name in online_users:
+            del online_users[old_name]
+        nickname = conn.nickname = new_name
+        online_users[nickname] = client_socket   # Re-enlisting
+        if token in sessions:
+            sessions[token]['nick'] = nickname
+
+    # ack to the client who requested it -->
+    send_frame(client_socket, Protocol.Ack("System", old_name, "NAME_CHANGED", nickname))
+
+    log.info("rename", f"--> {old_name} has changed the user_name to-> {nickname}", user=nickname, old=old_name)
+
+    # Update list + Inform everyone -->
+    rename_line = Protocol.Rename(old_name, nickname).encode()
+    if cluster is not None:
+        cluster.local_left(old_name)
+        cluster.local_joined(nickname)
+        cluster.forward_raw(rename_line)
+    tell_everyone_who_is_online()
+    broadcast(rename_line)
+    announce(f"{old_name} has changed the user_name to-> {nickname}")   # Message to everybody about the change
+    return True    # A command, not a normal text
+
+# ----- Avatar Change Command (stored once by hash; everyone gets only the hash) -----
+def cmd_set_avatar(conn: Session, frame: Protocol.SetAvatar) -> bool:
+    nickname = conn.nickname
+    avatar_url = frame.url.strip()
+    if avatar_url:
+        avatar_hash = avatars.put(avatar_url)
+        if avatar_hash is None:
+            send_frame(conn.sock, Protocol.Err("System", nickname, "AVATAR_TOO_LARGE"))
+            return True
+        with online_users_lock:
+            session = sessions.get(conn.token)
+            changed = session is not None and session['avatar'] != avatar_hash
+            if changed:
+                session['avatar'] = avatar_hash  # Re-sent to everyone after a resume
+        log.info("avatar", f"{nickname} picked avatar {avatar_hash}", user=nickname, hash=avatar_hash)
+        if changed:  # broadcast to everyone: AVATAR|username|hash
+            broadcast(Protocol.Avatar(nickname, avatar_hash).encode())
+            if cluster is not None:  # The other nodes store the URL themselves
+                cluster.forward_avatar(nickname, avatar_url)
+    return True
+
+# ----- Avatar fetch: CMD:AVATAR_GET:<hash> -> AVATAR_BLOB|System|<hash>|<url> -----
+def cmd_get_avatar(conn: Session, frame: Protocol.GetAvatar) -> bool:
+    avatar_hash = frame.avatar_hash.strip()
+    avatar_url = avatars.get(avatar_hash)
+    if avatar_url is None:
+        send_frame(conn.sock, Protocol.Err("System", conn.nickname, "NO_AVATAR"))
+    else:
+        send_frame(conn.sock, Protocol.AvatarBlob("System", avatar_hash, avatar_url))
+    return True
 
+# ----- Capabilities (if they did not come with the first line) -----
+def cmd_caps(conn: Session, frame: Protocol.Caps) -> bool:
+    negotiate_caps(conn.sock, frame.caps, conn.nickname)
+    return True
+
+# ----- Rooms: CMD:JOIN:#room / CMD:PART:#room / CMD:ROOMS -----
+def cmd_join_room(conn: Session, frame: Protocol.JoinRoom) -> bool:
+    nickname, room = conn.nickname, frame.room.strip()
+    if not valid_room(room):
+        send_frame(conn.sock, Protocol.Err("System", nickname, "BAD_ROOM"))
+        return True
+    is_new = join_room(conn.token, conn.sock, room)
+    send_frame(conn.sock, Protocol.Ack("System", nickname, "JOINED", room))
+    if is_new:
+        announce_room(room, f"{nickname} -> has joined {room}")
+    return True
+
+def cmd_part_room(conn: Session, frame: Protocol.PartRoom) -> bool:
+    nickname, room = conn.nickname, frame.room.strip()
+    if not valid_room(room):
+        send_frame(conn.sock, Protocol.Err("System", nickname, "BAD_ROOM"))
+        return True
+    if part_room(conn.token, conn.sock, room):
+        announce_room(room, f"{nickname} -> has left {room}")
+    send_frame(conn.sock, Protocol.Ack("System", nickname, "PARTED", room))
+    return True
+
+def cmd_list_rooms(conn: Session, frame: Protocol.ListRooms) -> bool:
+    with online_users_lock:
+        names = ",".join(sorted(rooms))
+    send_frame(conn.sock, Protocol.Rooms("System", conn.nickname, names))
+    return True
+
+# ----- Admin: CMD:PROFILE:<admin token>[:<seconds>] -> sampling profile of the whole server -----
+def cmd_profile(conn: Session, frame: Protocol.Profile) -> bool:
+    nickname = conn.nickname
+    if not is_admin(frame.secret):
+        send_frame(conn.sock, Protocol.Err("System", nickname, "NOT_ADMIN"))
+        return True
+    try:
+        seconds = float(frame.seconds or PROFILE_DEFAULT_SEC)
+    except ValueError:
+        seconds = PROFILE_DEFAULT_SEC
+    base = start_profile(seconds, nickname)
+    if base is None:
+        send_frame(conn.sock, Protocol.Err("System", nickname, "PROFILE_BUSY"))
+    else:
+        send_frame(conn.sock, Protocol.Ack("System", nickname, "PROFILE", os.path.basename(base)))
+    return True
+
+# ----- History range: CMD:HISTORY:<ALL, #room or other user>:<from_seq>:<to_seq> -----
+def cmd_history(conn: Session, frame: Protocol.History) -> bool:
+    try:
+        lo, hi = int(frame.lo), int(frame.hi)
+    except ValueError:
+        return True
+    other = frame.other.strip()
+    if is_room(other) and not in_room(conn.token, other):
+        return True
+    channel = channel_of(conn.nickname, "ALL" if other.upper() == "ALL" else other)
+    lines = channel_range(channel, lo, min(hi, lo + SERVER_HISTORY_SIZE - 1))
+    if lines:
+        send_line(conn.sock, "\n".join(lines))  # One write for the whole range
+    return True
+
+# ----- Heartbeat answer: CMD:PONG:<stamp> (handle_line already noted that the client is alive) -----
+def cmd_pong(conn: Session, frame: Protocol.Pong) -> bool:
+    heartbeat_stats["pongs"] += 1
+    return True
+
+# ----- Handling normal messages (TARGET:MSG_ID:TEXT) -----
+def cmd_send(conn: Session, frame: Protocol.Send) -> bool:
+    client_socket, nickname = conn.sock, conn.nickname
+    target_raw, msg_id, message_text = frame.target.strip(), frame.msg_id, frame.text
+    log.debug("msg", sender=nickname, target=target_raw, msg_id=msg_id, bytes=len(message_text))
+
+    target_is_all = (target_raw.upper() == "ALL")
+    target = "ALL" if target_is_all else target_raw
+
+    if is_room(target):  # Only the room's members (the subscription index), not everyone
+        if not in_room(conn.token, target):
+            send_frame(client_socket, Protocol.Err("System", nickname, "NOT_IN_ROOM"))
+            return True
+        formatted_msg, is_new = publish(nickname, target, msg_id, message_text)
+        if not is_new:
+            send_line(client_socket, formatted_msg)
+            return True
+        send_to_room(target, formatted_msg)
+        if cluster is not None:
+            cluster.forward_all(target, nickname, msg_id, message_text)
+    elif target_is_all:
+        formatted_msg, is_new = publish(nickname, "ALL", msg_id, message_text)
+        if not is_new:  # Resent after a reconnect: only the sender needs the (same) line again
+            send_line(client_socket, formatted_msg)
+            return True
         with online_users_lock:
-            if nickname and nickname in online_users:
-                del online_users[nickname]
+            sockets = list(online_users.values())
+        for user_socket in sockets:
+            send_line(user_socket, formatted_msg)
+        if cluster is not None:  # One line per node, each node fans out to its own users
+            cluster.forward_all("ALL", nickname, msg_id, message_text)
+    else:
+        # Lookup exact username (no .upper())
+        with online_users_lock:
+            target_socket = online_users.get(target)
+            target_parked = target in parked_names  # Dropped, may resume -> gets it on replay
+        if target_socket or target_parked:   # Sending to target
+            formatted_msg, is_new = publish(nickname, target, msg_id, message_text)
+            if target_socket and is_new:
+                send_line(target_socket, formatted_msg)
+            if target != nickname:  # Preventing duplication in client
+                send_line(client_socket, formatted_msg)
+        elif cluster is not None and cluster.owner_of(target) is not None:
+            # Lives on another node: only that node gets it (the sender still gets our line)
+            formatted_msg, is_new = publish(nickname, target, msg_id, message_text)
+            if is_new:
+                cluster.forward_to_owner(target, nickname, msg_id, message_text)
+            send_line(client_socket, formatted_msg)
+        elif mailboxes is not None and not is_reserved_name(target):
+            # Offline: kept on disk until somebody connects with this name (the sender's line once it is stored)
+            formatted_msg, is_new = publish(nickname, target, msg_id, message_text)
+            if not is_new:
+                send_line(client_socket, formatted_msg)
+                return True
+            def stored(ok: bool) -> None:
+                if ok:
+                    send_line(client_socket, formatted_msg)
+                else:
+                    send_frame(client_socket, Protocol.Err("System", nickname, "MAILBOX_FULL"))
+            mailbox_io(mailboxes.put, (target, nickname, msg_id, message_text), stored)
+    return True
+
+
+# Frame type -> handler (built once; handle_line does one dict lookup per line) -->
+COMMAND_HANDLERS = {
+    Protocol.Send: cmd_send,
+    Protocol.NameChange: cmd_name_change,
+    Protocol.SetAvatar: cmd_set_avatar,
+    Protocol.GetAvatar: cmd_get_avatar,
+    Protocol.Caps: cmd_caps,
+    Protocol.JoinRoom: cmd_join_room,
+    Protocol.PartRoom: cmd_part_room,
+    Protocol.ListRooms: cmd_list_rooms,
+    Protocol.Profile: cmd_profile,
+    Protocol.History: cmd_history,
+    Protocol.Pong: cmd_pong,
+    Protocol.Resume: lambda conn, frame: True,   # Only valid as the first line
+}
+
+
+# The connection is over (closed, dropped, QUIT): park or end the session, tell the others -->
+def end_connection(conn: Session) -> None:
+    client_socket, nickname, token, clean_exit = conn.sock, conn.nickname, conn.token, conn.clean_exit
+    should_announce = False
+    should_park = False
+
+    with online_users_lock:
+        connections.pop(conn.id, None)
+        for room in sessions.get(token, {}).get('rooms', ()):  # This socket gets no room messages anymore
+            unsubscribe(client_socket, room)
+        # Only if the name is still ours (a resume may already have moved it to a new socket):
+        if nickname and online_users.get(nickname) is client_socket:
+            del online_users[nickname]
+            session = sessions.get(token)
+            if client_socket in kicked:  # The name went to another node: no "left" message for it
+                sessions.pop(token, None)
+            elif clean_exit or session is None:
+                sessions.pop(token, None)
                 should_announce = True
+            else:
+                should_park = True
+    wheel.cancel(("idle", conn.id))
 
-        # Exiting message -->
-        if should_announce:
-            broadcast(f"MSG|System|ALL|{make_msg_id()}|{nickname} -> has disconnected")
+    # Dropped connection: the client will probably resume -> no "left" message yet. Not while draining:
+    # this process is about to exit (its timer wheel is already stopped) -->
+    if should_park and not draining.is_set():
+        park_session(token)
+        log.info("park", f"{nickname} dropped, session kept for {RESUME_GRACE_SEC:.0f}s", user=nickname)
 
-        try: client_socket.close()
-        except Exception: pass
-        print(f"Connection closed for {nickname}")
+    if should_announce and cluster is not None:
+        cluster.local_left(nickname)
+    # Exiting message (skipped while draining: everybody is leaving anyway) -->
+    if should_announce and not draining.is_set():
+        broadcast(Protocol.Leave("System", "ALL", nickname, "timeout" if conn.reaped else "left").encode())
+        announce(f"{nickname} -> has disconnected")
+
+    compressing.discard(client_socket)
+    kicked.discard(client_socket)
+    if batcher is not None:
+        batcher.release(client_socket)  # Last lines (e.g. RESUME_FAILED) still go out
+    try: client_socket.close()
+    except Exception: pass
+    log.info("close", f"Connection closed for {nickname}", user=nickname, lines=conn.lines_in, bytes=conn.bytes_in)
+    if not draining.is_set():
         tell_everyone_who_is_online()
 
-def wake_up_server():
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+# ======================
+# ===== Heartbeats =====
+# ======================
+# A joined connection is checked once per idle period on the timer wheel (one entry per connection, moved
+# instead of added to): quiet for HEARTBEAT_IDLE_SEC -> PING, still quiet HEARTBEAT_TIMEOUT_SEC later -> reaped.
+def watch_connection(conn: Session) -> None:
+    if heartbeat['idle'] > 0:
+        wheel.schedule(("idle", conn.id), heartbeat['idle'], check_idle, conn)
+
+def check_idle(conn: Session) -> None:
+    if conn.id not in connections:  # Closed meanwhile
+        return
+    now = clock.monotonic()
+    quiet = now - conn.last_seen
+    if quiet < heartbeat['idle']:   # It spoke meanwhile -> look again when it could be idle
+        wheel.schedule(("idle", conn.id), heartbeat['idle'] - quiet, check_idle, conn)
+        return
+    heartbeat_stats["pings"] += 1
+    wheel.schedule(("idle", conn.id), heartbeat['timeout'], check_pong, conn, now)
+    try:
+        send_frame(conn.sock, Protocol.Ping("System", conn.nickname, str(int(now * 1000))))
+    except OSError:
+        pass
+
+def check_pong(conn: Session, sent: float) -> None:
+    if conn.id not in connections:
+        return
+    if conn.last_seen >= sent:  # PONG (or any other line) came back
+        check_idle(conn)
+    else:
+        reap(conn)
+
+# No line back after the PING: the peer is gone (sleeping laptop, NAT dropped the mapping). Ended like a QUIT
+# (no parking), by its transport: the shutdown wakes its recv / the event loop, which run end_connection -->
+def reap(conn: Session) -> None:
+    heartbeat_stats["reaped"] += 1
+    conn.reaped = conn.clean_exit = True
+    log.info("reap", f"{conn.nickname}: no answer to PING, disconnecting", user=conn.nickname,
+             quiet=round(clock.monotonic() - conn.last_seen, 1))
+    try: conn.sock.shutdown(socket.SHUT_RDWR)
+    except OSError: pass
+
+
+# =============================
+# ===== Drain / Hot restart ===
+# =============================
+# Start a new server process that inherits our listening socket (zero-downtime restart) -->
+def spawn_successor(server: socket.socket) -> subprocess.Popen:
+    fd = server.fileno()
+    os.set_inheritable(fd, True)
+    env = dict(os.environ, **{LISTEN_FD_ENV: str(fd)})
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__), *sys.argv[1:]], env=env, pass_fds=(fd,),
+                            start_new_session=True)
+
+# Stop accepting, tell every client to reconnect later, flush and wait for them to leave -->
+# Returns how long the whole drain took (seconds).
+def drain_server(server: socket.socket, handoff: bool = False) -> float:
+    t0 = time.monotonic()
+    draining.set()
+    wheel.stop()    # No heartbeats while everybody leaves (and no parking: no grace timers either)
+    if handoff:  # The successor starts accepting on the same socket while we drain
+        save_resume_state()  # ...and lets our clients resume their sessions there
+        successor = spawn_successor(server)
+        log.info("hot_restart", f"Hot restart: successor pid {successor.pid} took over port {server.getsockname()[1]}",
+                 pid=successor.pid)
+    try: server.close()  # Our copy only (the successor keeps its own)
+    except Exception: pass
+    if cluster is not None:  # Peers drop our users until we (or the successor) link up again
+        cluster.stop()
+
+    with client_threads_lock:  # Nobody behind these yet: close now (the client's pool replaces them)
+        idle = list(introducing)
+    for sock in idle:
+        try: sock.shutdown(socket.SHUT_RDWR)
+        except OSError: pass
+
+    with online_users_lock:
+        sockets = list(online_users.items())
+    log.info("drain", f"Draining {len(sockets)} connections...", connections=len(sockets))
+    for name, sock in sockets:
+        # Each client picks a random delay in the window, so they don't all come back at once:
+        send_frame(sock, Protocol.Reconnect("System", name, str(DRAIN_RECONNECT_MIN_MS), str(DRAIN_RECONNECT_MAX_MS)))
+        flush_lines(sock)
+        try: sock.shutdown(socket.SHUT_WR)  # FIN goes out only after everything queued was sent (= flushed)
+        except OSError: pass
+
+    # Wait for the clients to close (their handler threads end), then force close whoever is left:
+    deadline = t0 + DRAIN_TIMEOUT_SEC
+    with client_threads_lock:
+        threads = list(client_threads)
+    for t in threads:
+        t.join(max(0.0, deadline - time.monotonic()))
+    while connections and time.monotonic() < deadline:  # Event loop: no threads, its connections close one by one
+        time.sleep(0.01)
+    with online_users_lock:
+        leftovers = list(online_users.values())
+    for sock in leftovers:
+        try: sock.close()
+        except Exception: pass
+    if event_loop is not None:
+        event_loop.stop()
+
+    took = time.monotonic() - t0
+    log.info("drain_done", f"Drain finished in {took:.3f}s ({len(leftovers)} forced)", seconds=round(took, 3), forced=len(leftovers))
+    log.close()     # Whatever is still queued reaches the file (and stdout) before the numbers
+    print("OUTBOX_STATS " + json.dumps(Outbox.stats), flush=True)  # Send syscalls vs. delivered lines
+    if mailboxes is not None:
+        print("MAILBOX_STATS " + json.dumps(mailboxes.metrics()), flush=True)  # Depth + delivery latency
+    if cluster is not None:
+        print("FEDERATION_STATS " + json.dumps(cluster.stats), flush=True)  # Lines sent / received on peer links
+    print("HEARTBEAT_STATS " + json.dumps(dict(heartbeat_stats, wheel=wheel.stats)), flush=True)  # Pings / reaped
+    print("LOG_STATS " + json.dumps(log.stats), flush=True)
+    return took
+
+# SIGTERM -> drain and exit, SIGHUP -> hot restart (handoff + drain) -->
+def install_signal_handlers() -> None:
+    def request(mode):
+        def handler(_signum, _frame):
+            stop_request['mode'] = stop_request['mode'] or mode
+        return handler
+    signal.signal(signal.SIGTERM, request("drain"))
+    if hasattr(signal, "SIGHUP"):  # Not on Windows
+        signal.signal(signal.SIGHUP, request("handoff"))
+    if hasattr(signal, "SIGUSR1"):  # Whoever may signal the process is an admin
+        signal.signal(signal.SIGUSR1, lambda _signum, _frame: start_profile(PROFILE_DEFAULT_SEC, "SIGUSR1"))
+
+
+# Answer LAN discovery probes (Connection_Manager.discover) with our TCP port -->
+def start_discovery_responder(port: int) -> None:
     try:
-        server.bind((HOST, PORT))
-        server.listen(5)
-        print(f"Server is listening on port {PORT}...")
+        udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, "SO_REUSEPORT"):  # A hot-restart successor binds while we still drain
+            udp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        udp.bind((HOST, DISCOVERY_PORT))
+    except OSError as e:
+        log.warning("discovery", f"Discovery is off (UDP {DISCOVERY_PORT}): {e}", error=str(e))
+        return
 
+    def answer():
+        reply = f"{DISCOVERY_REPLY}|{port}".encode('utf-8')
         while True:
-            client, addr = server.accept()
-            threading.Thread(target=handle_single_client, args=(client, addr)).start()
+            try:
+                data, sender = udp.recvfrom(256)
+                if data.strip() == DISCOVERY_PROBE:
+                    udp.sendto(reply, sender)
+            except OSError:
+                return
+    threading.Thread(target=answer, name="discovery", daemon=True).start()
+
+
+def wake_up_server(port: int = PORT, batch_ms: float = SEND_BATCH_WINDOW_MS, batch_bytes: int = SEND_BATCH_MAX_BYTES,
+                   node_id: str = "", peers=(), log_level: str = LOG_LEVEL, log_sample=None,
+                   transport: str = SERVER_TRANSPORT, heartbeat_sec: float = HEARTBEAT_IDLE_SEC,
+                   heartbeat_timeout: float = HEARTBEAT_TIMEOUT_SEC):
+    global batcher, cluster, mailboxes, event_loop
+    log.configure(log_level, log_sample)
+    log.start()
+    heartbeat['idle'], heartbeat['timeout'] = heartbeat_sec, heartbeat_timeout
+    wheel.start()   # Before load_resume_state: parked sessions wait on it
+    if heartbeat_sec > 0:
+        log.info("startup", f"Heartbeats: PING after {heartbeat_sec:g}s of silence, evicted {heartbeat_timeout:g}s later")
+    if batch_ms > 0:
+        batcher = Outbox.Batcher(batch_ms / 1000.0, batch_bytes, SEND_BATCH_MAX_QUEUED_BYTES)
+        log.info("startup", f"Micro-batching outbound lines: {batch_ms} ms / {batch_bytes} bytes")
+    if transport == "loop":
+        event_loop = EventLoop(receive_data, end_connection, LOOP_MAX_QUEUED_BYTES)
+        event_loop.start()
+        log.info("startup", "Transport: one event loop for every client")
+    inherited_fd = os.environ.pop(LISTEN_FD_ENV, None)
+    try:
+        if inherited_fd is not None:  # Hot restart: the previous server handed us its listening socket
+            server = socket.socket(fileno=int(inherited_fd))
+            log.info("startup", f"Server took over the listening socket on port {server.getsockname()[1]}...")
+            load_resume_state()
+        else:
+            server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server.bind((HOST, port))
+            server.listen(socket.SOMAXCONN)  # Room for the reconnect herd after a restart
+            log.info("startup", f"Server is listening on port {port}...", port=port)
+        server.settimeout(0.1)  # Wake up regularly to notice drain requests
+        if DISCOVERY_ENABLED:
+            start_discovery_responder(server.getsockname()[1])
+        if MAILBOX_ENABLED:
+            mailboxes = MailboxStore()
+            log.info("startup", f"Mailboxes: {mailboxes.directory} ({len(mailboxes.depth)} waiting for their user)")
+            start_mailbox_sweeper()
+            if event_loop is not None:
+                start_mailbox_worker()
+        peer_secret = os.environ.get(PEER_SECRET_ENV, "")
+        if peers and not peer_secret:   # Anybody could call itself a peer: stay a lone server
+            log.error("startup", f"--peers needs the cluster secret in {PEER_SECRET_ENV}: federation is off")
+        elif peers:
+            node_id = node_id or f"127.0.0.1:{server.getsockname()[1]}"
+            cluster = Cluster(node_id, list(peers), local_names, local_avatars, deliver_from_peer,
+                              tell_everyone_who_is_online, lose_name, remote_avatar_changed, broadcast, peer_secret)
+            cluster.start()
+            log.info("startup", f"Node {node_id}, peers: {', '.join(cluster.peers)}", node=node_id)
+        install_signal_handlers()
+
+        while stop_request['mode'] is None:
+            try:
+                client, addr = server.accept()
+            except socket.timeout:
+                continue
+            if event_loop is not None:
+                conn = open_connection(event_loop.wrap(client), addr)
+                with client_threads_lock:
+                    introducing.add(conn.sock)
+                event_loop.add(conn)
+                event_loop.call_later(FIRST_LINE_TIMEOUT_SEC, drop_if_silent, conn)
+                continue
+            t = threading.Thread(target=handle_single_client, args=(client, addr))
+            with client_threads_lock:
+                client_threads.add(t)
+            t.start()
+
+        drain_server(server, handoff=(stop_request['mode'] == "handoff"))
     except Exception as e:
-        print(f"CRITICAL SERVER ERROR: {e}")
+        log.error("critical", f"CRITICAL SERVER ERROR: {e}", error=repr(e))
+        log.close()
 
 
 if __name__ == "__main__":
-    wake_up_server()
\ No newline at end of file
+    import argparse
+    parser = argparse.ArgumentParser(description="BotChat TCP server")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--batch-ms", type=float, default=SEND_BATCH_WINDOW_MS,
+                        help="Micro-batch outbound lines per connection for this long (0 = off)")
+    parser.add_argument("--batch-kb", type=int, default=SEND_BATCH_MAX_BYTES // 1024,
+                        help="Flush a connection's batch early once it holds this many KB")
+    parser.add_argument("--node-id", default="",
+                        help="host:port the other nodes reach this server at (default 127.0.0.1:<port>)")
+    parser.add_argument("--peers", default="",
+                        help="Comma separated host:port of the other nodes (every node lists all the others)")
+    parser.add_argument("--log-level", default=LOG_LEVEL, choices=list(LEVELS),
+                        help="Lowest level written to the server log")
+    parser.add_argument("--log-sample", type=int, default=None,
+                        help="Keep one 'msg' record in N (1 = every message; needs --log-level debug)")
+    parser.add_argument("--transport", default=SERVER_TRANSPORT, choices=["threads", "loop"],
+                        help="One handler thread per client, or every client on one event loop (less memory per idle client)")
+    parser.add_argument("--heartbeat-sec", type=float, default=HEARTBEAT_IDLE_SEC,
+                        help="PING a client after this many seconds of silence (0 = no heartbeats)")
+    parser.add_argument("--heartbeat-timeout", type=float, default=HEARTBEAT_TIMEOUT_SEC,
+                        help="Evict a client that sent nothing this long after its PING")
+    args = parser.parse_args()
+    wake_up_server(args.port, args.batch_ms, args.batch_kb * 1024, args.node_id,
+                   [p.strip() for p in args.peers.split(",") if p.strip()], args.log_level,
+                   None if args.log_sample is None else {"msg": args.log_sample}, args.transport,
+                   args.heartbeat_sec, args.heartbeat_timeout)
\ No newline at end of file
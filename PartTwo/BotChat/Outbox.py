@@ -0,0 +1,296 @@
+"""Server -> client writes: opt-in micro-batching (Nagle-style, one writev per connection per window) and the
+event loop's never-blocking sockets"""
+
+import select
+import socket
+import threading
+import time
+from collections import deque
+from typing import Dict, List
+
+# Server wide counters (printed by the server when it stops, read by Benchmarks.py) -->
+stats: Dict[str, int] = {"frames": 0, "syscalls": 0, "bytes": 0, "size_flushes": 0, "stalled_drops": 0}
+stats_lock = threading.Lock()
+
+HAVE_SENDMSG = hasattr(socket.socket, "sendmsg")  # Not on Windows -> join + sendall
+DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0)      # Per call non-blocking send on a blocking socket (not on Windows)
+FALLBACK_CHUNK = 1024                               # Without MSG_DONTWAIT: most bytes per send once select says writable
+
+
+def _count(frames: int, nbytes: int, size_flush: bool = False) -> None:
+    with stats_lock:
+        stats["frames"] += frames
+        stats["syscalls"] += 1
+        stats["bytes"] += nbytes
+        if size_flush:
+            stats["size_flushes"] += 1
+
+
+# Unbatched path: one sendall per line (what the server always did) -->
+def send_now(sock: socket.socket, data: bytes) -> None:
+    try:
+        sock.sendall(data)
+    except Exception:
+        return
+    _count(1, len(data))
+
+
+# Write many frames with as few syscalls as possible, without ever blocking. Returns the bytes the kernel took -->
+def write_frames(sock: socket.socket, frames: List[bytes]) -> int:
+    if isinstance(sock, QueuedSocket):  # Event loop: queues what the kernel does not take itself
+        return sock.sendmsg(frames)
+    try:
+        if HAVE_SENDMSG and DONTWAIT:
+            return sock.sendmsg(frames, [], DONTWAIT)  # writev: the kernel gathers all the frames in one call
+        data = b"".join(frames)
+        if DONTWAIT:
+            return sock.send(data, DONTWAIT)
+        if not select.select([], [sock], [], 0)[1]:     # Windows: only write when there is room
+            return 0
+        return sock.send(data[:FALLBACK_CHUNK])
+    except BlockingIOError:             # Send buffer full (the client is not reading right now)
+        return 0
+
+
+class Outbox:
+    """Pending frames of one connection."""
+    __slots__ = ("sock", "frames", "size", "lock", "send_lock", "released", "unsent")
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.frames: List[bytes] = []
+        self.size = 0
+        self.lock = threading.Lock()        # Guards frames/size (held only for a list append)
+        self.send_lock = threading.Lock()   # One flush at a time -> frames keep their order on the wire
+        self.released = False               # release() ran: frames that still come in are dropped
+        self.unsent = bytearray()           # What the kernel did not take at the last flush (goes out first)
+
+
+class Batcher:
+    """Gathers the frames of each connection for up to `window_sec` (or `max_bytes`) and flushes them together.
+
+    One background thread flushes the connections whose window ended. A frame that fills the
+    outbox to `max_bytes` flushes it at once on the caller's thread. Flushes never block: what the
+    kernel does not take stays in the outbox and is tried again next window, and a client that stops
+    reading is cut off once `max_queued` bytes wait for it (like QueuedSocket), so one stuck client
+    cannot hold up the flusher for everybody else. A released connection keeps its (empty, released)
+    outbox until the socket is closed, so a send racing with the close cannot make a new outbox that
+    nobody would ever flush or forget.
+    """
+
+    def __init__(self, window_sec: float, max_bytes: int, max_queued: int):
+        self.window_sec = float(window_sec)
+        self.max_bytes = int(max_bytes)
+        self.max_queued = int(max_queued)
+        self.boxes: Dict[socket.socket, Outbox] = {}
+        self.boxes_lock = threading.Lock()
+        self.due = deque()                  # (deadline, outbox), deadlines in order (same window for all)
+        self.cond = threading.Condition()
+        threading.Thread(target=self._run, name="outbox-flusher", daemon=True).start()
+
+    def _box(self, sock: socket.socket) -> Outbox:
+        box = self.boxes.get(sock)
+        if box is None:
+            with self.boxes_lock:
+                box = self.boxes.setdefault(sock, Outbox(sock))
+        return box
+
+    # Queue one frame for `sock` (dropped once the connection was released, like a send on a closed socket) -->
+    def send(self, sock: socket.socket, data: bytes) -> None:
+        box = self._box(sock)
+        with box.lock:
+            if box.released:
+                return
+            box.frames.append(data)
+            box.size += len(data)
+            first = len(box.frames) == 1
+            full = box.size >= self.max_bytes
+        if full:
+            self.flush(box, size_flush=True)
+        elif first:  # The window starts with the first frame
+            self._schedule(box)
+
+    def _schedule(self, box: Outbox) -> None:
+        with self.cond:
+            self.due.append((time.monotonic() + self.window_sec, box))
+            self.cond.notify()
+
+    # Send everything pending in one syscall, keep what the kernel does not take for the next window -->
+    def flush(self, box: Outbox, size_flush: bool = False) -> None:
+        with box.send_lock:
+            with box.lock:
+                frames, box.frames, box.size = box.frames, [], 0
+            unsent = box.unsent
+            if not frames and not unsent:
+                return
+            try:
+                sent = write_frames(box.sock, [unsent] + frames if unsent else frames)
+            except OSError:  # Connection is gone -> forget it
+                unsent.clear()
+                self.forget(box.sock)
+                return
+            _count(len(frames), sent, size_flush)
+            carried = len(unsent)
+            del unsent[:sent]           # bytearray: dropping the head is cheap, the rest stays in order
+            sent = max(0, sent - carried)
+            for frame in frames:
+                if sent >= len(frame):
+                    sent -= len(frame)
+                    continue
+                unsent += frame[sent:] if sent else frame
+                sent = 0
+            if not unsent:
+                return
+            if len(unsent) > self.max_queued:   # Not reading: its handler sees EOF and ends the connection
+                unsent.clear()
+                with stats_lock:
+                    stats["stalled_drops"] += 1
+                try: box.sock.shutdown(socket.SHUT_RDWR)
+                except OSError: pass
+                return
+        if not box.released:
+            self._schedule(box)     # Try the rest again next window (a released box is rechecked by _bury)
+
+    # Flush now (before shutdown/close, e.g. an ERR followed by close) -->
+    def flush_socket(self, sock: socket.socket) -> None:
+        box = self.boxes.get(sock)
+        if box is not None:
+            self.flush(box)
+
+    # Flush what is pending and stop tracking the connection (once its socket is closed) -->
+    def release(self, sock: socket.socket) -> None:
+        box = self._box(sock)
+        with box.lock:
+            box.released = True
+        self.flush(box)
+        self._bury(box)
+
+    # A released outbox leaves the dict when its socket is closed; until then the flusher looks again every window -->
+    def _bury(self, box: Outbox) -> None:
+        if box.sock.fileno() == -1:
+            self.forget(box.sock)
+            return
+        self._schedule(box)
+
+    def forget(self, sock: socket.socket) -> None:
+        with self.boxes_lock:
+            self.boxes.pop(sock, None)
+
+    def _run(self) -> None:
+        while True:
+            with self.cond:
+                while not self.due:
+                    self.cond.wait()
+                deadline, box = self.due[0]
+                wait = deadline - time.monotonic()
+                if wait > 0:
+                    self.cond.wait(wait)
+                    continue
+                self.due.popleft()
+            self.flush(box)
+            if box.released:
+                self._bury(box)
+
+
+# ====================================
+# ===== Event-loop (queued) writes ===
+# ====================================
+class QueuedSocket:
+    """A non-blocking client socket whose writes never block (Event_Loop transport).
+
+    What the kernel does not take right away waits in `pending`, in order, and the event loop sends it once
+    the socket is writable (`want_write(self)` asks it to watch). The routing, timers and peer links all write,
+    so the queue has a lock. A client that stops reading is cut off once `max_queued` bytes wait for it.
+    """
+    __slots__ = ("sock", "want_write", "max_queued", "pending", "queued", "lock", "shut")
+
+    def __init__(self, sock: socket.socket, want_write, max_queued: int):
+        sock.setblocking(False)
+        self.sock = sock
+        self.want_write = want_write
+        self.max_queued = max_queued
+        self.pending = None     # deque of bytes, made by the first write that has to wait (most never need one)
+        self.queued = 0
+        self.lock = threading.Lock()
+        self.shut = None        # shutdown(SHUT_WR) while bytes wait -> done after the last one
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
+
+    # Send what the kernel takes now, queue the rest (in order behind anything already waiting) -->
+    def sendall(self, data: bytes) -> None:
+        with self.lock:
+            sent = 0
+            if not self.queued:     # Usual case: one send() and done
+                try:
+                    sent = self.sock.send(data)
+                except BlockingIOError:
+                    pass
+                if sent == len(data):
+                    return
+            first = self._queue(data[sent:])
+        if first:
+            self.want_write(self)
+
+    def sendmsg(self, buffers) -> int:   # Outbox.Batcher's flush (writev)
+        total = sum(len(b) for b in buffers)
+        with self.lock:
+            sent = 0
+            if not self.queued:
+                try:
+                    sent = self.sock.sendmsg(buffers) if HAVE_SENDMSG else self.sock.send(b"".join(buffers))
+                except BlockingIOError:
+                    pass
+                if sent == total:
+                    return total
+            first = self._queue(b"".join(buffers)[sent:])
+        if first:
+            self.want_write(self)
+        return total
+
+    # With the lock held. True -> the queue was empty (the loop has to start watching) -->
+    def _queue(self, rest: bytes) -> bool:
+        if self.queued + len(rest) > self.max_queued:   # Not reading: the loop sees EOF and ends the connection
+            try: self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError: pass
+            raise BrokenPipeError("client stopped reading")
+        if self.pending is None:
+            self.pending = deque()
+        self.pending.append(rest)
+        self.queued += len(rest)
+        return self.queued == len(rest)
+
+    # The socket is writable (event loop). True -> nothing waits anymore -->
+    def flush(self) -> bool:
+        with self.lock:
+            pending = self.pending
+            while pending:
+                try:
+                    sent = self.sock.send(pending[0])
+                except BlockingIOError:
+                    return False
+                self.queued -= sent
+                if sent < len(pending[0]):
+                    pending[0] = pending[0][sent:]
+                    return False
+                pending.popleft()
+            self.pending = None
+            if self.shut is not None:
+                self.sock.shutdown(self.shut)
+                self.shut = None
+            return True
+
+    def shutdown(self, how: int = socket.SHUT_RDWR) -> None:
+        with self.lock:
+            if how == socket.SHUT_WR and self.queued:   # FIN after the queued bytes (like sendall + shutdown)
+                self.shut = how
+                return
+            self.pending, self.queued = None, 0
+        self.sock.shutdown(how)
+
+    def close(self) -> None:
+        try:
+            self.flush()    # Last lines (e.g. ERR NAME_TAKEN) if the kernel takes them now
+        except OSError:
+            pass
+        self.sock.close()
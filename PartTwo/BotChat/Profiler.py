@@ -0,0 +1,164 @@
+"""On-demand sampling profiler: where the running server's threads spend their time (collapsed stacks + top N)"""
+
+import linecache
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+from Common_Setups import PROFILE_DIR, PROFILE_INTERVAL_SEC, PROFILE_MAX_OVERHEAD, PROFILE_TOP_N
+
+WAITING = "[waiting]"   # Last frame of a stack whose thread sits in a blocking call (recv, accept, wait, sleep...)
+BLOCKING_RE = re.compile(r"\.(_?accept|acquire|recv|recvfrom|recv_into|wait|select|poll)\(|\bsleep\(|(?<![\"'])\.join\(")
+
+_active_lock = threading.Lock()
+_active: Optional["SamplingProfiler"] = None
+
+
+class SamplingProfiler:
+    """Every `interval` seconds: one look at the Python stack of every other thread (sys._current_frames).
+
+    Overhead bound: after each sample the profiler sleeps long enough that sampling (its own CPU time) takes
+    at most `max_overhead` of the wall time (cost / (cost + sleep) <= max_overhead). With many threads a
+    sample costs more, so the real interval grows instead of the overhead. Sampling holds the GIL, so the
+    bound is also the share of the interpreter the handler threads lose.
+
+    Results (next to the code, in PROFILE_DIR):
+      <name>.collapsed   "thread;outer;...;inner count" lines (flamegraph.pl / speedscope / inferno)
+      <name>.top.txt     hot functions: self and total share of the busy samples ([waiting] ones left out)
+    """
+
+    def __init__(self, seconds: float, interval: float = PROFILE_INTERVAL_SEC,
+                 max_overhead: float = PROFILE_MAX_OVERHEAD, directory: Optional[str] = None,
+                 top_n: int = PROFILE_TOP_N):
+        here = os.path.dirname(os.path.abspath(__file__))
+        self.seconds = seconds
+        self.interval = interval
+        self.max_overhead = max_overhead
+        self.directory = directory or os.path.join(here, PROFILE_DIR)
+        self.top_n = top_n
+        self.base = os.path.join(self.directory, time.strftime("profile-%Y%m%d-%H%M%S"))
+        self.stacks: Counter = Counter()
+        self.labels: Dict[object, str] = {}             # code object -> "func (file:line)"
+        self.keys: Dict[tuple, str] = {}                # (thread, code objects..., leaf line) -> collapsed stack
+        self.waiting: Dict[Tuple[object, int], bool] = {}  # (code, line) -> is a blocking call
+        self.result: Dict[str, float] = {}
+        self.thread: Optional[threading.Thread] = None
+
+    # ----- One at a time per process -----
+    def start(self, on_done=None) -> bool:
+        global _active
+        with _active_lock:
+            if _active is not None:
+                return False
+            _active = self
+        self.thread = threading.Thread(target=self._run, args=(on_done,), name="profiler", daemon=True)
+        self.thread.start()
+        return True
+
+    def _run(self, on_done) -> None:
+        global _active
+        try:
+            self.run()
+        finally:
+            with _active_lock:
+                _active = None
+        if on_done is not None:
+            on_done(self)
+
+    # Sample for `seconds`, then write the files. Returns the numbers (also in self.result) -->
+    def run(self) -> Dict[str, float]:
+        me = threading.get_ident()
+        names: Dict[int, str] = {}
+        samples = 0
+        spent = 0.0
+        t_start = time.perf_counter()
+        deadline = t_start + self.seconds
+        while time.perf_counter() < deadline:
+            t0 = time.thread_time()     # CPU of this thread: waiting for the GIL is not our overhead
+            frames = sys._current_frames()
+            if any(ident not in names for ident in frames):   # New threads only: enumerate() takes a lock
+                names = {t.ident: _thread_kind(t.name) for t in threading.enumerate()}
+            for ident, frame in frames.items():
+                if ident != me:
+                    self.stacks[self._collapse(names.get(ident, "thread"), frame)] += 1
+            samples += 1
+            cost = time.thread_time() - t0
+            spent += cost
+            time.sleep(max(self.interval, cost / self.max_overhead - cost))
+        wall = time.perf_counter() - t_start
+        self.result = {"samples": samples, "seconds": wall, "overhead": spent / wall,
+                       "interval_ms": wall / max(1, samples) * 1000, "stacks": len(self.stacks)}
+        self.write()
+        return self.result
+
+    # The same stack comes back sample after sample: walk it, but build its string only once -->
+    def _collapse(self, thread: str, frame) -> str:
+        leaf = frame
+        codes = [thread, leaf.f_lineno]
+        while frame is not None:
+            codes.append(frame.f_code)
+            frame = frame.f_back
+        key = tuple(codes)
+        stack = self.keys.get(key)
+        if stack is None:
+            parts = [thread] + [self._label(code) for code in reversed(codes[2:])]
+            if self._is_waiting(leaf.f_code, leaf.f_lineno):
+                parts.append(WAITING)
+            stack = self.keys[key] = ";".join(parts)
+        return stack
+
+    def _label(self, code) -> str:
+        label = self.labels.get(code)
+        if label is None:
+            label = self.labels[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+        return label
+
+    # Python can't see into C calls: a thread is "waiting" when its current line is a blocking call -->
+    def _is_waiting(self, code, line: int) -> bool:
+        key = (code, line)
+        found = self.waiting.get(key)
+        if found is None:
+            found = self.waiting[key] = bool(BLOCKING_RE.search(linecache.getline(code.co_filename, line)))
+        return found
+
+    # ----- Output -----
+    def write(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.base + ".collapsed", "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        with open(self.base + ".top.txt", "w", encoding="utf-8") as f:
+            f.write("\n".join(self.summary()) + "\n")
+
+    def top(self) -> Tuple[int, List[Tuple[str, int, int]]]:
+        own, total = Counter(), Counter()
+        busy = 0
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")[1:]   # Without the thread
+            if not frames or frames[-1] == WAITING:
+                continue
+            busy += count
+            own[frames[-1]] += count
+            for label in set(frames):
+                total[label] += count
+        return busy, [(label, own[label], total[label]) for label, _ in own.most_common(self.top_n)]
+
+    def summary(self) -> List[str]:
+        busy, rows = self.top()
+        r = self.result
+        lines = [f"{r.get('samples', 0)} samples in {r.get('seconds', 0):.1f}s (every {r.get('interval_ms', 0):.1f} ms), "
+                 f"overhead {r.get('overhead', 0) * 100:.2f}% (bound {self.max_overhead * 100:.1f}%)",
+                 f"busy thread samples: {busy} (threads in a blocking call are left out)",
+                 "", f"{'self %':>7} {'total %':>8}  function"]
+        for label, own, total in rows:
+            lines.append(f"{own * 100 / max(1, busy):7.1f} {total * 100 / max(1, busy):8.1f}  {label}")
+        return lines
+
+
+# "Thread-12 (handle_single_client)" -> "Thread(handle_single_client)": all handlers fold into one flame -->
+def _thread_kind(name: str) -> str:
+    return re.sub(r"-\d+", "", name).replace(";", ",").replace(" ", "")
@@ -0,0 +1,308 @@
+"""Protocol codec: every line of the chat protocol as a typed frame (one table per direction, escaped fields)"""
+
+import re
+from operator import attrgetter
+from typing import Dict, Optional, Tuple, Type
+
+from Common_Setups import PROTOCOL_MAX_LINE_BYTES
+
+# Server -> client (and server <-> server) lines: TYPE|field|field|...
+# Client -> server commands: CMD:NAME:field:field...   A chat message is just <target>:<msg_id>:<text>
+PIPE = "|"
+COLON = ":"
+CMD = "CMD"
+
+# Escaping inside a field: "\" first, then the line's separator and line breaks (so a field never holds them).
+# The last field is split with maxsplit, so a raw separator there (older clients, data: URLs) still decodes.
+_ESCAPED_SEP = {PIPE: "\\p", COLON: "\\c"}
+_UNESCAPED = {"\\": "\\", "p": "|", "c": ":", "n": "\n", "r": "\r"}
+_ESCAPE_RE = re.compile(r"\\(.)", re.S)
+_UNESCAPED_PAIRS = tuple(("\\" + k, v) for k, v in _UNESCAPED.items() if k != "\\")
+_PARKED = "\0"     # Stands in for an escaped backslash while the other escapes are replaced
+
+
+def escape(text: str, sep: str = PIPE) -> str:
+    if "\\" in text:    # `in` scans are C speed: most fields need no replace at all
+        text = text.replace("\\", "\\\\")
+    if sep in text:
+        text = text.replace(sep, _ESCAPED_SEP[sep])
+    if "\n" in text:
+        text = text.replace("\n", "\\n")
+    if "\r" in text:
+        text = text.replace("\r", "\\r")
+    return text
+
+# Linear in the length. Unknown escapes (and a lone "\" at the end) stay as they are -->
+# str.replace runs left to right like the escape reader does, so once every "\\" is parked on a character the
+# text does not have, no two backslashes touch and each escape can be replaced on its own (C speed, ~1 ns/byte
+# instead of a Python call per escape). The regex pass is only for text that holds the parking character.
+def unescape(text: str) -> str:
+    if "\\" not in text:
+        return text
+    if _PARKED not in text:
+        text = text.replace("\\\\", _PARKED)
+        for escaped, plain in _UNESCAPED_PAIRS:
+            if escaped in text:
+                text = text.replace(escaped, plain)
+        return text.replace(_PARKED, "\\")
+    return _ESCAPE_RE.sub(_unescape_one, text)
+
+def _unescape_one(match) -> str:
+    return _UNESCAPED.get(match.group(1), match.group(0))
+
+
+class Frame:
+    """One protocol line. A subclass lists its fields in __slots__, in wire order (strings; numbers are
+    written with str()).
+
+    REQUIRED: fields a line must have to decode (None = all); missing later ones decode as "".
+    Each subclass gets a compiled __init__ and encode() (plain assignments and one f-string, like a
+    namedtuple's generated code), so a frame costs about what the hand-written f-string / split did.
+    """
+    __slots__ = ()
+    TYPE = ""
+    SEP = PIPE
+    REQUIRED: Optional[int] = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        names, sep = cls.__slots__, cls.SEP
+        head = f"{CMD}{COLON}{cls.TYPE}" if sep == COLON and cls.TYPE else cls.TYPE
+        cls._prefix = head + sep if head and names else head     # A chat message (Send) has no head at all
+        cls._required = len(names) if cls.REQUIRED is None else cls.REQUIRED
+        if not names:
+            cls._get = staticmethod(lambda frame: ())
+            cls.encode = lambda self: head
+            return
+        getter = attrgetter(*names)
+        cls._get = staticmethod((lambda frame: (getter(frame),)) if len(names) == 1 else getter)
+        fields = sep.join("{self.%s}" % name for name in names)
+        expected = cls._prefix.count(sep) + len(names) - 1    # Separators in a line that needs no escaping
+        scope = {"_escaped": Frame._escaped, "BACKSLASH": "\\", "LF": "\n", "CR": "\r"}
+        exec(f"def __init__(self, {', '.join(name + '=' + repr('') for name in names)}):\n"
+             + "".join(f"    self.{name} = {name}\n" for name in names)
+             + "def encode(self):\n"
+             + f"    line = f{cls._prefix + fields!r}\n"
+             + f"    if line.count({sep!r}) != {expected} or BACKSLASH in line or LF in line or CR in line:\n"
+             + "        return _escaped(self)\n"
+             + "    return line\n", scope)
+        cls.__init__, cls.encode = scope["__init__"], scope["encode"]
+
+    def fields(self) -> Tuple[str, ...]:
+        return self._get(self)
+
+    def encode(self) -> str:    # Replaced per subclass (see __init_subclass__)
+        return self._escaped()
+
+    # Some field holds a separator, a "\" or a line break -> escape field by field -->
+    def _escaped(self) -> str:
+        return self._prefix + self.SEP.join([escape(str(value), self.SEP) for value in self._get(self)])
+
+    # The fields after the type (the last one keeps any raw separators). None: too few fields -->
+    @classmethod
+    def from_wire(cls, rest: str) -> Optional["Frame"]:
+        if not cls.__slots__:
+            return cls()
+        parts = rest.split(cls.SEP, len(cls.__slots__) - 1)
+        if len(parts) < cls._required:
+            return None
+        if "\\" in rest:
+            parts = [unescape(part) for part in parts]
+        return cls(*parts)
+
+    def __eq__(self, other) -> bool:
+        return type(other) is type(self) and other.fields() == self.fields()
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}{self.fields()!r}"
+
+
+# ============================
+# ===== Server -> client =====
+# ============================
+class Msg(Frame):
+    __slots__ = ("sender", "target", "msg_id", "seq", "text")
+    TYPE = "MSG"
+
+class Users(Frame):
+    __slots__ = ("sender", "target", "names")   # names: "a,b,c"
+    TYPE = "USERS"
+
+class Err(Frame):
+    __slots__ = ("sender", "target", "code")
+    TYPE = "ERR"
+
+class Ack(Frame):
+    __slots__ = ("sender", "target", "action", "value")
+    TYPE = "ACK"
+
+class Session(Frame):
+    __slots__ = ("sender", "target", "token", "epoch")
+    TYPE = "SESSION"
+    REQUIRED = 3
+
+class Rename(Frame):
+    __slots__ = ("old", "new")
+    TYPE = "RENAME"
+
+class Avatar(Frame):
+    __slots__ = ("name", "avatar_hash")
+    TYPE = "AVATAR"
+
+class Avatars(Frame):
+    __slots__ = ("sender", "target", "pairs")   # pairs: "name=hash,name=hash"
+    TYPE = "AVATARS"
+
+class AvatarBlob(Frame):
+    __slots__ = ("sender", "avatar_hash", "url")
+    TYPE = "AVATAR_BLOB"
+
+class Reconnect(Frame):
+    __slots__ = ("sender", "target", "min_ms", "max_ms")
+    TYPE = "RECONNECT"
+
+class Rooms(Frame):
+    __slots__ = ("sender", "target", "names")   # names: "#a,#b"
+    TYPE = "ROOMS"
+
+class Ping(Frame):
+    __slots__ = ("sender", "target", "stamp")   # Any line back proves the client is alive (CMD:PONG:<stamp>)
+    TYPE = "PING"
+
+class Leave(Frame):
+    __slots__ = ("sender", "target", "name", "reason")    # reason: left / timeout / expired
+    TYPE = "LEAVE"
+
+
+# ============================
+# ===== Client -> server =====
+# ============================
+class Command(Frame):
+    __slots__ = ()
+    SEP = COLON
+
+class Send(Command):
+    """A chat message (no CMD: prefix)."""
+    __slots__ = ("target", "msg_id", "text")
+
+class Quit(Command):
+    __slots__ = ()
+    TYPE = "QUIT"
+
+class Resume(Command):
+    __slots__ = ("token", "last_msg_id")
+    TYPE = "RESUME"
+    REQUIRED = 1
+
+class Caps(Command):
+    __slots__ = ("caps",)   # caps: "zlib,..."
+    TYPE = "CAPS"
+
+class NameChange(Command):
+    __slots__ = ("name",)
+    TYPE = "NAME_CHANGE"
+
+class SetAvatar(Command):
+    __slots__ = ("url",)
+    TYPE = "AVATAR"
+
+class GetAvatar(Command):
+    __slots__ = ("avatar_hash",)
+    TYPE = "AVATAR_GET"
+
+class JoinRoom(Command):
+    __slots__ = ("room",)
+    TYPE = "JOIN"
+
+class PartRoom(Command):
+    __slots__ = ("room",)
+    TYPE = "PART"
+
+class ListRooms(Command):
+    __slots__ = ()
+    TYPE = "ROOMS"
+
+class Profile(Command):
+    __slots__ = ("secret", "seconds")
+    TYPE = "PROFILE"
+    REQUIRED = 1
+
+class History(Command):
+    __slots__ = ("other", "lo", "hi")
+    TYPE = "HISTORY"
+
+class Pong(Command):
+    __slots__ = ("stamp",)
+    TYPE = "PONG"
+
+
+# ============================
+# ===== Server <-> server ====
+# ============================
+class PeerHello(Command):
+    """First line of a peer link: CMD:PEER:<node>:<secret>. Not in COMMANDS (never valid after a join)."""
+    __slots__ = ("node", "secret")
+    TYPE = "PEER"
+
+class PeerAccept(Frame):
+    __slots__ = ("node", "secret")  # The answer to the hello: the accepting node proves it knows the secret too
+    TYPE = "PEER"
+
+class Forward(Frame):
+    __slots__ = ("target", "sender", "msg_id", "text")
+    TYPE = "FWD"
+
+class Roster(Frame):
+    __slots__ = ("node", "names")   # names: "a,b,c" (every local user of that node)
+    TYPE = "ROSTER"
+
+class PeerJoined(Frame):
+    __slots__ = ("node", "name")
+    TYPE = "JOINED"
+
+class PeerLeft(Frame):
+    __slots__ = ("node", "name")
+    TYPE = "LEFT"
+
+class PeerAvatar(Frame):
+    __slots__ = ("name", "url")
+    TYPE = "AVATAR"
+
+class Raw(Frame):
+    __slots__ = ("line",)   # A client line the other node sends to its own users as it is
+    TYPE = "RAW"
+
+
+# ===========================
+# ===== Dispatch tables =====
+# ===========================
+SERVER_FRAMES: Dict[str, Type[Frame]] = {cls.TYPE: cls for cls in (
+    Msg, Users, Err, Ack, Session, Rename, Avatar, Avatars, AvatarBlob, Reconnect, Rooms, Ping, Leave)}
+COMMANDS: Dict[str, Type[Frame]] = {cls.TYPE: cls for cls in (
+    Quit, Resume, Caps, NameChange, SetAvatar, GetAvatar, JoinRoom, PartRoom, ListRooms, Profile, History,
+    Pong)}
+PEER_FRAMES: Dict[str, Type[Frame]] = {cls.TYPE: cls for cls in (
+    PeerAccept, Forward, Roster, PeerJoined, PeerLeft, PeerAvatar, Raw)}
+
+
+# A line from the server (clients). None: unknown type, too few fields or too long -->
+def decode(line: str, table: Dict[str, Type[Frame]] = SERVER_FRAMES) -> Optional[Frame]:
+    if len(line) > PROTOCOL_MAX_LINE_BYTES:
+        return None
+    kind, _, rest = line.partition(PIPE)
+    cls = table.get(kind)
+    return None if cls is None else cls.from_wire(rest)
+
+# A line from a client (server). A line without the CMD: prefix is a chat message -->
+def decode_command(line: str) -> Optional[Frame]:
+    if len(line) > PROTOCOL_MAX_LINE_BYTES:
+        return None
+    if line.startswith("CMD:"):
+        kind, _, rest = line[4:].partition(COLON)
+        cls = COMMANDS.get(kind)
+        return None if cls is None else cls.from_wire(rest)
+    return Send.from_wire(line)
+
+# A line from a peer server -->
+def decode_peer(line: str) -> Optional[Frame]:
+    return decode(line, PEER_FRAMES)
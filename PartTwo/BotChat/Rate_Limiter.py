@@ -0,0 +1,127 @@
+"""Token-bucket rate limiting for the server (per connection + global)"""
+
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from Common_Setups import (
+    RATE_LIMIT_ACTION,
+    RATE_LIMIT_CONN_MSGS_PER_SEC, RATE_LIMIT_CONN_BYTES_PER_SEC,
+    RATE_LIMIT_GLOBAL_MSGS_PER_SEC, RATE_LIMIT_GLOBAL_BYTES_PER_SEC,
+    RATE_LIMIT_BURST_SECONDS,
+)
+
+# What the server does with a message that is over the limit -->
+ACTION_DELAY = "delay"              # Backpressure: the client's own handler thread sleeps until tokens exist
+                                    # (event loop: that connection is not read for as long)
+ACTION_DROP = "drop"                # Silently ignore the message
+ACTION_ERROR = "error"              # Ignore it and answer ERR|System|<nick>|RATE_LIMITED
+ACTION_DISCONNECT = "disconnect"    # Close the connection
+ACTIONS = (ACTION_DELAY, ACTION_DROP, ACTION_ERROR, ACTION_DISCONNECT)
+ALLOWED = "ok"
+
+
+# ========================
+# ===== Token bucket =====
+# ========================
+class TokenBucket:
+    """`rate` tokens per second, holding at most `burst` tokens (rate <= 0 means unlimited).
+
+    Time is whatever `now` the callers pass (Main_Server.clock: real or a Sim_Net VirtualClock), so the
+    bucket starts counting at its first wait_time(), never at a time.monotonic() of its own.
+    """
+    __slots__ = ("rate", "burst", "tokens", "last")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self.tokens = self.burst
+        self.last: Optional[float] = None   # `now` of the last wait_time() (None: never checked yet)
+
+    # How long until n tokens exist (0.0 = available now). Refills, but consumes nothing -->
+    def wait_time(self, n: float, now: float) -> float:
+        rate = self.rate
+        if rate <= 0:
+            return 0.0
+        tokens, last = self.tokens, self.last
+        if last is not None and now > last:     # First check (full bucket) / a clock behind us: no refill
+            tokens += (now - last) * rate
+        if tokens > self.burst:
+            tokens = self.burst
+        self.tokens, self.last = tokens, now
+        need = n if n < self.burst else self.burst  # A single message bigger than the burst must still pass eventually
+        return 0.0 if tokens >= need else (need - tokens) / rate
+
+    # Take n tokens (may go negative after a delay -> the debt slows the next messages) -->
+    def consume(self, n: float) -> None:
+        if self.rate > 0:
+            self.tokens -= n
+
+
+# =======================
+# ===== Rate limiter ====
+# =======================
+# Server wide counters (read by benchmarks / diagnostics) -->
+counters: Dict[str, int] = {"allowed": 0, "delayed": 0, "dropped": 0, "errored": 0, "disconnected": 0}
+counters_lock = threading.Lock()
+
+# Global buckets shared by every connection (one lock guards both) -->
+_global_msgs = TokenBucket(RATE_LIMIT_GLOBAL_MSGS_PER_SEC, RATE_LIMIT_GLOBAL_MSGS_PER_SEC * RATE_LIMIT_BURST_SECONDS)
+_global_bytes = TokenBucket(RATE_LIMIT_GLOBAL_BYTES_PER_SEC, RATE_LIMIT_GLOBAL_BYTES_PER_SEC * RATE_LIMIT_BURST_SECONDS)
+_global_lock = threading.Lock()
+
+_COUNTER_FOR_ACTION = {ACTION_DELAY: "delayed", ACTION_DROP: "dropped", ACTION_ERROR: "errored",
+                       ACTION_DISCONNECT: "disconnected"}
+
+
+class ConnectionLimiter:
+    """One per connection: its own msgs/bytes buckets + the shared global buckets."""
+    __slots__ = ("action", "msgs", "bytes", "counters")
+
+    def __init__(self, msgs_per_sec: float = RATE_LIMIT_CONN_MSGS_PER_SEC,
+                 bytes_per_sec: float = RATE_LIMIT_CONN_BYTES_PER_SEC,
+                 action: str = RATE_LIMIT_ACTION):
+        if action not in ACTIONS:
+            raise ValueError(f"Unknown rate limit action: {action}")
+        self.action = action
+        self.msgs = TokenBucket(msgs_per_sec, msgs_per_sec * RATE_LIMIT_BURST_SECONDS)
+        self.bytes = TokenBucket(bytes_per_sec, bytes_per_sec * RATE_LIMIT_BURST_SECONDS)
+        self.counters = {"allowed": 0, "delayed": 0, "dropped": 0, "errored": 0, "disconnected": 0}
+
+    def _count(self, key: str) -> None:
+        self.counters[key] += 1
+        with counters_lock:
+            counters[key] += 1
+
+    # Check one incoming message of `size` bytes. Returns ALLOWED or the configured action -->
+    # For ACTION_DELAY this call itself sleeps (only this client's thread) and then returns ALLOWED.
+    def check(self, size: int, now: Optional[float] = None) -> str:
+        verdict, wait = self.decide(size, now)
+        if verdict == ACTION_DELAY:
+            time.sleep(wait)
+            return ALLOWED
+        return verdict
+
+    # The same without sleeping: (ALLOWED, 0.0), (ACTION_DELAY, seconds to hold the client back - the message
+    # itself is let through and paid for) or (drop / error / disconnect, 0.0) -->
+    def decide(self, size: int, now: Optional[float] = None) -> Tuple[str, float]:
+        now = time.monotonic() if now is None else now
+        wait = max(self.msgs.wait_time(1, now), self.bytes.wait_time(size, now))
+        with _global_lock:
+            wait = max(wait, _global_msgs.wait_time(1, now), _global_bytes.wait_time(size, now))
+            if wait <= 0 or self.action == ACTION_DELAY:
+                _global_msgs.consume(1)
+                _global_bytes.consume(size)
+
+        if wait <= 0:
+            self.msgs.consume(1)
+            self.bytes.consume(size)
+            self._count("allowed")
+            return ALLOWED, 0.0
+
+        self._count(_COUNTER_FOR_ACTION[self.action])
+        if self.action == ACTION_DELAY:
+            self.msgs.consume(1)
+            self.bytes.consume(size)
+            return ACTION_DELAY, wait
+        return self.action, 0.0
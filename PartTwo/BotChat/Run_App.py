@@ -1,10 +1,12 @@
 from nicegui import ui
+import socket
 import threading
 import subprocess
 import platform
+import time
 import webbrowser
 
-from Common_Setups import CHAT_UI_PORT, CHROME_PATH
+from Common_Setups import CHAT_UI_PORT, CHROME_PATH, UI_READY_TIMEOUT_SEC, PREWARM_CHAT_UI
 
 
 def open_popup_app(url: str):
@@ -47,7 +49,32 @@ def open_popup_app(url: str) -> None:
         print("Failed to open Chrome app window:", e)
 
 '''
-def run_chat_app() -> None:
+# Readiness signal: the UI server accepts connections (uvicorn binds only after the app started) -->
+def wait_until_serving(port: int, timeout: float = UI_READY_TIMEOUT_SEC) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return True
+        except OSError:
+            time.sleep(0.02)
+    return False
+
+
+# Open the launcher window as soon as the server is up, then load the chat page in the background -->
+def open_when_ready(url: str, port: int, open_window: bool = True) -> None:
+    t0 = time.perf_counter()
+    if not wait_until_serving(port):
+        print(f"UI server did not answer within {UI_READY_TIMEOUT_SEC:.0f}s, opening the window anyway")
+    print(f"UI_READY {time.perf_counter() - t0:.3f}s")
+    if open_window:
+        open_popup_app(url)
+    if PREWARM_CHAT_UI:
+        import UI_Router
+        UI_Router.prewarm_chat_ui()
+
+
+def run_chat_app(port: int = CHAT_UI_PORT, open_window: bool = True) -> None:
     """
     Starts the NiceGUI server. The UI pages are defined in app.py
     (build_launcher_ui / build_chat_ui).
@@ -55,15 +82,16 @@ def run_chat_app() -> None:
     # Import here so UI_Router.py registers routes before ui.run starts
     import UI_Router  # noqa: F401
 
-    url = f"http://localhost:{CHAT_UI_PORT}/"
+    url = f"http://localhost:{port}/"
 
-    # Open the launcher window shortly after the server starts
-    threading.Timer(0.5, open_popup_app, args=(url,)).start()
+    # Open the launcher window once the server answers (instead of a fixed delay)
+    threading.Thread(target=open_when_ready, args=(url, port, open_window), name="open-when-ready",
+                     daemon=True).start()
 
     # Run NiceGUI without auto-opening a regular browser tab
     ui.run(
         reload=False,
-        port=CHAT_UI_PORT,
+        port=port,
         show=False,
         title="Chat Launcher",
     )
@@ -0,0 +1,156 @@
+"""Full-text search over the chat history: an inverted index kept up to date as messages arrive"""
+
+import html
+import re
+import threading
+from array import array
+from bisect import bisect_left
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from Common_Setups import SEARCH_RESULTS_MAX
+
+TOKEN_RE = re.compile(r"\w+")
+ALL_ID = 0  # Name id of the public chat
+
+
+# "Hello, World!" -> ["hello", "world"] (same rule for messages and queries) -->
+def tokenize(text: str) -> List[str]:
+    return TOKEN_RE.findall(str(text).casefold())
+
+
+# Escape a message for HTML and wrap the words that match the query in <mark> -->
+def highlight(text: str, terms: Set[str]) -> str:
+    out, last = [], 0
+    for m in TOKEN_RE.finditer(text):
+        if m.group().casefold() in terms:
+            out.append(html.escape(text[last:m.start()]))
+            out.append(f"<mark>{html.escape(m.group())}</mark>")
+            last = m.end()
+    out.append(html.escape(text[last:]))
+    return "".join(out).replace("\n", "<br />")    # Like a plain text bubble
+
+
+def _contains(postings: array, doc: int) -> bool:
+    i = bisect_left(postings, doc)
+    return i < len(postings) and postings[i] == doc
+
+
+class SearchIndex:
+    """token -> posting list of message numbers (ascending), one number per indexed message.
+
+    Numbers are given out in the order messages are indexed and never change, so a posting list is
+    only ever appended to (positions in State_Globals.messages move when older history is loaded).
+    A higher number must mean a newer message (search walks backwards and stops at `limit`): while the
+    stored history is indexed (hold_live ... release_live), live messages wait in `pending` and get their
+    numbers after it. Search looks at the waiting ones first (they are the newest).
+    Sender and target are kept per message as small name ids for the visibility check.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()    # Listener threads add, the UI loop searches
+        self.postings: Dict[str, array] = {}
+        self.msg_ids: List[str] = []    # message number -> msg_id
+        self.senders = array("I")       # message number -> name id
+        self.targets = array("I")
+        self.names: List[str] = ["ALL"]  # name id -> user / room ("ALL" = ALL_ID)
+        self.name_ids: Dict[str, int] = {"ALL": ALL_ID}
+        self.pending: Optional[List[tuple]] = None  # Live messages held back while the history is indexed
+
+    def __len__(self) -> int:
+        return len(self.msg_ids)
+
+    def _name_id(self, name: str) -> int:    # Lock held
+        i = self.name_ids.get(name)
+        if i is None:
+            i = self.name_ids[name] = len(self.names)
+            self.names.append(name)
+        return i
+
+    # One live message -> its number appended to the posting list of each of its words -->
+    def add(self, msg_id: str, sender: str, target: str, text: str) -> None:
+        prepared = self._prepare([(msg_id, sender, target, text)])
+        with self.lock:
+            if self.pending is not None:
+                self.pending.extend(prepared)
+            else:
+                self._add(prepared)
+
+    # Rows in age order (the stored history, oldest first) -->
+    def add_many(self, rows: Iterable[Tuple[str, str, str, str]]) -> None:
+        prepared = self._prepare(rows)  # Outside the lock
+        with self.lock:
+            self._add(prepared)
+
+    # From now on live messages wait until release_live (older rows are being indexed meanwhile) -->
+    def hold_live(self) -> None:
+        with self.lock:
+            if self.pending is None:
+                self.pending = []
+
+    def release_live(self) -> None:
+        with self.lock:
+            pending, self.pending = self.pending, None
+            if pending:
+                self._add(pending)
+
+    @staticmethod
+    def _prepare(rows) -> List[tuple]:
+        return [(msg_id, sender, "ALL" if str(target or "").upper() == "ALL" else str(target or ""),
+                 set(tokenize(text))) for msg_id, sender, target, text in rows]
+
+    def _add(self, prepared: List[tuple]) -> None:  # Lock held
+        for msg_id, sender, target, words in prepared:
+            doc = len(self.msg_ids)
+            self.msg_ids.append(msg_id)
+            self.senders.append(self._name_id(sender))
+            self.targets.append(self._name_id(target))
+            for word in words:
+                postings = self.postings.get(word)
+                if postings is None:
+                    postings = self.postings[word] = array("I")
+                postings.append(doc)
+
+    # A user was renamed (the chat rewrites its bubbles too): O(1), the messages keep their name id -->
+    def rename(self, old: str, new: str) -> None:
+        with self.lock:
+            if self.pending:    # Waiting messages still carry names, not ids
+                self.pending = [(m, new if s == old else s, new if t == old else t, w) for m, s, t, w in self.pending]
+            i = self.name_ids.pop(old, None)
+            if i is None:
+                return
+            self.names[i] = new
+            self.name_ids.setdefault(new, i)
+
+    # msg_ids of the newest messages that hold every word of `query` and that `me` may see -->
+    # Visible: to ALL, to me, by me, or in one of my rooms (`joined`) - the same rule as the chat window.
+    def search(self, query: str, me: str, joined: Iterable[str] = (), limit: int = SEARCH_RESULTS_MAX) -> List[str]:
+        words = set(tokenize(query))
+        if not words:
+            return []
+        joined = set(joined)
+        found, seen = [], set()
+        with self.lock:
+            for msg_id, sender, target, row_words in reversed(self.pending or ()):   # Newest: not numbered yet
+                if (target in ("ALL", me) or target in joined or sender == me) and words <= row_words \
+                        and msg_id not in seen:
+                    seen.add(msg_id)
+                    found.append(msg_id)
+                    if len(found) >= limit:
+                        return found
+            lists = [self.postings.get(word) for word in words]
+            if any(postings is None for postings in lists):
+                return found
+            lists.sort(key=len)     # Walk the rarest word, look the others up (binary search)
+            rarest, others = lists[0], lists[1:]
+            mine = {i for i, name in enumerate(self.names) if name == me}
+            visible = {ALL_ID} | mine | {i for i, name in enumerate(self.names) if name in joined}
+            for k in range(len(rarest) - 1, -1, -1):    # Newest first, stop at `limit`
+                doc = rarest[k]
+                if self.targets[doc] not in visible and self.senders[doc] not in mine:
+                    continue
+                if all(_contains(postings, doc) for postings in others) and self.msg_ids[doc] not in seen:
+                    seen.add(self.msg_ids[doc])     # A message stored twice (e.g. replayed) is one result
+                    found.append(self.msg_ids[doc])
+                    if len(found) >= limit:
+                        break
+        return found
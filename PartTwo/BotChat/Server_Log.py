@@ -0,0 +1,156 @@
+"""Structured server log: JSON lines, written by a background thread (handler threads never wait for the disk)"""
+
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+from typing import Dict, Optional
+
+from Common_Setups import (
+    LOG_FILE, LOG_LEVEL, LOG_ECHO, LOG_FLUSH_SEC, LOG_MAX_PENDING, LOG_MAX_BYTES, LOG_BACKUPS, LOG_SAMPLE_EVERY,
+)
+
+LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40, "off": 100}
+FILE_ENV = "BOTCHAT_LOG_FILE"   # Overrides LOG_FILE ("-" = no file, e.g. benchmarks)
+
+
+class AsyncLogger:
+    """Callers only append a tuple to a deque (no lock, no I/O); the writer thread turns them into JSON lines.
+
+    - Records below `level` are dropped at the call, before anything is built
+    - Events listed in `sample_every` keep one record in N (the kept record says so: "sampled": N)
+    - At most `max_pending` records wait; more are counted as dropped instead of blocking the caller
+    - The file is rotated once it grows past `max_bytes` (file -> file.1 -> ... -> file.<backups>)
+    """
+
+    def __init__(self, path: Optional[str] = None, level: str = LOG_LEVEL, echo: bool = LOG_ECHO,
+                 flush_sec: float = LOG_FLUSH_SEC, max_pending: int = LOG_MAX_PENDING,
+                 max_bytes: int = LOG_MAX_BYTES, backups: int = LOG_BACKUPS,
+                 sample_every: Optional[Dict[str, int]] = None):
+        here = os.path.dirname(os.path.abspath(__file__))
+        path = path or os.environ.get(FILE_ENV) or os.path.join(here, LOG_FILE)
+        self.path = None if path == "-" else path
+        self.echo = echo
+        self.flush_sec = flush_sec
+        self.max_pending = max_pending
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.configure(level, sample_every)
+        self.pending: deque = deque()
+        self.stats = {"written": 0, "dropped": 0, "sampled_out": 0, "batches": 0, "rotations": 0}
+        self.file = None
+        self.stop_event = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    # Level + sampling (the server sets them from its command line before start()) -->
+    def configure(self, level: str = LOG_LEVEL, sample_every: Optional[Dict[str, int]] = None) -> None:
+        self.threshold = LEVELS[level]
+        self.sample_every = dict(LOG_SAMPLE_EVERY if sample_every is None else sample_every)
+        self.counters = {event: itertools.count() for event in self.sample_every}  # next() is atomic
+
+    # ----- Callers (handler threads) -----
+    def log(self, level: str, event: str, text: str = "", **fields) -> None:
+        if LEVELS[level] < self.threshold:
+            return
+        every = self.sample_every.get(event)
+        if every and every > 1:
+            if next(self.counters[event]) % every:
+                self.stats["sampled_out"] += 1
+                return
+            fields["sampled"] = every
+        if len(self.pending) >= self.max_pending:
+            self.stats["dropped"] += 1
+            return
+        self.pending.append((time.time(), level, event, text, fields))
+
+    def debug(self, event: str, text: str = "", **fields) -> None:
+        if LEVELS["debug"] >= self.threshold:   # Filtered before the record is built
+            self.log("debug", event, text, **fields)
+
+    def info(self, event: str, text: str = "", **fields) -> None:
+        if LEVELS["info"] >= self.threshold:
+            self.log("info", event, text, **fields)
+
+    def warning(self, event: str, text: str = "", **fields) -> None:
+        if LEVELS["warning"] >= self.threshold:
+            self.log("warning", event, text, **fields)
+
+    def error(self, event: str, text: str = "", **fields) -> None:
+        if LEVELS["error"] >= self.threshold:
+            self.log("error", event, text, **fields)
+
+    # ----- Writer -----
+    def start(self) -> None:
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+            self.thread.start()
+
+    # Drain: write what is still waiting, then stop the writer -->
+    def close(self) -> None:
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(5.0)
+            self.thread = None
+        else:
+            self._write_batch()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def _run(self) -> None:
+        while not self.stop_event.wait(self.flush_sec):
+            self._write_batch()
+        self._write_batch()
+
+    def _write_batch(self) -> None:
+        lines, echoed = [], []
+        pending = self.pending
+        while pending:
+            ts, level, event, text, fields = pending.popleft()
+            record = {"ts": round(ts, 3), "level": level, "event": event}
+            if text:
+                record["msg"] = text
+            record.update(fields)
+            lines.append(json.dumps(record, ensure_ascii=False, default=str))
+            if self.echo and text:
+                echoed.append(text)
+        if not lines:
+            return
+        self.stats["batches"] += 1
+        self.stats["written"] += len(lines)
+        if echoed:
+            try:
+                sys.stdout.write("\n".join(echoed) + "\n")
+                sys.stdout.flush()
+            except (OSError, ValueError):
+                self.echo = False   # stdout closed: keep the file going
+        if self.path is None:
+            return
+        try:
+            if self.file is None:
+                self.file = open(self.path, "a", encoding="utf-8")
+            self.file.write("\n".join(lines) + "\n")
+            self.file.flush()
+            if self.file.tell() >= self.max_bytes:
+                self._rotate()
+        except OSError:
+            pass
+
+    def _rotate(self) -> None:
+        self.file.close()
+        self.file = None
+        for i in range(self.backups - 1, 0, -1):
+            older = f"{self.path}.{i}"
+            if os.path.exists(older):
+                os.replace(older, f"{self.path}.{i + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.stats["rotations"] += 1
+
+
+log = AsyncLogger()     # The server's logger (Main_Server configures it with --log-level and starts it)
@@ -0,0 +1,171 @@
+"""Simulated network: Main_Server's routing over in-memory socket pairs, on a virtual clock (no threads, no kernel)"""
+
+import socket
+from typing import Callable, List, Optional, Tuple
+
+import Main_Server
+from Clocks import VirtualClock
+from Common_Setups import TIMER_WHEEL_TICK_SEC, TIMER_WHEEL_SLOTS
+from Timer_Wheel import TimerWheel
+
+
+class MemorySocket:
+    """One end of an in-memory socket pair: what one end sends, the other end receives.
+
+    Only what the server's send path uses (sendall / shutdown / close) plus recv for the client end.
+    `keep=False` only counts the bytes (a client nobody reads from: 100k of them stay cheap).
+    `conn`: the Session on the server end. A shutdown there (reaped, kicked, replaced by a resume) ends it,
+    like a real transport whose recv returns b"".
+    """
+    __slots__ = ("peer", "inbox", "keep", "received", "closed", "conn")
+
+    def __init__(self, keep: bool = True):
+        self.peer: Optional["MemorySocket"] = None
+        self.inbox: List[bytes] = []
+        self.keep = keep
+        self.received = 0       # Bytes that arrived here
+        self.closed = False
+        self.conn = None
+
+    def sendall(self, data: bytes) -> None:
+        peer = self.peer
+        if self.closed or peer is None or peer.closed:
+            raise BrokenPipeError
+        peer.received += len(data)
+        if peer.keep:
+            peer.inbox.append(data)
+
+    def recv(self, _bufsize: int = 65536) -> bytes:
+        if self.inbox:
+            data = b"".join(self.inbox)
+            self.inbox.clear()
+            return data
+        if self.closed or self.peer is None or self.peer.closed:
+            return b""
+        raise BlockingIOError   # Like a non-blocking socket with nothing to read
+
+    def shutdown(self, _how: int = socket.SHUT_RDWR) -> None:
+        self.closed = True
+        conn, self.conn = self.conn, None
+        if conn is not None:
+            Main_Server.end_connection(conn)
+
+    def close(self) -> None:
+        self.closed = True
+        self.conn = None
+
+
+def memory_socketpair(keep: bool = True) -> Tuple[MemorySocket, MemorySocket]:
+    server_end, client_end = MemorySocket(), MemorySocket(keep)
+    server_end.peer, client_end.peer = client_end, server_end
+    return server_end, client_end
+
+
+class SimClient:
+    """A simulated user: its lines go straight into Main_Server.handle_line (on the caller's thread)."""
+    __slots__ = ("net", "conn", "sock", "buffer")
+
+    def __init__(self, net: "SimNetwork", conn: "Main_Server.Session", sock):
+        self.net = net
+        self.conn = conn
+        self.sock = sock        # Client end
+        self.buffer = b""
+
+    @property
+    def name(self) -> str:
+        return self.conn.nickname
+
+    def send(self, line: str) -> bool:
+        alive = Main_Server.handle_line(self.conn, line)
+        if not alive:
+            self.close()
+        return alive
+
+    # Lines the server sent to this client since the last call -->
+    def lines(self) -> List[str]:
+        chunks = [self.buffer]
+        while True:     # A kernel socket hands out at most bufsize per recv
+            try:
+                data = self.sock.recv(65536)
+            except BlockingIOError:
+                break
+            if not data:
+                break
+            chunks.append(data)
+        *complete, self.buffer = b"".join(chunks).split(b"\n")
+        return [line.decode("utf-8", "replace") for line in complete]
+
+    def close(self) -> None:
+        Main_Server.end_connection(self.conn)
+
+
+class SimNetwork:
+    """Runs Main_Server's connection handling without its TCP transport.
+
+    The server's clock becomes a VirtualClock (its timer wheel - resume grace periods, heartbeats - ticks on
+    advance()), its log is silenced and its state is reset, so a run depends only on what the caller sends.
+    `pair` makes the transport: memory_socketpair (default), or socket.socketpair to measure the kernel.
+    `heartbeat`: seconds of silence before a PING (0 = off: simulated clients that never answer stay).
+    """
+
+    def __init__(self, clock: Optional[VirtualClock] = None, pair: Callable = memory_socketpair,
+                 log_level: str = "off", heartbeat: float = 0.0):
+        self.clock = clock or VirtualClock()
+        self.pair = pair
+        self.count = 0
+        Main_Server.clock = self.clock
+        Main_Server.wheel.stop()
+        Main_Server.wheel = TimerWheel(self.clock, TIMER_WHEEL_TICK_SEC, TIMER_WHEEL_SLOTS)
+        Main_Server.wheel.start()
+        Main_Server.heartbeat['idle'] = heartbeat
+        Main_Server.log.configure(log_level)
+        reset_server_state()
+
+    def _pair(self, keep: bool):
+        if self.pair is memory_socketpair:
+            return memory_socketpair(keep)
+        server_end, client_end = self.pair()
+        client_end.setblocking(False)
+        return server_end, client_end
+
+    # Join through the real path (SESSION, USERS to everyone, join announcement...) -->
+    def connect(self, first_line: str, keep: bool = True) -> Optional[SimClient]:
+        server_end, client_end = self._pair(keep)
+        self.count += 1
+        conn = Main_Server.open_connection(server_end, ("sim", self.count))
+        if self.pair is memory_socketpair:
+            server_end.conn = conn
+        if Main_Server.start_connection(conn, first_line) is None:
+            Main_Server.end_connection(conn)
+            return None
+        return SimClient(self, conn, client_end)
+
+    # Join without telling anybody (no USERS / announcement: those are O(users) each, so O(n^2) for n joins).
+    # For building a big population quickly; the session, name and socket are registered like a real join -->
+    def attach(self, name: str, keep: bool = False) -> SimClient:
+        server_end, client_end = self._pair(keep)
+        self.count += 1
+        conn = Main_Server.open_connection(server_end, ("sim", self.count))
+        if self.pair is memory_socketpair:
+            server_end.conn = conn
+        conn.nickname = name
+        with Main_Server.online_users_lock:
+            Main_Server.online_users[name] = server_end
+        conn.token = Main_Server.open_session(name, server_end)
+        Main_Server.watch_connection(conn)
+        return SimClient(self, conn, client_end)
+
+    def advance(self, seconds: float) -> None:
+        self.clock.advance(seconds)
+
+
+# Forget every user, session, room and message (a fresh server in the same process) -->
+def reset_server_state() -> None:
+    with Main_Server.online_users_lock:
+        for table in (Main_Server.online_users, Main_Server.sessions, Main_Server.parked_names,
+                      Main_Server.channel_seqs, Main_Server.channel_history, Main_Server.seen_ids,
+                      Main_Server.rooms, Main_Server.connections):
+            table.clear()
+        Main_Server.history.clear()
+        Main_Server.kicked.clear()
+        Main_Server.compressing.clear()
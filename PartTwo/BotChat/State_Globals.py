@@ -1,22 +1,175 @@
 """Shared in-process state for Launcher_UI and Chat_UI (NiceGUI app)"""
 
-from typing import List, Tuple, Dict, Any
+import atexit
+import threading
+from typing import List, Tuple, Dict, Any, Set, Callable, Awaitable, Optional
+
+from Common_Setups import CLIENT_STATE_ENABLED, CLIENT_STATE_LOAD_RECENT
+from State_Store import open_store, PersistentList, PersistentDict, UPSERT_SEQ, CLEAR_SEQ, CLEAR_SEQS
+from Search_Index import SearchIndex
+
+# ==============================
+# ===== Persistence (SQLite) ===
+# ==============================
+# Everything below marked "persisted" survives a restart of Run_App.py (writes are batched off the UI loop) -->
+store = open_store(CLIENT_STATE_ENABLED)
+if store is not None:
+    atexit.register(store.flush)
 
 # =========================
 # ===== Chat Storage  =====
 # =========================
-# History storage. Format: (msg_id, sender, text, stamp, target_id) -->
-messages: List[Tuple[str, str, str, str, str]] = []
+# History storage (persisted). Format: (msg_id, sender, text, stamp, target_id) -->
+messages: List[Tuple[str, str, str, str, str]] = PersistentList(store)
+
+# Server order of the stored messages (seq numbers are per channel, see Common_Setups.channel_of) -->
+message_seqs: Dict[str, Tuple[str, int]] = PersistentDict(  # msg_id -> (channel, seq)
+    store, "seqs", lambda mid, cs: (UPSERT_SEQ, (mid, cs[0], cs[1])), lambda mid: (CLEAR_SEQ, (mid,)), (CLEAR_SEQS, ()))
+channel_heads: Dict[str, int] = PersistentDict(store, "heads")  # channel -> highest seq stored (persisted)
+channel_missing: Dict[str, Set[int]] = {}  # channel -> seqs below the head that did not arrive (yet)
+pending_msg_ids: Set[str] = set()  # Sent from here and shown already, waiting for the server's echo
+seq_state = PersistentDict(store, "seq_state")  # {'epoch': ...} the seqs belong to (a new one restarts the counting)
+seq_state.setdefault('epoch', None)
+seq_lock = threading.Lock()  # Several chat tabs (listener threads) share the state above
+MAX_TRACKED_GAP = 1000  # Don't remember more missing seqs than the server could ever send back
+
+# Register seq of a channel. Returns (is_new, gap): gap = (lo, hi) seqs that were skipped, else None -->
+def track_seq(channel: str, seq: int) -> Tuple[bool, Optional[Tuple[int, int]]]:
+    with seq_lock:
+        head = channel_heads.get(channel)
+        if head is None or seq == head + 1:   # First one we see on this channel counts as the start
+            channel_heads[channel] = seq
+            return True, None
+        if seq > head:
+            lo = max(head + 1, seq - MAX_TRACKED_GAP)
+            channel_missing.setdefault(channel, set()).update(range(lo, seq))
+            channel_heads[channel] = seq
+            return True, (lo, seq - 1)
+        missing = channel_missing.get(channel)
+        if missing and seq in missing:  # Late (reordered / fetched) message fills a gap
+            missing.discard(seq)
+            return True, None
+        return False, None
+
+# Seqs of [lo, hi] that are still missing -->
+def still_missing(channel: str, lo: int, hi: int) -> List[int]:
+    with seq_lock:
+        missing = channel_missing.get(channel, set())
+        return [seq for seq in range(lo, hi + 1) if seq in missing]
+
+# A different server epoch means the counters restarted -> forget the old seqs -->
+def set_seq_epoch(epoch: str) -> None:
+    with seq_lock:
+        if seq_state['epoch'] != epoch:
+            seq_state['epoch'] = epoch
+            channel_heads.clear()
+            channel_missing.clear()
+
+# Warm start: only the newest messages are read now (cost independent of the history size) -->
+def _load_rows(rows) -> List[Tuple[str, str, str, str, str]]:
+    loaded = []
+    for _id, msg_id, sender, text, stamp, target, channel, seq in rows:
+        loaded.append((msg_id, sender, text, stamp, target))
+        if channel is not None:
+            dict.__setitem__(message_seqs, msg_id, (channel, seq))  # Already stored -> no write back
+    return loaded
+
+# Older history on demand (e.g. "Load older messages"). Returns how many were added at the front -->
+def load_older_messages(limit: int = CLIENT_STATE_LOAD_RECENT) -> int:
+    if store is None:
+        return 0
+    older = _load_rows(store.load_older(limit))
+    with seq_lock:
+        list.__setitem__(messages, slice(0, 0), older)
+    return len(older)
+
+def has_older_messages() -> bool:
+    return store is not None and store.has_older()
+
+if store is not None:
+    list.extend(messages, _load_rows(store.load_recent(CLIENT_STATE_LOAD_RECENT)))
+
+# ==========================
+# ===== Search Index  ======
+# ==========================
+# Words -> messages. Chat_UI adds every new message; the stored history is indexed in the background -->
+search_index = SearchIndex()
+search_state = {'indexed_history': store is None}  # False while the stored history is still being indexed
+
+def _index_history(upto: int) -> None:
+    try:
+        for rows in store.iter_messages(upto):
+            search_index.add_many(rows)
+    finally:
+        search_index.release_live()  # The messages that arrived meanwhile get numbers after the history
+        search_state['indexed_history'] = True
+
+if store is not None:  # Only rows that exist now: newer messages are added by the chat as they arrive
+    search_index.hold_live()    # Newer = higher number: live messages wait until the history is in
+    threading.Thread(target=_index_history, args=(store.last_row_id(),), name="search-indexer", daemon=True).start()
+
+# The messages behind search results: loaded ones from memory, the others from the store -->
+def find_messages(msg_ids: List[str]) -> Dict[str, Tuple[str, str, str, str, str]]:
+    wanted = set(msg_ids)
+    found = {m[0]: m for m in list(messages) if m[0] in wanted}
+    missing = [mid for mid in msg_ids if mid not in found]
+    if missing and store is not None:
+        for row in store.load_by_msg_ids(missing):
+            found[row[0]] = tuple(row)
+    return found
+
+# Load older pages until `msg_id` is in `messages` (jump to an old search result). False if it never shows up -->
+def load_until(msg_id: str) -> bool:
+    while not any(m[0] == msg_id for m in messages):
+        if not load_older_messages():
+            return False
+    return True
+
+# Insert a message in seq order of its channel (normally that is simply the end of the list) -->
+def store_message(msg: Tuple[str, str, str, str, str], channel: str, seq: int) -> None:
+    with seq_lock:
+        message_seqs[msg[0]] = (channel, seq)
+        if channel_heads.get(channel) == seq:  # Newest of its channel (track_seq ran first) -> O(1)
+            messages.append(msg)
+            return
+        pos = len(messages)
+        for i in range(len(messages) - 1, -1, -1):
+            info = message_seqs.get(messages[i][0])
+            if info is not None and info[0] == channel:
+                if info[1] < seq:
+                    break
+                pos = i
+        messages.insert(pos, msg)
 
 # List of connected usernames (synced by server USERS messages) -->
 active_users_list: List[str] = []
 
+# Callbacks fired as (added, removed) when the roster changes (called from the socket listener threads) -->
+roster_listeners: List[Callable[[List[str], List[str]], None]] = []
+
+# Replace the roster in place and fire roster_listeners only when somebody joined or left -->
+def set_active_users(names: List[str]) -> None:
+    old = set(active_users_list)
+    active_users_list[:] = names
+    new = set(names)
+    added = [n for n in names if n not in old]
+    removed = [n for n in old if n not in new]
+    if not added and not removed:
+        return
+    for listener in list(roster_listeners):
+        try:
+            listener(added, removed)
+        except Exception as e:
+            print("Roster listener failed:", e)
+
 
 # ==============================
 # ===== Avatar Sync Storage ====
 # ==============================
-# [(Username) -> (Avatar URL)] dictionary chosen by the user (synced via server) -->
-avatar_urls: Dict[str, str] = {}
+# [(Username) -> (Avatar URL)] dictionary chosen by the user (synced via server, persisted) -->
+avatar_urls: Dict[str, str] = PersistentDict(store, "avatar_urls")
+# [(Avatar hash) -> (Avatar URL)] the server sends hashes only; each URL is fetched once (persisted) -->
+avatar_blobs: Dict[str, str] = PersistentDict(store, "avatar_blobs")
 
 
 # ==============================
@@ -25,8 +178,15 @@ avatar_urls: Dict[str, str] = {}
 BG_COLORS = ['b6e3f4', 'c0aede', 'd1f0cc', 'ffd5dc', 'fff3c4', 'f1c27d',
              'e0f2fe', 'ede9fe', 'c7f9cc', 'ffcad4']   # Colors option fo the avatars background
 
-# seed -> chosen background color (keeps consistent avatar bg per user/seed)
-user_colors_cache: Dict[str, Any] = {}
+# seed -> chosen background color (keeps consistent avatar bg per user/seed, persisted)
+user_colors_cache: Dict[str, Any] = PersistentDict(store, "user_colors")
+
+# username -> seed string (used to keep avatar consistent after rename, persisted)
+avatar_seeds: Dict[str, str] = PersistentDict(store, "avatar_seeds")
+
 
-# username -> seed string (used to keep avatar consistent after rename)
-avatar_seeds: Dict[str, str] = {}
+# ===============================
+# ===== Open Chat Sessions  =====
+# ===============================
+# One async "disconnect" callback per open chat tab (QUIT + wait for the server), used to close many at once -->
+chat_disconnectors: Set[Callable[[], Awaitable[None]]] = set()
@@ -0,0 +1,326 @@
+"""SQLite persistence behind the shared client state (State_Globals)"""
+
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from Common_Setups import CLIENT_STATE_DB, CLIENT_STATE_FLUSH_MS, SEARCH_INDEX_BATCH
+
+DB_ENV = "BOTCHAT_CLIENT_DB"    # Overrides CLIENT_STATE_DB (benchmarks, several instances on one machine)
+MAX_BATCH = 5000                # Most writes per transaction
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS messages ("
+    " id INTEGER PRIMARY KEY, msg_id TEXT UNIQUE, sender TEXT, text TEXT, stamp TEXT, target TEXT,"
+    " channel TEXT, seq INTEGER)",
+    "CREATE TABLE IF NOT EXISTS kv (ns TEXT, key TEXT, value TEXT, PRIMARY KEY (ns, key)) WITHOUT ROWID",
+)
+
+UPSERT_MESSAGE = ("INSERT INTO messages (msg_id, sender, text, stamp, target) VALUES (?, ?, ?, ?, ?) "
+                  "ON CONFLICT(msg_id) DO UPDATE SET sender = excluded.sender, text = excluded.text, "
+                  "stamp = excluded.stamp, target = excluded.target")
+UPSERT_SEQ = ("INSERT INTO messages (msg_id, channel, seq) VALUES (?, ?, ?) "
+              "ON CONFLICT(msg_id) DO UPDATE SET channel = excluded.channel, seq = excluded.seq")
+CLEAR_SEQ = "UPDATE messages SET channel = NULL, seq = NULL WHERE msg_id = ?"
+CLEAR_SEQS = "UPDATE messages SET channel = NULL, seq = NULL"
+DELETE_MESSAGE = "DELETE FROM messages WHERE msg_id = ?"
+DELETE_MESSAGES = "DELETE FROM messages"
+UPSERT_KV = "INSERT OR REPLACE INTO kv (ns, key, value) VALUES (?, ?, ?)"
+DELETE_KV_KEY = "DELETE FROM kv WHERE ns = ? AND key = ?"
+DELETE_KV = "DELETE FROM kv WHERE ns = ?"
+
+
+class StateStore:
+    """One SQLite file (WAL). The UI only enqueues writes; a background thread commits them in batches."""
+
+    def __init__(self, path: str, flush_sec: float = CLIENT_STATE_FLUSH_MS / 1000.0):
+        self.path = path
+        self.flush_sec = flush_sec
+        self.db = sqlite3.connect(path, check_same_thread=False)   # Reads: UI thread, writes: writer thread
+        self.db.execute("PRAGMA journal_mode=WAL")      # Readers never wait for the writer
+        self.db.execute("PRAGMA synchronous=NORMAL")    # fsync per checkpoint, not per commit
+        for statement in SCHEMA:
+            self.db.execute(statement)
+        self.db.commit()
+        self.db_lock = threading.Lock()
+        self.oldest_id: Optional[int] = None    # Oldest message row loaded so far (for load_older)
+        self.writes: "queue.SimpleQueue[Tuple[str, Any]]" = queue.SimpleQueue()
+        self.stats = {"writes": 0, "batches": 0}
+        threading.Thread(target=self._writer, name="state-store-writer", daemon=True).start()
+
+    # ----- Reads (UI side) -----
+    def _message_rows(self, where: str, args: tuple, limit: int) -> List[tuple]:
+        with self.db_lock:
+            rows = self.db.execute(
+                f"SELECT id, msg_id, sender, text, stamp, target, channel, seq FROM messages "
+                f"WHERE sender IS NOT NULL {where} ORDER BY id DESC LIMIT ?", args + (limit,)).fetchall()
+        rows.reverse()
+        if rows:
+            self.oldest_id = rows[0][0] if self.oldest_id is None else min(self.oldest_id, rows[0][0])
+        return rows
+
+    # The newest `limit` messages (oldest first). Uses the rowid index: cost does not depend on the table size -->
+    def load_recent(self, limit: int) -> List[tuple]:
+        return self._message_rows("", (), limit)
+
+    # One page before the oldest message loaded so far -->
+    def load_older(self, limit: int) -> List[tuple]:
+        if self.oldest_id is None:
+            return []
+        return self._message_rows("AND id < ?", (self.oldest_id,), limit)
+
+    def has_older(self) -> bool:
+        if self.oldest_id is None:
+            return False
+        with self.db_lock:
+            return self.db.execute("SELECT 1 FROM messages WHERE id < ? LIMIT 1", (self.oldest_id,)).fetchone() is not None
+
+    def last_row_id(self) -> int:
+        with self.db_lock:
+            return self.db.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+
+    # Every stored message up to row `upto`, oldest first, in batches of (msg_id, sender, target, text) -->
+    # The lock is taken per batch, so the UI reads in between.
+    def iter_messages(self, upto: int, batch: int = SEARCH_INDEX_BATCH):
+        after = 0
+        while True:
+            with self.db_lock:
+                rows = self.db.execute(
+                    "SELECT id, msg_id, sender, target, text FROM messages "
+                    "WHERE sender IS NOT NULL AND id > ? AND id <= ? ORDER BY id LIMIT ?", (after, upto, batch)).fetchall()
+            if not rows:
+                return
+            after = rows[-1][0]
+            yield [row[1:] for row in rows]
+
+    # Messages by msg_id (search results that are not loaded), as (msg_id, sender, text, stamp, target) -->
+    def load_by_msg_ids(self, msg_ids: List[str]) -> List[tuple]:
+        marks = ",".join("?" * len(msg_ids))
+        with self.db_lock:
+            return self.db.execute(f"SELECT msg_id, sender, text, stamp, target FROM messages "
+                                   f"WHERE sender IS NOT NULL AND msg_id IN ({marks})", tuple(msg_ids)).fetchall()
+
+    def load_kv(self, ns: str) -> Dict[str, Any]:
+        with self.db_lock:
+            rows = self.db.execute("SELECT key, value FROM kv WHERE ns = ?", (ns,)).fetchall()
+        return {k: json.loads(v) for k, v in rows}
+
+    # ----- Writes (any thread -> writer thread) -----
+    def put(self, sql: str, params: tuple) -> None:
+        self.writes.put((sql, params))
+
+    # Block until everything enqueued so far is committed -->
+    def flush(self, timeout: float = 5.0) -> bool:
+        done = threading.Event()
+        self.writes.put(("", done))
+        return done.wait(timeout)
+
+    def _writer(self) -> None:
+        while True:
+            batch = [self.writes.get()]
+            deadline = time.monotonic() + self.flush_sec
+            while len(batch) < MAX_BATCH:   # Gather for a moment: one transaction for many writes
+                try:
+                    batch.append(self.writes.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            self._commit(batch)
+
+    def _commit(self, batch: List[Tuple[str, Any]]) -> None:
+        waiters = []
+        with self.db_lock:
+            try:
+                i = 0
+                while i < len(batch):
+                    sql = batch[i][0]
+                    if not sql:  # flush() marker
+                        waiters.append(batch[i][1])
+                        i += 1
+                        continue
+                    j = i
+                    while j < len(batch) and batch[j][0] == sql:  # Same statement in a row -> executemany
+                        j += 1
+                    self.db.executemany(sql, [params for _sql, params in batch[i:j]])
+                    i = j
+                self.db.commit()
+                self.stats["writes"] += len(batch) - len(waiters)
+                self.stats["batches"] += 1
+            except sqlite3.Error as e:
+                print("State store write failed:", e)
+                self.db.rollback()
+        for done in waiters:
+            done.set()
+
+
+# ===================================
+# ===== Persistent containers  ======
+# ===================================
+# Every method that changes the container is overridden: list / dict methods written in C never call
+# __setitem__, so one that is not would change memory only and the change would be lost at the next start.
+class PersistentList(list):
+    """`messages`: a normal list whose changes are also written to the store (rows keyed by msg_id, item[0]).
+
+    Adding or replacing items upserts them, taking them out deletes their rows. Pages loaded from the store
+    (State_Globals) go in with the plain list methods, so they are not written back.
+    """
+
+    def __init__(self, store: Optional[StateStore]):
+        super().__init__()
+        self.store = store
+
+    def _save(self, item) -> None:
+        if self.store is not None:
+            self.store.put(UPSERT_MESSAGE, tuple(item))
+
+    def _drop(self, item) -> None:
+        if self.store is not None:
+            self.store.put(DELETE_MESSAGE, (item[0],))
+
+    def append(self, item) -> None:
+        super().append(item)
+        self._save(item)
+
+    def extend(self, items) -> None:
+        items = list(items)
+        super().extend(items)
+        for item in items:
+            self._save(item)
+
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
+
+    def __imul__(self, n):
+        if n <= 0:      # Same rows otherwise (msg_ids repeat), only `*= 0` takes anything out
+            self.clear()
+            return self
+        return super().__imul__(n)
+
+    def insert(self, index, item) -> None:
+        super().insert(index, item)
+        self._save(item)
+
+    def __setitem__(self, index, item) -> None:
+        if not isinstance(index, slice):
+            old = super().__getitem__(index)
+            super().__setitem__(index, item)
+            if old[0] != item[0]:
+                self._drop(old)
+            self._save(item)
+            return
+        old, item = super().__getitem__(index), list(item)
+        super().__setitem__(index, item)
+        kept = {new[0] for new in item}
+        for gone in old:
+            if gone[0] not in kept:
+                self._drop(gone)
+        for new in item:
+            self._save(new)
+
+    def __delitem__(self, index) -> None:
+        gone = super().__getitem__(index)
+        super().__delitem__(index)
+        for item in (gone if isinstance(index, slice) else (gone,)):
+            self._drop(item)
+
+    def pop(self, index=-1):
+        item = super().pop(index)
+        self._drop(item)
+        return item
+
+    def remove(self, item) -> None:
+        super().remove(item)
+        self._drop(item)
+
+    def clear(self) -> None:
+        super().clear()
+        if self.store is not None:
+            self.store.put(DELETE_MESSAGES, ())
+
+
+class PersistentDict(dict):
+    """A dict mirrored to one namespace of the kv table (values must be JSON friendly).
+
+    A dict that lives in another table gives its own statements: to_sql(key, value) for a write,
+    del_sql(key) for a removed key and clear_sql for clear().
+    """
+
+    def __init__(self, store: Optional[StateStore], ns: str,
+                 to_sql: Optional[Callable[[Any, Any], Tuple[str, tuple]]] = None,
+                 del_sql: Optional[Callable[[Any], Tuple[str, tuple]]] = None,
+                 clear_sql: Optional[Tuple[str, tuple]] = None):
+        super().__init__()
+        if to_sql is not None and (del_sql is None or clear_sql is None):
+            raise ValueError(f"PersistentDict {ns!r}: to_sql needs del_sql and clear_sql too")
+        self.store = store
+        self.ns = ns
+        self.to_sql = to_sql    # Custom write (e.g. message seqs live in the messages table)
+        self.del_sql = del_sql
+        self.clear_sql = clear_sql
+        if store is not None and to_sql is None:
+            super().update(store.load_kv(ns))
+
+    def __setitem__(self, key, value) -> None:
+        super().__setitem__(key, value)
+        if self.store is not None:
+            if self.to_sql is not None:
+                self.store.put(*self.to_sql(key, value))
+            else:
+                self.store.put(UPSERT_KV, (self.ns, str(key), json.dumps(value)))
+
+    def _drop(self, key) -> None:
+        if self.store is not None:
+            if self.del_sql is not None:
+                self.store.put(*self.del_sql(key))
+            else:
+                self.store.put(DELETE_KV_KEY, (self.ns, str(key)))
+
+    def __delitem__(self, key) -> None:
+        super().__delitem__(key)
+        self._drop(key)
+
+    def pop(self, key, *default):
+        had = key in self   # pop(missing, default) changes nothing
+        value = super().pop(key, *default)
+        if had:
+            self._drop(key)
+        return value
+
+    def popitem(self):
+        key, value = super().popitem()
+        self._drop(key)
+        return key, value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return super().__getitem__(key)
+
+    def update(self, *args, **kwargs) -> None:
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def clear(self) -> None:
+        super().clear()
+        if self.store is not None:
+            self.store.put(*(self.clear_sql or (DELETE_KV, (self.ns,))))
+
+
+# The store for this process (None if persistence is off or the file can't be opened) -->
+def open_store(enabled: bool = True) -> Optional[StateStore]:
+    if not enabled:
+        return None
+    path = os.environ.get(DB_ENV) or os.path.join(os.path.dirname(os.path.abspath(__file__)), CLIENT_STATE_DB)
+    try:
+        return StateStore(path)
+    except sqlite3.Error as e:
+        print(f"Client state is not persisted ({path}): {e}")
+        return None
@@ -0,0 +1,91 @@
+"""Hashed timer wheel: every server timer (heartbeats, resume grace periods) in one structure, driven by one tick"""
+
+import math
+import threading
+from typing import Callable, Dict, Hashable, List
+
+
+class TimerWheel:
+    """`slots` buckets, one per tick; a timer goes into the bucket of the tick it is due on.
+
+    schedule / cancel are O(1) (a dict per bucket + key -> bucket), a tick only looks at its own bucket.
+    Timers further out than one turn (slots * tick) carry the number of extra turns they wait.
+    A key has at most one timer: scheduling it again moves it (a connection's idle check, a parked session).
+    Timers fire on the tick after they are due (never early, at most one tick late) - outside the lock,
+    so a callback may schedule again. The clock is the server's (Clocks): RealClock ticks on its one
+    long-lived timer thread, a VirtualClock ticks inside advance().
+    """
+
+    def __init__(self, clock, tick: float, slots: int):
+        self.clock = clock
+        self.tick = tick
+        self.slots = slots
+        self.buckets: List[Dict] = [{} for _ in range(slots)]  # key -> (turns left, fn, args)
+        self.where: Dict[Hashable, int] = {}    # key -> its bucket
+        self.cursor = 0                         # Bucket of the last tick that ran
+        self.last = clock.monotonic()           # When that tick was due
+        self.lock = threading.Lock()
+        self.running = False
+        self.stats = {"scheduled": 0, "cancelled": 0, "fired": 0, "errors": 0, "ticks": 0}
+
+    def __len__(self) -> int:
+        return len(self.where)
+
+    # Run fn(*args) in `delay` seconds (replaces the key's earlier timer) -->
+    def schedule(self, key: Hashable, delay: float, fn: Callable, *args) -> None:
+        with self.lock:
+            ticks = max(1, math.ceil((self.clock.monotonic() - self.last + delay) / self.tick))
+            old = self.where.get(key)
+            if old is not None:
+                del self.buckets[old][key]
+            slot = (self.cursor + ticks) % self.slots
+            self.buckets[slot][key] = ((ticks - 1) // self.slots, fn, args)
+            self.where[key] = slot
+            self.stats["scheduled"] += 1
+
+    def cancel(self, key: Hashable) -> None:
+        with self.lock:
+            slot = self.where.pop(key, None)
+            if slot is not None:
+                del self.buckets[slot][key]
+                self.stats["cancelled"] += 1
+
+    # Run every tick that is due by now (several if the clock jumped). Returns how many timers fired -->
+    def advance(self) -> int:
+        now = self.clock.monotonic()
+        due = []
+        with self.lock:
+            while self.last + self.tick <= now:
+                self.last += self.tick
+                self.cursor = (self.cursor + 1) % self.slots
+                self.stats["ticks"] += 1
+                bucket = self.buckets[self.cursor]
+                for key, (turns, fn, args) in list(bucket.items()):
+                    if turns:
+                        bucket[key] = (turns - 1, fn, args)
+                    else:
+                        del bucket[key]
+                        del self.where[key]
+                        due.append((fn, args))
+        for fn, args in due:
+            try:
+                fn(*args)
+            except Exception:   # One broken callback must not stop the others (or the wheel)
+                self.stats["errors"] += 1
+        self.stats["fired"] += len(due)
+        return len(due)
+
+    def start(self) -> None:
+        self.running = True
+        self.clock.call_later(self.tick, self._tick)
+
+    def stop(self) -> None:
+        self.running = False
+
+    def _tick(self) -> None:
+        if not self.running:
+            return
+        try:
+            self.advance()
+        finally:
+            self.clock.call_later(self.tick, self._tick)
@@ -4,7 +4,20 @@ from nicegui import ui
 from fastapi import Request
 
 from Launcher_UI import build_launcher_ui
-from Chat_UI import build_chat_ui
+
+
+# The chat builder is imported on the first mode=chat request (or by prewarm_chat_ui), not at startup -->
+def chat_builder():
+    from Chat_UI import build_chat_ui
+    return build_chat_ui
+
+
+# Import the chat page in the background while the user looks at the launcher -->
+def prewarm_chat_ui() -> None:
+    try:
+        chat_builder()
+    except Exception as e:
+        print("Chat UI prewarm failed:", e)
 
 
 @ui.page('/')
@@ -12,6 +25,6 @@ async def main(request: Request) -> None:
     is_chat = (request.query_params.get('mode') == 'chat')
 
     if is_chat:
-        await build_chat_ui(request)
+        await chat_builder()(request)
     else:
         await build_launcher_ui(request)
\ No newline at end of file
@@ -0,0 +1,103 @@
+"""Property tests for the protocol codec (seeded random frames): round trips, junk lines, CPU per byte"""
+
+import random
+import time
+
+import Protocol
+from Common_Setups import PROTOCOL_MAX_LINE_BYTES
+
+SEED = 11
+CASES = 20_000
+ALPHABET = "|:\\\n\rpcnr aZ09,=#é🙂"    # Separators, escape letters and multi-byte characters
+SPECIALS = "a|b:c\\d\ne\rf\\\\p\\c|:"   # Every character the codec escapes, next to the escape letters
+TABLES = [(Protocol.SERVER_FRAMES, Protocol.decode), (Protocol.COMMANDS, Protocol.decode_command),
+          (Protocol.PEER_FRAMES, Protocol.decode_peer)]
+NS_PER_BYTE_LIMIT = 100.0                # Hostile lines at the size limit (measured: ~10-20 ns/byte)
+
+
+# Every frame class of a table (+ the chat message, which is a command without a head) -->
+def _classes(table, decode) -> list:
+    return list(table.values()) + ([Protocol.Send] if decode is Protocol.decode_command else [])
+
+def _frame(cls, fields):
+    frame = cls(*fields)
+    if cls is Protocol.Send and frame.target == Protocol.CMD:   # Reserved name (is_reserved_name)
+        frame.target = "x"
+    return frame
+
+def _ns_per_byte(line: str, reps: int = 3) -> float:
+    best = float("inf")
+    for _ in range(reps):   # Best of a few: a preempted run says nothing about the codec
+        t0 = time.perf_counter_ns()
+        Protocol.decode(line)
+        Protocol.decode_command(line)
+        best = min(best, time.perf_counter_ns() - t0)
+    return best / len(line)
+
+
+# ======================
+# ===== Round trips ====
+# ======================
+def test_every_frame_round_trips_with_special_characters():
+    for table, decode in TABLES:
+        for cls in _classes(table, decode):
+            for fields in ([SPECIALS] * len(cls.__slots__), [""] * len(cls.__slots__),
+                           [f"{name}{SPECIALS}" for name in cls.__slots__]):
+                frame = _frame(cls, fields)
+                assert decode(frame.encode()) == frame, (frame, frame.encode())
+
+def test_random_frames_round_trip():
+    rng = random.Random(SEED)
+    for _ in range(CASES):
+        table, decode = rng.choice(TABLES)
+        cls = rng.choice(_classes(table, decode))
+        frame = _frame(cls, ["".join(rng.choices(ALPHABET, k=rng.randint(0, 24))) for _ in cls.__slots__])
+        line = frame.encode()
+        assert "\n" not in line and "\r" not in line
+        assert decode(line) == frame, (frame, line)
+
+def test_unescape_matches_the_escape_reader():
+    rng = random.Random(SEED)
+    for _ in range(CASES):
+        text = "".join(rng.choices("\\\\\\pcnrx|:\n\0", k=rng.randint(0, 20)))
+        assert Protocol.unescape(text) == Protocol._ESCAPE_RE.sub(Protocol._unescape_one, text), repr(text)
+    for text in ("a|b", "a\\nb\\\\", "\\"):
+        assert Protocol.unescape(Protocol.escape(text)) == text
+
+
+# ====================
+# ===== Junk lines ===
+# ====================
+def test_junk_lines_decode_or_return_none():
+    rng = random.Random(SEED)
+    heads = ["MSG|", "ACK|", "CMD:", "CMD:HISTORY:", "CMD:RESUME:", "FWD|", "RAW|", ""]
+    for _ in range(CASES):
+        junk = rng.choice(heads) + "".join(rng.choices(ALPHABET, k=rng.randint(0, 64)))
+        for _table, decode in TABLES:
+            frame = decode(junk)    # An exception fails the test
+            assert frame is None or isinstance(frame, Protocol.Frame)
+
+def test_lines_over_the_limit_are_not_decoded():
+    over = "MSG|a|b|c|1|" + "x" * PROTOCOL_MAX_LINE_BYTES
+    assert Protocol.decode(over) is None
+    assert Protocol.decode_command("ALL:1:" + "x" * PROTOCOL_MAX_LINE_BYTES) is None
+
+
+# ===================
+# ===== CPU bound ===
+# ===================
+# Hostile shapes near the size limit: a bounded cost per byte, and no growth with the length -->
+def test_hostile_lines_stay_linear():
+    size = PROTOCOL_MAX_LINE_BYTES - 64
+    shapes = {
+        "backslashes": lambda k: "MSG|a|b|c|1|" + "\\" * k,
+        "escapes": lambda k: "MSG|a|b|c|1|" + "\\p\\c\\n" * (k // 6),
+        "escaped_backslashes": lambda k: "MSG|a|b|c|1|" + "\\\\\\p" * (k // 4),
+        "pipes": lambda k: "MSG|" + "|" * k,
+        "colons": lambda k: "CMD:HISTORY:" + ":" * k,
+        "cmd_prefixes": lambda k: "CMD:" * (k // 4),
+    }
+    for name, make in shapes.items():
+        small, large = _ns_per_byte(make(size // 20)), _ns_per_byte(make(size))
+        assert large < NS_PER_BYTE_LIMIT, (name, large)
+        assert large < max(small, 1.0) * 4, (name, small, large)